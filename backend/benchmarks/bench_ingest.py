@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк путей загрузки истории на синтетических чатах (без живого Telegram)
+
+Запуск из папки backend:
+    python -m benchmarks.bench_ingest --messages 10000
+    python -m benchmarks.bench_ingest --messages 100000 --latency-ms 50
+    python -m benchmarks.bench_ingest --messages 10000 --save-baseline
+    python -m benchmarks.bench_ingest --messages 5000 --server-rate 200
+    python -m benchmarks.bench_ingest --messages 50000 --latency-ms 50 --shards 8
+    python -m benchmarks.bench_ingest --scenario download_chat_media --media-types voice
+
+Каждый сценарий выполняется в отдельном процессе во временной папке,
+чтобы пиковый RSS не смешивался между сценариями. Результат сравнивается
+с сохранёнными базовыми значениями (benchmarks/baselines.json); при
+регрессии скрипт завершается с кодом 1.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+BASELINES_FILE = os.path.join(BENCH_DIR, "baselines.json")
+
+CHAT_ID = 777
+SCENARIOS = ("download_history", "export_chat_for_llm", "download_chat_media")
+
+
+def parse_mix(value: str) -> dict:
+    """"voice=0.05,photo=0.05" -> {"voice": 0.05, "photo": 0.05}"""
+    mix = {}
+    for part in filter(None, value.split(",")):
+        kind, share = part.split("=")
+        mix[kind.strip()] = float(share)
+    return mix
+
+
+def make_client(args):
+    from benchmarks.fake_telegram import FakeChat, FakeTelegramClient
+    chat = FakeChat(CHAT_ID, "Bench Chat", args.messages, parse_mix(args.media_mix),
+                    senders=args.senders, media_bytes=args.media_bytes)
+    return FakeTelegramClient([chat], latency=args.latency_ms / 1000,
+                              download_latency=args.download_latency_ms / 1000,
+                              server_rate=args.server_rate, flood_wait=args.flood_wait)
+
+
+async def run_download_history(client, args) -> int:
+    from telegram_analyzer import TelegramAnalyzer
+    from services.telegram_client import wrap_client
+    analyzer = TelegramAnalyzer(0, "", "bench")
+    analyzer.client = wrap_client(client)
+    if args.skip_asr:
+        async def no_asr(*a, **kw):
+            return None
+        analyzer.whisper_transcribe = no_asr
+    if not await analyzer.download_history(str(CHAT_ID), limit=args.messages, shards=args.shards):
+        raise RuntimeError("download_history завершился с ошибкой")
+    return args.messages
+
+
+async def run_export_chat_for_llm(client, args) -> int:
+    import main
+    if args.skip_asr:
+        async def no_asr(*a, **kw):
+            return None
+        main.transcribe_audio = no_asr
+    result = await main.export_chat_for_llm(client, CHAT_ID, limit=args.messages, shards=args.shards)
+    if result["status"] != "success":
+        raise RuntimeError(result.get("detail"))
+    return result["metadata"]["processed_messages"]
+
+
+async def run_download_chat_media(client, args) -> int:
+    import main
+    result = await main.download_chat_media_for_client(
+        client, CHAT_ID, shards=args.shards,
+        media_types=args.media_types.split(",") if args.media_types else None
+    )
+    return result["processed_messages"]
+
+
+RUNNERS = {
+    "download_history": run_download_history,
+    "export_chat_for_llm": run_export_chat_for_llm,
+    "download_chat_media": run_download_chat_media,
+}
+
+
+def _run_scenario(scenario: str, args, queue):
+    """Выполняется в дочернем процессе"""
+    workdir = tempfile.mkdtemp(prefix=f"bench_{scenario}_")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    logging.disable(logging.ERROR)
+    try:
+        client = make_client(args)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            processed = asyncio.run(RUNNERS[scenario](client, args))
+            elapsed = time.perf_counter() - start
+        queue.put({
+            "scenario": scenario,
+            "messages": processed,
+            "seconds": round(elapsed, 3),
+            "messages_per_s": round(processed / elapsed, 1) if elapsed else None,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "api_calls": dict(client.calls),
+            "flood_waits": client.flood_waits,
+        })
+    except Exception as e:
+        queue.put({"scenario": scenario, "error": repr(e)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(scenario: str, args) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_scenario, args=(scenario, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def baseline_key(scenario: str, args) -> str:
+    key = f"{scenario}|n={args.messages}|lat={args.latency_ms}|mix={args.media_mix}"
+    if args.server_rate:
+        key += f"|rate={args.server_rate}"
+    if args.shards > 1:
+        key += f"|shards={args.shards}"
+    if args.media_types and scenario == "download_chat_media":
+        key += f"|media={args.media_types}"
+    return key
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Список регрессий относительно базовой линии"""
+    problems = []
+    if result["messages_per_s"] < baseline["messages_per_s"] * (1 - tolerance):
+        problems.append(f"messages/s {result['messages_per_s']} < {baseline['messages_per_s']}")
+    if result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        problems.append(f"peak RSS {result['peak_rss_mb']} МБ > {baseline['peak_rss_mb']} МБ")
+    for method, count in result["api_calls"].items():
+        expected = baseline["api_calls"].get(method, 0)
+        if count > expected:
+            problems.append(f"{method}: {count} вызовов > {expected}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк загрузки истории на фейковом Telegram")
+    parser.add_argument("--messages", type=int, default=10000, help="Сообщений в синтетическом чате")
+    parser.add_argument("--media-mix", default="voice=0.05,video=0.01,photo=0.05,document=0.01",
+                        help="Доли типов медиа, остальное — текст")
+    parser.add_argument("--media-bytes", type=int, default=4096, help="Базовый размер медиафайла")
+    parser.add_argument("--senders", type=int, default=2)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Задержка каждого запроса к API")
+    parser.add_argument("--download-latency-ms", type=float, default=0.0, help="Задержка скачивания файла")
+    parser.add_argument("--server-rate", type=float, default=0.0,
+                        help="Лимит запросов в секунду на стороне «сервера» (FloodWait при превышении)")
+    parser.add_argument("--flood-wait", type=int, default=1, help="Длительность FloodWait, с")
+    parser.add_argument("--shards", type=int, default=1, help="Параллельных диапазонов при загрузке истории")
+    parser.add_argument("--media-types", help="Режим «только медиа» для download_chat_media, например voice,photo")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Сценарий (по умолчанию все)")
+    parser.add_argument("--no-skip-asr", dest="skip_asr", action="store_false",
+                        help="Не отключать расшифровку голосовых в экспорте")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Допустимое отклонение от базовой линии")
+    parser.add_argument("--save-baseline", action="store_true", help="Сохранить результат как базовую линию")
+    parser.add_argument("--json", action="store_true", help="Вывести результаты в JSON")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(BASELINES_FILE):
+        with open(BASELINES_FILE, 'r', encoding='utf-8') as f:
+            baselines = json.load(f)
+
+    results = []
+    regressions = 0
+    for scenario in args.scenario or SCENARIOS:
+        result = run(scenario, args)
+        results.append(result)
+        if "error" in result:
+            print(f"❌ {scenario}: {result['error']}")
+            regressions += 1
+            continue
+
+        key = baseline_key(scenario, args)
+        if args.save_baseline:
+            baselines[key] = {k: result[k] for k in ("messages_per_s", "peak_rss_mb", "api_calls")}
+        elif key in baselines:
+            result["regressions"] = compare(result, baselines[key], args.tolerance)
+            regressions += bool(result["regressions"])
+
+        if not args.json:
+            status = "⚠️" if result.get("regressions") else "✅"
+            print(f"{status} {scenario}: {result['messages_per_s']} сообщ/с, "
+                  f"RSS {result['peak_rss_mb']} МБ, вызовы API {result['api_calls']}, "
+                  f"FloodWait {result['flood_waits']}")
+            for problem in result.get("regressions", []):
+                print(f"   • {problem}")
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        with open(BASELINES_FILE, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, ensure_ascii=False)
+        print(f"💾 Базовые значения сохранены: {BASELINES_FILE}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк задержек LLM-пути на заглушке Ollama
+
+Запуск из папки backend:
+    python -m benchmarks.bench_llm --requests 200 --concurrency 16
+    python -m benchmarks.bench_llm --tokens-per-s 30 --failure-rate 0.05
+    python -m benchmarks.bench_llm --backends 3 --backend-concurrency 2
+
+Одновременно гоняет /api/analyze (через ASGI-приложение main.py) и
+обновление профиля TelegramAnalyzer.analyze_new_message, считает
+p50/p95/p99 задержки и пропускную способность по каждому пути.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub(args, port: int):
+    from benchmarks.ollama_stub import serve
+    process = multiprocessing.get_context("spawn").Process(
+        target=serve,
+        args=("127.0.0.1", port, args.tokens_per_s, args.prompt_tokens_per_s,
+              args.response_tokens, args.failure_rate),
+        daemon=True
+    )
+    process.start()
+    for _ in range(100):
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.1):
+            return process
+        time.sleep(0.05)
+    raise RuntimeError("Заглушка Ollama не запустилась")
+
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 1)
+
+
+def summarize(name: str, latencies, errors: int, elapsed: float) -> dict:
+    return {
+        "path": name,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+    }
+
+
+async def drive(name: str, call, requests: int, concurrency: int) -> dict:
+    """Выполняет requests вызовов call(i) не более чем concurrency одновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await call(i)
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return summarize(name, latencies, errors, time.perf_counter() - start)
+
+
+def make_messages(count: int, chat: int):
+    return [
+        {
+            "from": f"User{i % 2}",
+            "time": f"2024-01-{1 + i // 1440 % 28:02d}T{i // 60 % 24:02d}:{i % 60:02d}:00",
+            "message_id": i,
+            "type": "text",
+            "text": f"сообщение {i} в чате {chat}: как дела, что нового?"
+        }
+        for i in range(count)
+    ]
+
+
+async def run_benchmark(args) -> list:
+    import httpx
+    import main
+    from telegram_analyzer import TelegramAnalyzer
+
+    analyzer = TelegramAnalyzer(0, "", "bench")
+    chat_keys = [f"bench_chat_{i}" for i in range(args.chats)]
+    for i, chat_key in enumerate(chat_keys):
+        with open(os.path.join(analyzer.live_dir, f"{chat_key}.json"), 'w', encoding='utf-8') as f:
+            json.dump(make_messages(args.history, i), f, ensure_ascii=False)
+
+    text = "\n".join(f"[12:{i % 60:02d}] User{i % 2}: сообщение {i}" for i in range(args.history))
+
+    async with httpx.AsyncClient(app=main.app, base_url="http://bench", timeout=None) as client:
+        async def analyze_call(i):
+            response = await client.post("/api/analyze", json={"text": text, "model": "stub"})
+            response.raise_for_status()
+
+        async def refresh_call(i):
+            chat_key = chat_keys[i % len(chat_keys)]
+            # Ошибку LLM анализатор только пишет в лог — без нового анализа вызов считается ошибкой
+            if await analyzer.analyze_new_message(chat_key, {"from": "User0", "text": "новое"}) is None:
+                raise RuntimeError("Профиль не обновлён")
+
+        return list(await asyncio.gather(
+            drive("/api/analyze", analyze_call, args.requests, args.concurrency),
+            drive("profile_refresh", refresh_call, args.requests, args.concurrency),
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк LLM-пути на заглушке Ollama")
+    parser.add_argument("--requests", type=int, default=100, help="Запросов на каждый путь")
+    parser.add_argument("--concurrency", type=int, default=8, help="Одновременных запросов на путь")
+    parser.add_argument("--chats", type=int, default=10, help="Чатов для обновления профиля")
+    parser.add_argument("--history", type=int, default=200, help="Сообщений в каждом чате")
+    parser.add_argument("--tokens-per-s", type=float, default=200.0)
+    parser.add_argument("--prompt-tokens-per-s", type=float, default=5000.0)
+    parser.add_argument("--response-tokens", type=int, default=32)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--backends", type=int, default=1, help="Заглушек Ollama в пуле LLM")
+    parser.add_argument("--backend-concurrency", type=int, default=4,
+                        help="Одновременных запросов на заглушку (лимит пула)")
+    parser.add_argument("--json", action="store_true", help="Вывести результаты в JSON")
+    args = parser.parse_args()
+
+    ports = [free_port() for _ in range(args.backends)]
+    stubs = [start_stub(args, port) for port in ports]
+    os.environ["OLLAMA_BACKENDS"] = ",".join(f"http://127.0.0.1:{port}|{args.backend_concurrency}" for port in ports)
+
+    workdir = tempfile.mkdtemp(prefix="bench_llm_")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    logging.disable(logging.ERROR)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(run_benchmark(args))
+    finally:
+        for stub in stubs:
+            stub.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    for result in results:
+        print(f"📊 {result['path']}: p50 {result['p50_ms']} мс, p95 {result['p95_ms']} мс, "
+              f"p99 {result['p99_ms']} мс, {result['throughput_rps']} запр/с, ошибок {result['errors']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк задержки цикла событий при чтении больших live-файлов
+
+Запуск из папки backend:
+    python -m benchmarks.bench_loop_lag --messages 50000 --requests 40
+    python -m benchmarks.bench_loop_lag --threads 0 4
+
+Создаёт live-файл на несколько МБ и одновременно гоняет тяжёлые запросы
+(/telegram/messages, /telegram/profile приложения main_new.py) и лёгкие
+(/). Для каждого значения FILE_IO_THREADS (0 — файлы читаются в
+цикле событий, как раньше) выводит задержку цикла по монитору и задержку
+лёгких запросов, которые ждут, пока цикл освободится.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextlib
+
+from benchmarks.bench_llm import BACKEND_DIR, drive, make_messages, summarize
+
+# Период лёгких запросов, с
+LIGHT_INTERVAL = 0.01
+
+
+async def run_benchmark(args, threads: int) -> dict:
+    import httpx
+    import main_new
+    from services import file_io, loop_lag
+
+    file_io.FILE_IO_THREADS = threads
+    monitor = loop_lag.LoopLagMonitor(interval=0.005, window=100000)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    monitor.reset()
+
+    async with httpx.AsyncClient(app=main_new.app, base_url="http://bench", timeout=None) as client:
+        async def heavy_call(i):
+            path = "/telegram/messages/bench" if i % 2 == 0 else "/telegram/profile/bench"
+            response = await client.get(path)
+            response.raise_for_status()
+
+        async def light_requests(stop: asyncio.Event) -> dict:
+            """Лёгкие запросы по расписанию; задержка считается от запланированного момента"""
+            latencies, started = [], time.perf_counter()
+            while not stop.is_set():
+                planned = started + len(latencies) * LIGHT_INTERVAL
+                await asyncio.sleep(max(0.0, planned - time.perf_counter()))
+                response = await client.get("/")
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - planned)
+            return summarize("light", latencies, 0, time.perf_counter() - started)
+
+        stop = asyncio.Event()
+        light_task = asyncio.ensure_future(light_requests(stop))
+        heavy = await drive("heavy", heavy_call, args.requests, args.concurrency)
+        stop.set()
+        light = await light_task
+    monitor.stop()
+    return {"file_io_threads": threads, "loop_lag": monitor.stats(), "heavy": heavy, "light": light}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка цикла событий при чтении больших файлов")
+    parser.add_argument("--messages", type=int, default=50000, help="Сообщений в live-файле")
+    parser.add_argument("--requests", type=int, default=40, help="Тяжёлых запросов")
+    parser.add_argument("--concurrency", type=int, default=4, help="Одновременных тяжёлых запросов")
+    parser.add_argument("--threads", type=int, nargs="+", default=[0, 4],
+                        help="Значения FILE_IO_THREADS для сравнения")
+    parser.add_argument("--json", action="store_true", help="Вывести результаты в JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_loop_lag_")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    logging.disable(logging.ERROR)
+    os.makedirs("data/live", exist_ok=True)
+    os.makedirs("data/profiles", exist_ok=True)
+    with open("data/live/chat_bench.json", 'w', encoding='utf-8') as f:
+        json.dump(make_messages(args.messages, 0), f, ensure_ascii=False, indent=2)
+    with open("data/profiles/chat_bench_profile.json", 'w', encoding='utf-8') as f:
+        json.dump({"chat_key": "chat_bench", "analysis": "профиль " * 2000}, f, ensure_ascii=False, indent=2)
+    size_mb = os.path.getsize("data/live/chat_bench.json") / (1024 * 1024)
+
+    results = []
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for threads in args.threads:
+                results.append(asyncio.run(run_benchmark(args, threads)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"live_file_mb": round(size_mb, 1), "results": results}, ensure_ascii=False, indent=2))
+        return
+    print(f"📄 live-файл: {size_mb:.1f} МБ")
+    for result in results:
+        lag, light, heavy = result["loop_lag"], result["light"], result["heavy"]
+        print(f"📊 FILE_IO_THREADS={result['file_io_threads']}: задержка цикла p99 {lag.get('p99_ms')} мс, "
+              f"макс {lag.get('max_ms')} мс; лёгкие запросы p99 {light['p99_ms']} мс; "
+              f"тяжёлые p50 {heavy['p50_ms']} мс, {heavy['throughput_rps']} запр/с")
+
+
+if __name__ == "__main__":
+    main()
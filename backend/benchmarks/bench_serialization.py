@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сериализации больших историй
+
+Запуск из папки backend:
+    python -m benchmarks.bench_serialization --messages 100000
+
+Сравнивает прежнюю запись (json.dump с отступами) и чтение (json.load)
+со services/serialization.py: JSON через orjson и msgpack. Выводит время
+записи и чтения списка сообщений, размер файла и время дописывания одного
+сообщения в live-файл (JSON переписывается целиком, msgpack — дописывается).
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from benchmarks.bench_llm import make_messages
+
+
+def measure_append(path: str, messages, fmt: str, appends: int = 10) -> float:
+    from services import storage
+
+    storage.write_messages(path, messages, fmt=fmt)
+    start = time.perf_counter()
+    for i in range(appends):
+        storage.append_message(path, {"message_id": -i, "text": "новое"}, fmt=fmt)
+    return round((time.perf_counter() - start) / appends * 1000, 2)
+
+
+def measure(write, read, path: str, repeat: int) -> dict:
+    write_s = read_s = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        write(path)
+        write_s = min(write_s, time.perf_counter() - start)
+        start = time.perf_counter()
+        read(path)
+        read_s = min(read_s, time.perf_counter() - start)
+    return {
+        "write_ms": round(write_s * 1000, 1),
+        "read_ms": round(read_s * 1000, 1),
+        "size_mb": round(os.path.getsize(path) / (1024 * 1024), 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость и размер форматов хранения сообщений")
+    parser.add_argument("--messages", type=int, default=100000, help="Сообщений в истории")
+    parser.add_argument("--repeat", type=int, default=3, help="Повторов (берётся лучший)")
+    parser.add_argument("--json", action="store_true", help="Вывести результаты в JSON")
+    args = parser.parse_args()
+
+    from services import serialization
+
+    messages = make_messages(args.messages, 0)
+
+    def stdlib_write(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(messages, f, ensure_ascii=False, indent=2)
+
+    def stdlib_read(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def codec_write(fmt):
+        def write(path):
+            with open(path, 'wb') as f:
+                serialization.write_messages(f, messages, fmt)
+        return write
+
+    def codec_read(path):
+        with open(path, 'rb') as f:
+            return list(serialization.iter_messages(f))
+
+    workdir = tempfile.mkdtemp(prefix="bench_serialization_")
+    results = {}
+    try:
+        results["json (stdlib, indent=2)"] = measure(stdlib_write, stdlib_read, os.path.join(workdir, "a"),
+                                                     args.repeat)
+        results[f"json ({serialization.codecs()['json']})"] = measure(
+            codec_write(serialization.JSON), codec_read, os.path.join(workdir, "b"), args.repeat)
+        if serialization.store_format(serialization.MSGPACK) == serialization.MSGPACK:
+            results["msgpack"] = measure(codec_write(serialization.MSGPACK), codec_read,
+                                         os.path.join(workdir, "c"), args.repeat)
+        live_dir = os.path.join(workdir, "live")
+        os.makedirs(live_dir)
+        for name, fmt in ((f"json ({serialization.codecs()['json']})", serialization.JSON),
+                          ("msgpack", serialization.MSGPACK)):
+            if name in results:
+                results[name]["append_ms"] = measure_append(os.path.join(live_dir, f"{fmt}.json"), messages, fmt)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print(f"📄 {args.messages} сообщений")
+    for name, result in results.items():
+        append = f", дописать сообщение {result['append_ms']} мс" if "append_ms" in result else ""
+        print(f"📊 {name}: запись {result['write_ms']} мс, чтение {result['read_ms']} мс, "
+              f"{result['size_mb']} МБ{append}")
+
+
+if __name__ == "__main__":
+    main()
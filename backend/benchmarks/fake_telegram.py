@@ -0,0 +1,367 @@
+"""
+Фейковый клиент Telethon над синтетическими чатами для бенчмарков
+"""
+
+import time
+import random
+import asyncio
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+# Доля сообщений каждого типа (остальное — текст)
+DEFAULT_MEDIA_MIX = {"voice": 0.05, "video": 0.01, "photo": 0.05, "document": 0.01}
+
+# Сколько сообщений Telegram отдаёт за один запрос истории
+PAGE_SIZE = 100
+
+WORDS = ("привет как дела что делаешь сегодня завтра давай встретимся вечером "
+         "отлично спасибо посмотри это фото хорошо ладно понял договорились").split()
+
+
+class FakePeerUser:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"User{user_id}"
+        self.username = f"user{user_id}"
+
+
+class FakeAttribute:
+    """Как DocumentAttributeFilename"""
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+
+
+class FakeAudioAttribute:
+    """Как DocumentAttributeAudio: длительность есть только в атрибуте, не в документе"""
+
+    def __init__(self, duration: int, voice: bool = True):
+        self.duration = duration
+        self.voice = voice
+
+
+class FakeVideoAttribute:
+    """Как DocumentAttributeVideo"""
+
+    def __init__(self, duration: int, w: int = 1280, h: int = 720):
+        self.duration = duration
+        self.w = w
+        self.h = h
+
+
+class FakeDocument:
+    def __init__(self, doc_id: int, size: int, mime_type: str, attributes=None):
+        self.id = doc_id
+        self.size = size
+        self.mime_type = mime_type
+        self.attributes = list(attributes or [])
+
+
+class FakeFile:
+    """Как message.file в Telethon: свойства медиа, собранные из атрибутов документа"""
+
+    def __init__(self, media):
+        self.media = media
+        self.size = getattr(media, "size", None)
+        self.mime_type = getattr(media, "mime_type", None)
+
+    def _attribute(self, name: str):
+        for attribute in getattr(self.media, "attributes", None) or []:
+            value = getattr(attribute, name, None)
+            if value is not None:
+                return value
+        return None
+
+    @property
+    def duration(self):
+        return self._attribute("duration")
+
+    @property
+    def name(self):
+        return self._attribute("file_name")
+
+    @property
+    def width(self):
+        return getattr(self.media, "width", None) or self._attribute("w")
+
+    @property
+    def height(self):
+        return getattr(self.media, "height", None) or self._attribute("h")
+
+
+class FakePhoto:
+    def __init__(self, photo_id: int, size: int):
+        self.id = photo_id
+        self.size = size
+        self.width = 1280
+        self.height = 960
+
+
+class FakeMessage:
+    """Минимальный набор полей telethon Message, которые читает бэкенд"""
+
+    def __init__(self, chat_id: int, msg_id: int, date: datetime, sender_id: int, text: str = "",
+                 voice=None, video=None, photo=None, document=None, reply_to_msg_id: Optional[int] = None):
+        self.chat_id = chat_id
+        self.id = msg_id
+        self.date = date
+        self.sender_id = sender_id
+        self.from_id = FakePeerUser(sender_id) if sender_id else None
+        self.text = text
+        self.message = text
+        self.voice = voice
+        self.video = video
+        self.photo = photo
+        self.document = document
+        self.media = voice or video or photo or document
+        self.file = FakeFile(self.media) if self.media else None
+        self.reply_to_msg_id = reply_to_msg_id
+
+
+class FakeChat:
+    """Синтетический чат: сообщения генерируются детерминированно по id"""
+
+    def __init__(self, chat_id: int, title: str, messages: int, media_mix: Optional[Dict[str, float]] = None,
+                 senders: int = 2, media_bytes: int = 4096, seed: int = 0):
+        self.id = chat_id
+        self.title = title
+        self.username = f"bench{chat_id}"
+        self.count = messages
+        self.media_mix = media_mix or DEFAULT_MEDIA_MIX
+        self.senders = [1000 + i for i in range(senders)]
+        self.media_bytes = media_bytes
+        self.seed = seed
+        self.start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def kind_of(self, msg_id: int) -> str:
+        roll = random.Random(self.seed * 1_000_003 + msg_id).random()
+        for kind, share in self.media_mix.items():
+            if roll < share:
+                return kind
+            roll -= share
+        return "text"
+
+    def message(self, msg_id: int) -> FakeMessage:
+        rng = random.Random(self.seed * 1_000_003 + msg_id)
+        rng.random()  # тот же бросок, что в kind_of
+        kind = self.kind_of(msg_id)
+        date = self.start + timedelta(seconds=msg_id * 37)
+        sender = rng.choice(self.senders)
+        reply_to = msg_id - rng.randint(1, 5) if msg_id > 5 and rng.random() < 0.1 else None
+
+        if kind == "text":
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 20)))
+            return FakeMessage(self.id, msg_id, date, sender, text=text, reply_to_msg_id=reply_to)
+        if kind == "voice":
+            doc = FakeDocument(msg_id, self.media_bytes, "audio/ogg",
+                               attributes=[FakeAudioAttribute(rng.randint(1, 120))])
+            return FakeMessage(self.id, msg_id, date, sender, voice=doc, document=doc, reply_to_msg_id=reply_to)
+        if kind == "video":
+            doc = FakeDocument(msg_id, self.media_bytes * 16, "video/mp4",
+                               attributes=[FakeVideoAttribute(rng.randint(5, 600))])
+            return FakeMessage(self.id, msg_id, date, sender, video=doc, document=doc, reply_to_msg_id=reply_to)
+        if kind == "photo":
+            photo = FakePhoto(msg_id, self.media_bytes * 4)
+            return FakeMessage(self.id, msg_id, date, sender, photo=photo, reply_to_msg_id=reply_to)
+        doc = FakeDocument(msg_id, self.media_bytes * 8, "application/pdf",
+                           attributes=[FakeAttribute(f"file_{msg_id}.pdf")])
+        return FakeMessage(self.id, msg_id, date, sender, document=doc, reply_to_msg_id=reply_to)
+
+
+class FloodWaitError(Exception):
+    """Как telethon.errors.FloodWaitError: ограничитель узнаёт её по имени и seconds"""
+
+    def __init__(self, seconds: int):
+        super().__init__(f"A wait of {seconds} seconds is required")
+        self.seconds = seconds
+
+
+class TotalList(list):
+    """Список с полем total, как у результатов get_messages в Telethon"""
+    total = 0
+
+
+class FakeDialog:
+    def __init__(self, chat: FakeChat):
+        self.id = chat.id
+        self.name = chat.title
+        self.entity = chat
+        self.is_group = True
+        self.is_channel = False
+        self.is_user = False
+
+
+_FILTER_KINDS = {
+    "InputMessagesFilterVoice": {"voice"},
+    "InputMessagesFilterRoundVoice": {"voice"},
+    "InputMessagesFilterRoundVideo": set(),
+    "InputMessagesFilterVideo": {"video"},
+    "InputMessagesFilterPhotos": {"photo"},
+    "InputMessagesFilterPhotoVideo": {"photo", "video"},
+    "InputMessagesFilterDocument": {"document", "voice", "video"},
+}
+
+
+class FakeTelegramClient:
+    """Имитация TelegramClient в памяти процесса с задержкой на каждый запрос"""
+
+    def __init__(self, chats, latency: float = 0.0, download_latency: float = 0.0,
+                 server_rate: float = 0.0, flood_wait: int = 1):
+        self.chats = {chat.id: chat for chat in chats}
+        self.latency = latency
+        self.download_latency = download_latency
+        # Больше server_rate запросов за секунду — FloodWaitError на flood_wait секунд
+        self.server_rate = server_rate
+        self.flood_wait = flood_wait
+        self.calls = Counter()
+        self.flood_waits = 0
+        self._recent = deque()
+        self._totals = {}
+        self._connected = False
+
+    async def _request(self, method: str, latency: Optional[float] = None):
+        if self.server_rate:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 1.0:
+                self._recent.popleft()
+            if len(self._recent) >= self.server_rate:
+                self.flood_waits += 1
+                raise FloodWaitError(self.flood_wait)
+            self._recent.append(now)
+        self.calls[method] += 1
+        delay = self.latency if latency is None else latency
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _chat(self, entity) -> FakeChat:
+        if isinstance(entity, FakeChat):
+            return entity
+        if isinstance(entity, str) and entity.startswith("@"):
+            for chat in self.chats.values():
+                if chat.username == entity[1:]:
+                    return chat
+            raise ValueError(f"No user has \"{entity[1:]}\" as username")
+        return self.chats[int(entity)]
+
+    # --- соединение ---
+    async def connect(self):
+        self._connected = True
+
+    async def disconnect(self):
+        self._connected = False
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def is_user_authorized(self) -> bool:
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        pass
+
+    def remove_event_handler(self, callback, event=None):
+        pass
+
+    # --- API ---
+    async def get_entity(self, entity):
+        await self._request("get_entity")
+        if isinstance(entity, FakePeerUser):
+            return FakeUser(entity.user_id)
+        return self._chat(entity)
+
+    async def iter_dialogs(self, limit: Optional[int] = None):
+        dialogs = list(self.chats.values())[:limit]
+        for start in range(0, len(dialogs), PAGE_SIZE):
+            await self._request("iter_dialogs")
+            for chat in dialogs[start:start + PAGE_SIZE]:
+                yield FakeDialog(chat)
+
+    async def get_dialogs(self, limit: Optional[int] = None):
+        return [dialog async for dialog in self.iter_dialogs(limit)]
+
+    def _matches(self, chat: FakeChat, msg_id: int, message_filter) -> bool:
+        if message_filter is None:
+            return True
+        name = message_filter.__name__ if isinstance(message_filter, type) else type(message_filter).__name__
+        return chat.kind_of(msg_id) in _FILTER_KINDS.get(name, set())
+
+    def _ids(self, chat: FakeChat, offset_id: int, min_id: int, max_id: int, reverse: bool) -> range:
+        """id сообщений в порядке выдачи; при reverse offset_id — нижняя граница"""
+        upper = chat.count
+        if max_id:
+            upper = min(upper, max_id - 1)
+        if reverse:
+            return range(max(min_id, offset_id) + 1, upper + 1)
+        if offset_id:
+            upper = min(upper, offset_id - 1)
+        return range(upper, min_id, -1)
+
+    def _total(self, chat: FakeChat, message_filter) -> int:
+        if message_filter is None:
+            return chat.count
+        key = (chat.id, message_filter.__name__ if isinstance(message_filter, type) else type(message_filter).__name__)
+        if key not in self._totals:
+            self._totals[key] = sum(1 for msg_id in range(1, chat.count + 1)
+                                    if self._matches(chat, msg_id, message_filter))
+        return self._totals[key]
+
+    async def get_messages(self, entity, limit: Optional[int] = 1, offset_id: int = 0, min_id: int = 0,
+                           max_id: int = 0, reverse: bool = False, filter=None, ids=None, **kwargs):
+        """Одна страница истории (limit ≤ 100) за один запрос; limit=0 — только total"""
+        chat = self._chat(entity)
+        await self._request("search" if filter is not None else "get_history")
+        if ids is not None:
+            if isinstance(ids, int):
+                return chat.message(ids) if 0 < ids <= chat.count else None
+            return [chat.message(i) if 0 < i <= chat.count else None for i in ids]
+
+        result = TotalList()
+        result.total = self._total(chat, filter)
+        for msg_id in self._ids(chat, offset_id, min_id, max_id, reverse):
+            if limit is not None and len(result) >= limit:
+                break
+            if self._matches(chat, msg_id, filter):
+                result.append(chat.message(msg_id))
+        return result
+
+    async def iter_messages(self, entity, limit: Optional[int] = None, offset_id: int = 0, min_id: int = 0,
+                            max_id: int = 0, reverse: bool = False, filter=None, **kwargs):
+        chat = self._chat(entity)
+        ids = self._ids(chat, offset_id, min_id, max_id, reverse)
+
+        returned = 0
+        page_left = 0
+        method = "search" if filter is not None else "get_history"
+        for msg_id in ids:
+            if limit is not None and returned >= limit:
+                return
+            if not self._matches(chat, msg_id, filter):
+                continue
+            if page_left == 0:
+                await self._request(method)
+                page_left = PAGE_SIZE
+            page_left -= 1
+            returned += 1
+            yield chat.message(msg_id)
+
+    async def iter_download(self, media, offset: int = 0, request_size: int = 512 * 1024,
+                            chunk_size: Optional[int] = None, file_size: Optional[int] = None, **kwargs):
+        size = getattr(media, "size", 1024)
+        while offset < size:
+            await self._request("download_chunk", self.download_latency)
+            chunk = min(request_size, size - offset)
+            offset += chunk
+            yield b"\0" * chunk
+
+    async def download_media(self, media, file=None, **kwargs):
+        await self._request("download_media", self.download_latency)
+        size = getattr(media, "size", 1024)
+        with open(file, "wb") as f:
+            f.write(b"\0" * size)
+        return file
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Заглушка Ollama: имитирует /api/generate с заданной скоростью и долей ошибок
+
+/api/embed и /api/embeddings отдают детерминированные эмбеддинги
+«мешка слов» (хэши слов), так что тексты с общими словами близки.
+
+/api/generate, как KV-кэш Ollama, помнит последние вычисленные
+последовательности токенов (промпт и ответ): новый промпт платит только за
+токены после самого длинного совпадающего с ними начала.
+
+Запуск из папки backend:
+    python -m benchmarks.ollama_stub --port 11435 --tokens-per-s 40 --failure-rate 0.02
+
+и затем OLLAMA_URL=http://127.0.0.1:11435 для бэкенда.
+"""
+
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubConfig:
+    tokens_per_s = 50.0           # скорость генерации
+    prompt_tokens_per_s = 500.0   # скорость обработки промпта
+    response_tokens = 64          # длина ответа
+    failure_rate = 0.0            # доля ответов 500
+    embedding_dim = 64            # размерность эмбеддингов
+    cached_sequences = 8          # сколько последовательностей помнит «KV-кэш»
+
+
+_kv_cache = deque()
+_kv_lock = threading.Lock()
+
+
+def _token_ids(text: str) -> list:
+    return [int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:2], "little") for word in text.split()]
+
+
+def _kv_reused(tokens: list) -> int:
+    """Сколько первых токенов уже вычислено (самое длинное общее начало в кэше)"""
+    best = 0
+    with _kv_lock:
+        for cached in _kv_cache:
+            common = 0
+            for a, b in zip(cached, tokens):
+                if a != b:
+                    break
+                common += 1
+            best = max(best, common)
+    return best
+
+
+def _kv_store(tokens: list):
+    with _kv_lock:
+        _kv_cache.append(tokens)
+        while len(_kv_cache) > StubConfig.cached_sequences:
+            _kv_cache.popleft()
+
+
+def stub_embedding(text: str, dim: int = None) -> list:
+    """Нормированный вектор: каждое слово добавляет ±1 в позицию по своему хэшу"""
+    dim = dim or StubConfig.embedding_dim
+    vector = [0.0] * dim
+    for word in text.lower().split():
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        vector[digest[0] % dim] += 1.0 if digest[1] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class OllamaStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json(200, {"models": [{"name": "stub"}]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "invalid json"})
+            return
+
+        if self.path == "/api/embed":
+            texts = request.get("input", "")
+            texts = [texts] if isinstance(texts, str) else texts
+            self._send_json(200, {"model": request.get("model", "stub"),
+                                  "embeddings": [stub_embedding(text) for text in texts]})
+            return
+        if self.path == "/api/embeddings":
+            self._send_json(200, {"embedding": stub_embedding(request.get("prompt", ""))})
+            return
+
+        if self.path != "/api/generate":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        if random.random() < StubConfig.failure_rate:
+            self._send_json(500, {"error": "stub failure"})
+            return
+
+        prompt = _token_ids(request.get("prompt", "")) or [0]
+        # Совпадающее с кэшем начало промпта не вычисляется заново
+        evaluated = max(1, len(prompt) - _kv_reused(prompt))
+        started = time.perf_counter()
+        time.sleep(evaluated / StubConfig.prompt_tokens_per_s)
+        prompt_eval = time.perf_counter() - started
+
+        model = request.get("model", "stub")
+        num_predict = (request.get("options") or {}).get("num_predict")
+        response_tokens = StubConfig.response_tokens if num_predict is None else max(0, min(num_predict, StubConfig.response_tokens))
+        tokens = [f"токен{i} " for i in range(response_tokens)]
+        delay = 1.0 / StubConfig.tokens_per_s
+        _kv_store(prompt + _token_ids("".join(tokens)))
+        stats = {
+            "prompt_eval_count": evaluated,
+            "prompt_eval_duration": int(prompt_eval * 1e9),
+            "eval_count": len(tokens),
+        }
+
+        # Ollama по умолчанию стримит NDJSON
+        if request.get("stream", True):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for token in tokens:
+                time.sleep(delay)
+                self._write_chunk({"model": model, "response": token, "done": False})
+            self._write_chunk({"model": model, "response": "", "done": True,
+                               "total_duration": int((time.perf_counter() - started) * 1e9), **stats})
+            self.wfile.write(b"0\r\n\r\n")
+            return
+
+        time.sleep(delay * len(tokens))
+        self._send_json(200, {
+            "model": model,
+            "response": "".join(tokens).strip(),
+            "done": True,
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+            **stats
+        })
+
+    def _write_chunk(self, payload: dict):
+        data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def serve(host: str = "127.0.0.1", port: int = 11435, tokens_per_s: float = 50.0,
+          prompt_tokens_per_s: float = 500.0, response_tokens: int = 64, failure_rate: float = 0.0):
+    """Запускает заглушку (блокирующий вызов)"""
+    StubConfig.tokens_per_s = tokens_per_s
+    StubConfig.prompt_tokens_per_s = prompt_tokens_per_s
+    StubConfig.response_tokens = response_tokens
+    StubConfig.failure_rate = failure_rate
+    server = ThreadingHTTPServer((host, port), OllamaStubHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Ollama generate API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--tokens-per-s", type=float, default=50.0)
+    parser.add_argument("--prompt-tokens-per-s", type=float, default=500.0)
+    parser.add_argument("--response-tokens", type=int, default=64)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    print(f"🧪 Заглушка Ollama на http://{args.host}:{args.port}")
+    serve(args.host, args.port, args.tokens_per_s, args.prompt_tokens_per_s,
+          args.response_tokens, args.failure_rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,39 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional
-import json
+from typing import List, Optional
 import os
 from pathlib import Path
 from telethon import TelegramClient
 from telethon.sessions import StringSession
 from telethon.errors import SessionPasswordNeededError
-from fastapi import Request
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
 import asyncio
 import shutil
 import hashlib
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
 
 # Импортируем функцию анализа
-from services.llm import analyze_text
+from services.llm import analyze_text, analyze_text_stream, ANALYTICS_IN_PROMPT, GENERATIONS
+from services import asr
+from services.transcription_cache import TranscriptionCache
+from services.telegram_client import media_duration, wrap_client
+from services.media_download import download_resumable
+from services.media_scheduler import MediaScheduler, DOWNLOADED, EXISTS, load_deferred, save_deferred
+from services.history_fetch import MEDIA_FILTERS, iter_history, iter_media_messages, count_messages, count_media_messages
+from services import metrics
+from services import tracing
+from services import rate_limiter
+from services import storage
+from services.columnar import ColumnarWriter, read_columns
+from services import analytics
+from services import llm_pool
+from services import batch
+from services import file_io
+from services import serialization
+from services import loop_lag
 
 app = FastAPI(title="AI Bot Manager API", version="1.0.0")
 
@@ -36,6 +54,17 @@ class ConfigModel(BaseModel):
 class AnalyzeRequest(BaseModel):
     text: str
     model: str
+    stream: bool = False
+
+class BatchAnalyzeRequest(BaseModel):
+    """Чаты для пакетного анализа: chat_ids, иначе все диалоги аккаунта, иначе все экспорты"""
+    model: str
+    chat_ids: Optional[List[int]] = None
+    api_id: Optional[int] = None
+    api_hash: Optional[str] = None
+    phone: Optional[str] = None
+    priority: int = 0
+    parallelism: Optional[int] = None
 
 # Файл для хранения конфигурации
 CONFIG_FILE = Path("config.json")
@@ -44,16 +73,14 @@ def load_config():
     """Загрузить конфигурацию из файла"""
     if CONFIG_FILE.exists():
         try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return serialization.load(CONFIG_FILE)
         except Exception:
             return {"ai_model": "gpt-3.5-turbo", "telegram_api_key": ""}
     return {"ai_model": "gpt-3.5-turbo", "telegram_api_key": ""}
 
 def save_config(config: dict):
     """Сохранить конфигурацию в файл"""
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    serialization.dump(CONFIG_FILE, config, pretty=True)
 
 @app.get("/")
 async def root():
@@ -64,7 +91,7 @@ async def root():
 async def get_config():
     """Получить текущую конфигурацию"""
     try:
-        config = load_config()
+        config = await file_io.run(load_config)
         return config
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка загрузки конфигурации: {str(e)}")
@@ -83,7 +110,7 @@ async def save_config_endpoint(config: ConfigModel):
             raise HTTPException(status_code=400, detail="Telegram API ключ не может быть пустым")
         
         config_dict = config.dict()
-        save_config(config_dict)
+        await file_io.run(save_config, config_dict)
         
         return {"message": "Конфигурация успешно сохранена", "config": config_dict}
     except HTTPException:
@@ -106,17 +133,140 @@ async def analyze_conversation(request: AnalyzeRequest):
 
 @app.post("/api/analyze")
 async def analyze_api(request: AnalyzeRequest):
-    """Анализ текста с помощью Ollama"""
+    """Анализ текста с помощью Ollama (stream=true — текст ответа по мере генерации)"""
+    if request.stream:
+        async def tokens():
+            try:
+                async for token in analyze_text_stream(request.text, request.model):
+                    yield token
+            except Exception as e:
+                print(f"❌ Ошибка потокового анализа: {e}")
+                yield f"\n\n❌ Ошибка анализа: {e}"
+        return StreamingResponse(tokens(), media_type="text/plain; charset=utf-8")
     try:
         result = await analyze_text(request.text, request.model)
         return {"result": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка анализа: {str(e)}")
 
+def find_llm_export(chat_id: int) -> Optional[str]:
+    """Папка экспорта чата в LLM_EXPORT_DIR или None"""
+    if os.path.exists(LLM_EXPORT_DIR):
+        for export_dir in os.listdir(LLM_EXPORT_DIR):
+            export_path = os.path.join(LLM_EXPORT_DIR, export_dir)
+            if export_dir.startswith(f"{chat_id}_") and os.path.isdir(export_path):
+                return export_path
+    return None
+
+async def account_dialog_ids(api_id: int, api_hash: str, phone: str) -> List[int]:
+    """id всех диалогов аккаунта"""
+    client = wrap_client(TelegramClient(get_session_path(api_id, phone), api_id, api_hash))
+    try:
+        await client.connect()
+        if not await client.is_user_authorized():
+            raise HTTPException(status_code=401, detail="Not authorized")
+        return [dialog.id async for dialog in client.iter_dialogs()]
+    finally:
+        await client.disconnect()
+
+@app.post("/api/analyze/batch")
+async def analyze_batch(request: BatchAnalyzeRequest):
+    """Пакетный анализ сохранённых экспортов многих чатов (возвращает batch_id)
+    
+    Промпт каждого чата строится из его chat_for_llm.txt, результат
+    сохраняется в llm_analysis.txt рядом. Чаты без экспорта пропускаются.
+    """
+    if request.chat_ids is not None:
+        chat_ids = request.chat_ids
+    elif request.phone:
+        if not request.api_id or not request.api_hash:
+            raise HTTPException(status_code=400, detail="api_id and api_hash are required with phone")
+        chat_ids = await account_dialog_ids(request.api_id, request.api_hash, request.phone)
+    else:
+        chat_ids = [int(name.split("_", 1)[0]) for name in sorted(os.listdir(LLM_EXPORT_DIR))
+                    if name.split("_", 1)[0].lstrip("-").isdigit()]
+    
+    items, skipped = [], {}
+    for chat_id in dict.fromkeys(chat_ids):
+        export_path = find_llm_export(chat_id)
+        if export_path and storage.exists(os.path.join(export_path, "chat_for_llm.txt")):
+            items.append(str(chat_id))
+        else:
+            skipped[str(chat_id)] = "no export"
+    
+    async def analyze_chat(chat_id: str) -> dict:
+        export_path = find_llm_export(int(chat_id))
+        text = await file_io.run(storage.read_text, os.path.join(export_path, "chat_for_llm.txt"))
+        # Свой владелец в пуле LLM: пакет не вытесняет интерактивные запросы
+        result = await analyze_text(text, request.model, tenant=f"batch_{job.batch_id}")
+        analysis_file = await file_io.run(storage.write_text, os.path.join(export_path, "llm_analysis.txt"), result)
+        return {"file": analysis_file, "analysis": result}
+    
+    job = batch.RUNNER.submit(items, analyze_chat, request.priority, request.parallelism, "llm_export", skipped)
+    return job.stats(include_results=False)
+
+@app.get("/api/analyze/batch/{batch_id}")
+async def analyze_batch_status(batch_id: str, results: bool = True):
+    """Прогресс пакета и результаты по чатам"""
+    job = batch.RUNNER.get(batch_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return job.stats(include_results=results)
+
+@app.delete("/api/analyze/batch/{batch_id}")
+async def analyze_batch_cancel(batch_id: str):
+    """Отменяет ещё не начатые чаты пакета"""
+    if not batch.RUNNER.cancel(batch_id):
+        raise HTTPException(status_code=404, detail="Batch not found or already finished")
+    return batch.RUNNER.get(batch_id).stats(include_results=False)
+
+@app.get("/api/analyze/batches")
+async def analyze_batches():
+    """Все пакеты и загрузка планировщика"""
+    return batch.RUNNER.stats()
+
+@app.on_event("startup")
+async def startup_event():
+    """Прогрев модели Whisper при запуске (если включён)"""
+    print(f"📦 Импорты при старте: {asr.startup_report()['imports']}")
+    loop_lag.MONITOR.start()
+    if asr.ASR_PRELOAD:
+        asr.preload_in_background(asr.BACKEND_FASTER)
+
+@app.get("/system/startup")
+async def startup_report():
+    """Отчёт о времени импортов и загрузки моделей"""
+    return asr.startup_report()
+
+@app.get("/system/loop-lag")
+async def loop_lag_report():
+    """Задержка цикла событий: последние замеры, p50/p99 и максимум"""
+    return {**loop_lag.MONITOR.stats(), "file_io_threads": file_io.FILE_IO_THREADS}
+
+@app.get("/asr/stats")
+async def asr_stats():
+    """Статистика распознавания по маршрутам (RTF) и кэшу расшифровок"""
+    return {"routes": asr.route_stats(), "cache": TRANSCRIPTION_CACHE.stats()}
+
+@app.get("/telegram/rate-limits")
+async def telegram_rate_limits():
+    """Текущие лимиты запросов к Telegram по аккаунтам и статистика FloodWait"""
+    return {"accounts": rate_limiter.stats()}
+
+@app.get("/llm/backends")
+async def llm_backends():
+    """Состояние пула LLM-бэкендов: загрузка, здоровье, очередь по владельцам"""
+    return {**llm_pool.POOL.stats(), "single_flight": GENERATIONS.stats()}
+
 @app.get("/health")
 async def health_check():
     """Проверка здоровья API"""
-    return {"status": "healthy", "timestamp": "2024-01-01T00:00:00Z"}
+    return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Метрики в формате Prometheus"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 # Пути для сохранения файлов
 TELETHON_SESSION_DIR = "telegram_sessions"
@@ -128,6 +278,9 @@ os.makedirs(TELETHON_SESSION_DIR, exist_ok=True)
 os.makedirs(MEDIA_DOWNLOAD_DIR, exist_ok=True)
 os.makedirs(LLM_EXPORT_DIR, exist_ok=True)
 
+# Кэш расшифровок рядом с медиа экспортов (ключ — хэш аудио, модель, язык)
+TRANSCRIPTION_CACHE = TranscriptionCache(os.path.join(LLM_EXPORT_DIR, "_transcripts"))
+
 # Удаляем TELETHON_CLIENTS, TWOFA_PENDING, PHONE_CODE_HASHES
 PHONE_CODE_HASHES = {}
 
@@ -135,6 +288,11 @@ PHONE_CODE_HASHES = {}
 DOWNLOAD_STATUS = {}
 EXPORT_STATUS = {}
 
+metrics.JOBS_IN_PROGRESS.set_function(lambda: {
+    ("download",): sum(1 for status in DOWNLOAD_STATUS.values() if status.get("status") == "downloading"),
+    ("export",): sum(1 for status in EXPORT_STATUS.values() if status.get("status") == "exporting"),
+})
+
 def get_session_path(api_id, phone):
     """Создаём уникальное имя сессии на основе api_id и phone"""
     user_hash = hashlib.md5(f"{api_id}_{phone}".encode()).hexdigest()
@@ -146,40 +304,41 @@ def get_user_data_path():
     """Файл для хранения данных пользователей"""
     return os.path.join(TELETHON_SESSION_DIR, "users.json")
 
+# users.json читается и перезаписывается из потоков file_io: изменения по очереди
+USERS_LOCK = threading.Lock()
+
 def save_user_data(api_id, api_hash, phone):
     """Сохраняем данные пользователя для быстрого входа"""
     users_file = get_user_data_path()
-    users = []
-    if os.path.exists(users_file):
-        try:
-            with open(users_file, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-        except Exception:
-            users = []
-    
-    # Проверяем, есть ли уже такой пользователь
-    user_exists = False
-    for user in users:
-        if user.get('api_id') == api_id and user.get('phone') == phone:
-            user_exists = True
-            break
-    
-    if not user_exists:
-        users.append({
-            'api_id': api_id,
-            'api_hash': api_hash,
-            'phone': phone
-        })
-        with open(users_file, 'w', encoding='utf-8') as f:
-            json.dump(users, f, indent=2, ensure_ascii=False)
+    with USERS_LOCK:
+        users = []
+        if os.path.exists(users_file):
+            try:
+                users = serialization.load(users_file)
+            except Exception:
+                users = []
+        
+        # Проверяем, есть ли уже такой пользователь
+        user_exists = False
+        for user in users:
+            if user.get('api_id') == api_id and user.get('phone') == phone:
+                user_exists = True
+                break
+        
+        if not user_exists:
+            users.append({
+                'api_id': api_id,
+                'api_hash': api_hash,
+                'phone': phone
+            })
+            serialization.dump(users_file, users, pretty=True)
 
 def get_saved_users():
     """Получаем список сохранённых пользователей"""
     users_file = get_user_data_path()
     if os.path.exists(users_file):
         try:
-            with open(users_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return serialization.load(users_file)
         except Exception:
             return []
     return []
@@ -187,19 +346,18 @@ def get_saved_users():
 def remove_user_data(api_id, phone):
     """Удаляем данные пользователя и его сессию"""
     users_file = get_user_data_path()
-    users = []
-    if os.path.exists(users_file):
-        try:
-            with open(users_file, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-        except Exception:
-            users = []
-    
-    # Удаляем пользователя из списка
-    users = [user for user in users if not (user.get('api_id') == api_id and user.get('phone') == phone)]
-    
-    with open(users_file, 'w', encoding='utf-8') as f:
-        json.dump(users, f, indent=2, ensure_ascii=False)
+    with USERS_LOCK:
+        users = []
+        if os.path.exists(users_file):
+            try:
+                users = serialization.load(users_file)
+            except Exception:
+                users = []
+        
+        # Удаляем пользователя из списка
+        users = [user for user in users if not (user.get('api_id') == api_id and user.get('phone') == phone)]
+        
+        serialization.dump(users_file, users, pretty=True)
     
     # Удаляем файл сессии
     session_path = get_session_path(api_id, phone)
@@ -218,67 +376,76 @@ def get_media_path(chat_id, chat_title):
     os.makedirs(chat_dir, exist_ok=True)
     return chat_dir
 
+def describe_media_file(message, media_path, file_type):
+    """Медиа сообщения и описание файла для него (без скачивания): (media, info) или (None, None)"""
+    date_str = message.date.strftime("%Y%m%d_%H%M%S")
+    if file_type == "voice" and message.voice:
+        return message.voice, {
+            "id": message.id,
+            "type": "voice",
+            "file_path": os.path.join(media_path, f"voice_{date_str}_{message.id}.ogg"),
+            "date": str(message.date),
+            "duration": media_duration(message)
+        }
+    elif file_type == "video" and message.video:
+        return message.video, {
+            "id": message.id,
+            "type": "video",
+            "file_path": os.path.join(media_path, f"video_{date_str}_{message.id}.mp4"),
+            "date": str(message.date),
+            "duration": media_duration(message),
+            "width": getattr(message.video, 'width', None),
+            "height": getattr(message.video, 'height', None)
+        }
+    elif file_type == "video" and message.document and message.document.mime_type and 'video' in message.document.mime_type:
+        return message.document, {
+            "id": message.id,
+            "type": "video",
+            "file_path": os.path.join(media_path, f"video_{date_str}_{message.id}.mp4"),
+            "date": str(message.date),
+            "mime_type": message.document.mime_type
+        }
+    elif file_type == "photo" and message.photo:
+        return message.photo, {
+            "id": message.id,
+            "type": "photo",
+            "file_path": os.path.join(media_path, f"photo_{date_str}_{message.id}.jpg"),
+            "date": str(message.date),
+            "width": getattr(message.photo, 'width', None),
+            "height": getattr(message.photo, 'height', None)
+        }
+    elif file_type == "document" and message.document:
+        doc_name = next(
+            (attr.file_name for attr in getattr(message.document, 'attributes', []) if getattr(attr, 'file_name', None)),
+            f'document_{message.id}'
+        )
+        return message.document, {
+            "id": message.id,
+            "type": "document",
+            "file_path": os.path.join(media_path, f"doc_{date_str}_{message.id}_{doc_name}"),
+            "date": str(message.date),
+            "mime_type": message.document.mime_type
+        }
+    return None, None
+
 async def download_media_file(client, message, media_path, file_type):
     """Скачивает медиафайл и возвращает информацию о нём"""
     try:
         os.makedirs(media_path, exist_ok=True)
         date_str = message.date.strftime("%Y%m%d_%H%M%S")
-        if file_type == "voice" and message.voice:
-            file_path = os.path.join(media_path, f"voice_{date_str}_{message.id}.ogg")
-            if not os.path.exists(file_path):
-                await client.download_media(message.voice, file_path)
-            return {
-                "id": message.id,
-                "type": "voice",
-                "file_path": file_path,
-                "date": str(message.date),
-                "duration": getattr(message.voice, 'duration', None)
-            }
-        elif file_type == "video" and message.video:
-            file_path = os.path.join(media_path, f"video_{date_str}_{message.id}.mp4")
-            if not os.path.exists(file_path):
-                await client.download_media(message.video, file_path)
-            return {
-                "id": message.id,
-                "type": "video",
-                "file_path": file_path,
-                "date": str(message.date),
-                "duration": getattr(message.video, 'duration', None),
-                "width": getattr(message.video, 'width', None),
-                "height": getattr(message.video, 'height', None)
-            }
-        elif file_type == "video" and message.document and message.document.mime_type and 'video' in message.document.mime_type:
-            file_path = os.path.join(media_path, f"video_{date_str}_{message.id}.mp4")
-            if not os.path.exists(file_path):
-                await client.download_media(message.document, file_path)
-            return {
-                "id": message.id,
-                "type": "video",
-                "file_path": file_path,
-                "date": str(message.date),
-                "mime_type": message.document.mime_type
-            }
-        elif file_type == "photo" and message.photo:
-            file_path = os.path.join(media_path, f"photo_{date_str}_{message.id}.jpg")
-            if not os.path.exists(file_path):
-                await client.download_media(message.photo, file_path)
-            return {
-                "id": message.id,
-                "type": "photo",
-                "file_path": file_path,
-                "date": str(message.date),
-                "width": getattr(message.photo, 'width', None),
-                "height": getattr(message.photo, 'height', None)
-            }
-        elif file_type == "text" and message.text:
+        media, file_info = describe_media_file(message, media_path, file_type)
+        if media is not None:
+            await download_resumable(client, media, file_info["file_path"])
+            return file_info
+        if file_type == "text" and message.text:
             text_file = os.path.join(media_path, f"text_{date_str}_{message.id}.txt")
             if not os.path.exists(text_file):
-                with open(text_file, 'w', encoding='utf-8') as f:
-                    f.write(f"ID: {message.id}\n")
-                    f.write(f"Дата: {message.date}\n")
-                    f.write(f"Отправитель: {message.sender_id}\n")
-                    f.write(f"Текст:\n{message.text}\n")
-                    f.write("-" * 50 + "\n")
+                # Файл в сотни байт пишется сразу: переход в поток обошёлся бы дороже записи
+                with tracing.span("write_files"):
+                    file_io.dump_text(text_file, f"ID: {message.id}\n"
+                                                        f"Дата: {message.date}\n"
+                                                        f"Отправитель: {message.sender_id}\n"
+                                                        f"Текст:\n{message.text}\n" + "-" * 50 + "\n")
             return {
                 "id": message.id,
                 "type": "text",
@@ -306,7 +473,7 @@ class TelegramCodeRequest(BaseModel):
 async def telegram_login(data: TelegramLoginRequest):
     session_path = get_session_path(data.api_id, data.phone)
     try:
-        client = TelegramClient(session_path, data.api_id, data.api_hash)
+        client = wrap_client(TelegramClient(session_path, data.api_id, data.api_hash))
         await client.connect()
         if await client.is_user_authorized():
             dialogs = []
@@ -319,7 +486,7 @@ async def telegram_login(data: TelegramLoginRequest):
                     "is_user": dialog.is_user
                 })
             await client.disconnect()
-            save_user_data(data.api_id, data.api_hash, data.phone)
+            await file_io.run(save_user_data, data.api_id, data.api_hash, data.phone)
             return {"status": "already_authorized", "chats": dialogs}
         sent = await client.send_code_request(data.phone)
         PHONE_CODE_HASHES[f"{data.api_id}_{data.phone}"] = sent.phone_code_hash
@@ -339,7 +506,7 @@ async def telegram_login(data: TelegramLoginRequest):
 async def telegram_code(data: TelegramCodeRequest):
     session_path = get_session_path(data.api_id, data.phone)
     try:
-        client = TelegramClient(session_path, data.api_id, data.api_hash)
+        client = wrap_client(TelegramClient(session_path, data.api_id, data.api_hash))
         await client.connect()
         phone_code_hash = PHONE_CODE_HASHES.get(f"{data.api_id}_{data.phone}")
         if not phone_code_hash:
@@ -361,7 +528,7 @@ async def telegram_code(data: TelegramCodeRequest):
                     "is_user": dialog.is_user
                 })
             await client.disconnect()
-            save_user_data(data.api_id, data.api_hash, data.phone)
+            await file_io.run(save_user_data, data.api_id, data.api_hash, data.phone)
             return {"status": "authorized", "chats": dialogs}
         else:
             await client.disconnect()
@@ -390,7 +557,7 @@ class TelegramDownloadRequest(BaseModel):
 async def telegram_password(data: TelegramPasswordRequest):
     session_path = get_session_path(data.api_id, data.phone)
     try:
-        client = TelegramClient(session_path, data.api_id, data.api_hash)
+        client = wrap_client(TelegramClient(session_path, data.api_id, data.api_hash))
         await client.connect()
         await client.sign_in(password=data.password)
         dialogs = []
@@ -403,7 +570,7 @@ async def telegram_password(data: TelegramPasswordRequest):
                 "is_user": dialog.is_user
             })
         await client.disconnect()
-        save_user_data(data.api_id, data.api_hash, data.phone)
+        await file_io.run(save_user_data, data.api_id, data.api_hash, data.phone)
         return {"status": "authorized", "chats": dialogs}
     except Exception as e:
         await client.disconnect()
@@ -417,13 +584,13 @@ async def telegram_password(data: TelegramPasswordRequest):
 @app.get("/telegram/users")
 async def get_telegram_users():
     """Получить список сохранённых пользователей"""
-    return get_saved_users()
+    return await file_io.run(get_saved_users)
 
 @app.delete("/telegram/reset")
 async def reset_telegram_session(api_id: int, phone: str):
     """Удалить сессию и данные пользователя"""
     try:
-        remove_user_data(api_id, phone)
+        await file_io.run(remove_user_data, api_id, phone)
         return {"status": "session_reset", "message": "Сессия и данные пользователя удалены"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Reset error: {str(e)}")
@@ -433,7 +600,7 @@ async def telegram_chats(api_id: int, api_hash: str, phone: str):
     session_path = get_session_path(api_id, phone)
     client = None
     try:
-        client = TelegramClient(session_path, api_id, api_hash)
+        client = wrap_client(TelegramClient(session_path, api_id, api_hash))
         await client.connect()
         if not await client.is_user_authorized():
             await client.disconnect()
@@ -467,7 +634,7 @@ async def telegram_chats(api_id: int, api_hash: str, phone: str):
 async def telegram_chat_messages(chat_id: int, api_id: int, api_hash: str, phone: str, limit: int = 20):
     session_path = get_session_path(api_id, phone)
     try:
-        client = TelegramClient(session_path, api_id, api_hash)
+        client = wrap_client(TelegramClient(session_path, api_id, api_hash))
         await client.connect()
         if not await client.is_user_authorized():
             await client.disconnect()
@@ -507,11 +674,43 @@ async def get_export_status(chat_id: int):
         return EXPORT_STATUS[status_key]
     return {"status": "not_found"}
 
-@app.post("/telegram/chat/{chat_id}/download")
-async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, download_voice: bool = True, download_video: bool = True):
-    """Скачивает медиафайлы из чата"""
-    print(f"🔍 Начинаем скачивание для чата {chat_id}")
-    print(f"📱 Параметры: voice={download_voice}, video={download_video}")
+async def download_chat_media_for_client(client, chat_id, download_voice=True, download_video=True, trace=False,
+                                         shards=None, media_types=None, max_file_mb=None, max_total_mb=None,
+                                         defer_video=False):
+    """Скачивает медиафайлы из чата через уже подключённый клиент, замеряя время по этапам"""
+    status_key = f"chat_{chat_id}"
+    result = None
+    with tracing.trace_job(status_key, record_events=trace) as tracer:
+        try:
+            result = await _download_chat_media(client, chat_id, download_voice, download_video, shards, media_types,
+                                                max_file_mb, max_total_mb, defer_video)
+        finally:
+            timings = tracer.breakdown()
+            DOWNLOAD_STATUS.setdefault(status_key, {})["timings"] = timings
+    
+    result["timings"] = timings
+    if trace:
+        result["trace_file"] = save_trace(tracer, result["media_path"])
+    return result
+
+def save_trace(tracer, directory):
+    """Сохраняет трассу задачи в формате Chrome trace рядом с результатами"""
+    trace_file = os.path.join(directory, "trace.json")
+    tracer.export_chrome(trace_file)
+    print(f"🧭 Трасса сохранена: {trace_file} (открыть в chrome://tracing или Perfetto)")
+    return trace_file
+
+async def _download_chat_media(client, chat_id, download_voice, download_video, shards, media_types,
+                               max_file_mb, max_total_mb, defer_video):
+    client = wrap_client(client)
+    
+    # Режим «только медиа»: сообщения выбранных типов отбирает сервер, текст не скачивается
+    save_text = not media_types
+    download_photo = not media_types or "photo" in media_types
+    download_document = bool(media_types) and "document" in media_types
+    if media_types:
+        download_voice = "voice" in media_types
+        download_video = "video" in media_types
     
     # Инициализируем статус
     status_key = f"chat_{chat_id}"
@@ -525,15 +724,7 @@ async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, downl
         "progress": 0
     }
     
-    session_path = get_session_path(data.api_id, data.phone)
-    client = None
     try:
-        client = TelegramClient(session_path, data.api_id, data.api_hash)
-        await client.connect()
-        if not await client.is_user_authorized():
-            await client.disconnect()
-            raise HTTPException(status_code=401, detail="Not authorized")
-        
         # Получаем информацию о чате
         try:
             chat = await client.get_entity(chat_id)
@@ -549,12 +740,14 @@ async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, downl
         
         print(f"📁 Папка для сохранения: {media_path}")
         
-        # Сначала подсчитаем общее количество сообщений
-        total_messages = 0
-        async for _ in client.iter_messages(chat_id):
-            total_messages += 1
+        # Количество сообщений одним запросом (total), без обхода истории
+        with tracing.span("count_messages"):
+            if media_types:
+                total_messages = await count_media_messages(client, chat_id, media_types)
+            else:
+                total_messages = await count_messages(client, chat_id)
         
-        print(f"📊 Всего сообщений в чате: {total_messages}")
+        print(f"📊 Всего сообщений {'с медиа ' if media_types else ''}в чате: {total_messages}")
         
         # Обновляем статус
         DOWNLOAD_STATUS[status_key]["total"] = total_messages
@@ -565,83 +758,101 @@ async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, downl
         voice_count = 0
         video_count = 0
         photo_count = 0
+        document_count = 0
         
-        async for message in client.iter_messages(chat_id):
-            processed_messages += 1
-            
-            # Обновляем статус каждые 10 сообщений
-            if processed_messages % 10 == 0:
-                progress = min(90, int((processed_messages / total_messages) * 90))
-                DOWNLOAD_STATUS[status_key].update({
-                    "processed": processed_messages,
-                    "progress": progress,
-                    "text_count": text_count,
-                    "voice_count": voice_count,
-                    "video_count": video_count,
-                    "photo_count": photo_count
-                })
-                print(f"⏳ Обработано сообщений: {processed_messages}/{total_messages}")
-            
-            # Скачиваем текстовые сообщения (всегда)
-            if message.text:
-                text_count += 1
-                file_info = await download_media_file(client, message, media_path, "text")
-                if file_info:
-                    downloaded_files.append(file_info)
-                    print(f"📝 Сохранено текстовое сообщение: {message.id}")
-            
-            # Скачиваем голосовые сообщения (если выбрано)
-            if download_voice and (message.voice or (message.document and message.document.mime_type and 'audio' in message.document.mime_type)):
-                voice_count += 1
-                file_info = await download_media_file(client, message, media_path, "voice")
-                if file_info:
-                    downloaded_files.append(file_info)
-                    # Подсчитываем размер файла
-                    if os.path.exists(file_info['file_path']):
-                        file_size = os.path.getsize(file_info['file_path'])
-                        total_size_mb += file_size / (1024 * 1024)
-                    print(f"🎤 Скачан голосовой файл: {message.id}")
-            
-            # Скачиваем видео сообщения (если выбрано)
-            if download_video and (message.video or (message.document and message.document.mime_type and 'video' in message.document.mime_type)):
-                video_count += 1
-                file_info = await download_media_file(client, message, media_path, "video")
-                if file_info:
-                    downloaded_files.append(file_info)
-                    # Подсчитываем размер файла
-                    if os.path.exists(file_info['file_path']):
-                        file_size = os.path.getsize(file_info['file_path'])
-                        total_size_mb += file_size / (1024 * 1024)
-                    print(f"🎥 Скачан видео файл: {message.id}")
-            
-            # Скачиваем фотографии (всегда)
-            if message.photo:
-                photo_count += 1
-                file_info = await download_media_file(client, message, media_path, "photo")
-                if file_info:
-                    downloaded_files.append(file_info)
-                    if os.path.exists(file_info['file_path']):
-                        file_size = os.path.getsize(file_info['file_path'])
-                        total_size_mb += file_size / (1024 * 1024)
-                    print(f"🖼️ Скачана фотография: {message.id}")
+        if media_types:
+            messages_source = iter_media_messages(client, chat_id, media_types, shards=shards)
+        else:
+            messages_source = iter_history(client, chat_id, shards=shards)
+        
+        scheduler = MediaScheduler(client, max_file_mb=max_file_mb, max_job_mb=max_total_mb,
+                                   defer=["video"] if defer_video else None)
+        scheduled = []
+        
+        def schedule(message, file_type):
+            media, file_info = describe_media_file(message, media_path, file_type)
+            if media is not None:
+                scheduled.append((file_info, scheduler.submit(file_type, message.id, media, file_info['file_path'])))
+        
+        async with scheduler:
+            async for message in messages_source:
+                processed_messages += 1
+                
+                # Обновляем статус каждые 10 сообщений
+                if processed_messages % 10 == 0:
+                    progress = min(90, int((processed_messages / max(1, total_messages)) * 90))
+                    DOWNLOAD_STATUS[status_key].update({
+                        "processed": processed_messages,
+                        "progress": progress,
+                        "text_count": text_count,
+                        "voice_count": voice_count,
+                        "video_count": video_count,
+                        "photo_count": photo_count,
+                        "document_count": document_count,
+                        "media": scheduler.stats(),
+                        "timings": tracing.breakdown()
+                    })
+                    print(f"⏳ Обработано сообщений: {processed_messages}/{total_messages}")
+                
+                is_voice = bool(message.voice or (message.document and message.document.mime_type and 'audio' in message.document.mime_type))
+                is_video = bool(message.video or (message.document and message.document.mime_type and 'video' in message.document.mime_type))
+                
+                # Скачиваем текстовые сообщения (кроме режима «только медиа»)
+                if save_text and message.text:
+                    text_count += 1
+                    file_info = await download_media_file(client, message, media_path, "text")
+                    if file_info:
+                        downloaded_files.append(file_info)
+                        print(f"📝 Сохранено текстовое сообщение: {message.id}")
+                
+                # Медиа уходят в очередь планировщика: голосовые скачиваются раньше фото, документов и видео
+                if download_voice and is_voice:
+                    voice_count += 1
+                    schedule(message, "voice")
+                if download_video and is_video:
+                    video_count += 1
+                    schedule(message, "video")
+                if download_photo and message.photo:
+                    photo_count += 1
+                    schedule(message, "photo")
+                if download_document and message.document and not is_voice and not is_video:
+                    document_count += 1
+                    schedule(message, "document")
+                
+        # Итоги планировщика: в список файлов попадают только скачанные
+        for file_info, future in scheduled:
+            result = future.result()
+            if result["status"] in (DOWNLOADED, EXISTS):
+                downloaded_files.append(file_info)
+                total_size_mb += result["size"] / (1024 * 1024)
+        deferred_file = await file_io.run(scheduler.write_deferred, media_path)
         
         print(f"✅ Обработка завершена:")
         print(f"   • Текстовых: {text_count}")
         print(f"   • Голосовых: {voice_count}")
         print(f"   • Видео: {video_count}")
         print(f"   • Фото: {photo_count}")
+        if download_document:
+            print(f"   • Документов: {document_count}")
         print(f"   • Общий размер: {round(total_size_mb, 2)} МБ")
+        if scheduler.deferred or scheduler.skipped:
+            print(f"   • Отложено: {len(scheduler.deferred)}, пропущено по лимитам: {len(scheduler.skipped)}")
         
         # Создаём отдельный файл с текстовыми сообщениями
         text_messages = []
         text_messages.append("=== ТЕКСТОВЫЕ СООБЩЕНИЯ ===\n")
         
+        # Текстовые файлы читаются одним заходом в поток, а не по одному
+        text_contents = await file_io.run(file_io.load_texts,
+                                          [f['file_path'] for f in downloaded_files if f['type'] == 'text'])
+        
         current_date = None
         for file_info in downloaded_files:
             if file_info['type'] == 'text':
                 try:
-                    with open(file_info['file_path'], 'r', encoding='utf-8') as f:
-                        content = f.read()
+                    content = text_contents[file_info['file_path']]
+                    if isinstance(content, Exception):
+                        raise content
                     
                     # Парсим информацию из файла
                     lines = content.split('\n')
@@ -686,10 +897,10 @@ async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, downl
         text_messages.append("\n=== КОНЕЦ ТЕКСТОВЫХ СООБЩЕНИЙ ===")
         
         # Сохраняем текстовые сообщения в отдельный файл
-        if text_messages:
-            text_file = os.path.join(media_path, "text_messages.txt")
-            with open(text_file, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(text_messages))
+        if save_text:
+            with tracing.span("write_files"):
+                text_file = await file_io.run(storage.write_text, os.path.join(media_path, "text_messages.txt"),
+                                              '\n'.join(text_messages))
             print(f"📄 Создан файл с текстовыми сообщениями: {text_file}")
         
         # Сохраняем информацию о скачанных файлах
@@ -698,14 +909,17 @@ async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, downl
             "chat_id": chat_id,
             "chat_title": chat_title,
             "download_date": str(datetime.now()),
+            "media_types": sorted(media_types) if media_types else None,
             "files": downloaded_files,
+            "deferred": scheduler.deferred,
+            "skipped": scheduler.skipped,
             "total_size_mb": round(total_size_mb, 2),
             "text_messages_count": len([f for f in downloaded_files if f['type'] == 'text']),
             "media_files_count": len([f for f in downloaded_files if f['type'] != 'text'])
         }
         
-        with open(info_file, 'w', encoding='utf-8') as f:
-            json.dump(download_info, f, indent=2, ensure_ascii=False)
+        with tracing.span("write_files"):
+            await file_io.write(info_file, download_info, pretty=True)
         
         print(f"💾 Сохранена информация о скачивании: {info_file}")
         
@@ -718,13 +932,20 @@ async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, downl
             "text_count": text_count,
             "voice_count": voice_count,
             "video_count": video_count,
-            "total_size_mb": round(total_size_mb, 2)
+            "photo_count": photo_count,
+            "document_count": document_count,
+            "total_size_mb": round(total_size_mb, 2),
+            "media": scheduler.stats()
         }
         
         result = {
             "status": "success",
             "chat_title": chat_title,
             "downloaded_count": len(downloaded_files),
+            "media_types": sorted(media_types) if media_types else None,
+            "media": scheduler.stats(),
+            "deferred_file": deferred_file,
+            "skipped": scheduler.skipped,
             "total_messages": total_messages,
             "processed_messages": processed_messages,
             "media_path": media_path,
@@ -744,11 +965,110 @@ async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, downl
             "status": "error",
             "error": str(e)
         }
+        raise
+
+@app.post("/telegram/chat/{chat_id}/download")
+async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, download_voice: bool = True, download_video: bool = True, trace: bool = False, shards: Optional[int] = None, media_types: Optional[str] = None,
+                              max_file_mb: Optional[float] = None, max_total_mb: Optional[float] = None, defer_video: bool = False):
+    """Скачивает медиафайлы из чата
+
+    media_types (например, "voice,photo") включает режим «только медиа»:
+    сообщения нужных типов отбираются серверными фильтрами Telegram.
+    max_file_mb/max_total_mb ограничивают размер файла и объём задачи,
+    defer_video сохраняет видео только как метаданные (докачка — /deferred-media).
+    """
+    print(f"🔍 Начинаем скачивание для чата {chat_id}")
+    print(f"📱 Параметры: voice={download_voice}, video={download_video}, media_types={media_types}")
+    
+    selected_types = [t.strip() for t in media_types.split(",") if t.strip()] if media_types else None
+    unknown_types = set(selected_types or []) - set(MEDIA_FILTERS)
+    if unknown_types:
+        raise HTTPException(status_code=400, detail=f"Unknown media types: {', '.join(sorted(unknown_types))}. "
+                                                    f"Supported: {', '.join(MEDIA_FILTERS)}")
+    
+    session_path = get_session_path(data.api_id, data.phone)
+    client = None
+    try:
+        client = wrap_client(TelegramClient(session_path, data.api_id, data.api_hash))
+        await client.connect()
+        if not await client.is_user_authorized():
+            await client.disconnect()
+            raise HTTPException(status_code=401, detail="Not authorized")
+        
+        return await download_chat_media_for_client(client, chat_id, download_voice, download_video, trace, shards, selected_types,
+                                                    max_file_mb, max_total_mb, defer_video)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Download error: {str(e)}")
+    finally:
         if client:
             try:
                 await client.disconnect()
             except Exception:
                 pass
+
+def deferred_media_dirs(chat_id):
+    """Папки чата, в которых есть список отложенных медиа"""
+    candidates = []
+    for base_dir, sub_dir in ((MEDIA_DOWNLOAD_DIR, None), (LLM_EXPORT_DIR, "media")):
+        if not os.path.exists(base_dir):
+            continue
+        for chat_dir in os.listdir(base_dir):
+            if chat_dir.startswith(f"{chat_id}_"):
+                path = os.path.join(base_dir, chat_dir, sub_dir) if sub_dir else os.path.join(base_dir, chat_dir)
+                if load_deferred(path):
+                    candidates.append(path)
+    return candidates
+
+async def download_deferred_media(client, chat_id, max_file_mb=None, max_total_mb=None):
+    """Докачивает медиа, отложенные ранее (defer_video), и обновляет их списки"""
+    client = wrap_client(client)
+    summary = {"status": "success", "downloaded": 0, "remaining": 0, "total_size_mb": 0, "dirs": []}
+    
+    for directory in await file_io.run(deferred_media_dirs, chat_id):
+        entries = await file_io.run(load_deferred, directory)
+        messages = await client.get_messages(chat_id, ids=[entry["message_id"] for entry in entries])
+        by_id = {message.id: message for message in (messages or []) if message is not None}
+        
+        scheduled = []
+        async with MediaScheduler(client, max_file_mb=max_file_mb, max_job_mb=max_total_mb, defer=[]) as scheduler:
+            for entry in entries:
+                message = by_id.get(entry["message_id"])
+                media = message and getattr(message, entry["type"], None)
+                if media is None:
+                    # Сообщение удалено — докачивать нечего
+                    continue
+                scheduled.append((entry, scheduler.submit(entry["type"], message.id, media, entry["path"])))
+        
+        remaining = [entry for entry, future in scheduled if future.result()["status"] not in (DOWNLOADED, EXISTS)]
+        await file_io.run(save_deferred, directory, remaining)
+        summary["downloaded"] += scheduler.counts[DOWNLOADED]
+        summary["remaining"] += len(remaining)
+        summary["total_size_mb"] += round(scheduler.bytes_downloaded / (1024 * 1024), 2)
+        summary["dirs"].append({"dir": directory, "media": scheduler.stats(), "remaining": len(remaining)})
+        print(f"📥 Докачано отложенных медиа в {directory}: {scheduler.counts[DOWNLOADED]}, осталось: {len(remaining)}")
+    
+    return summary
+
+@app.post("/telegram/chat/{chat_id}/deferred-media")
+async def download_chat_deferred_media(chat_id: int, data: TelegramDownloadRequest, max_file_mb: Optional[float] = None, max_total_mb: Optional[float] = None):
+    """Докачивает отложенные медиа чата (режим «метаданные сейчас, байты потом»)"""
+    session_path = get_session_path(data.api_id, data.phone)
+    client = None
+    try:
+        client = wrap_client(TelegramClient(session_path, data.api_id, data.api_hash))
+        await client.connect()
+        if not await client.is_user_authorized():
+            await client.disconnect()
+            raise HTTPException(status_code=401, detail="Not authorized")
+        
+        return await download_deferred_media(client, chat_id, max_file_mb, max_total_mb)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
         raise HTTPException(status_code=500, detail=f"Download error: {str(e)}")
     finally:
         if client:
@@ -760,6 +1080,10 @@ async def download_chat_media(chat_id: int, data: TelegramDownloadRequest, downl
 @app.get("/telegram/media/list")
 async def list_downloaded_media():
     """Получить список скачанных медиафайлов"""
+    return await file_io.run(read_download_infos)
+
+def read_download_infos():
+    """download_info.json всех скачанных чатов"""
     if not os.path.exists(MEDIA_DOWNLOAD_DIR):
         return []
     
@@ -770,20 +1094,20 @@ async def list_downloaded_media():
             info_file = os.path.join(chat_path, "download_info.json")
             if os.path.exists(info_file):
                 try:
-                    with open(info_file, 'r', encoding='utf-8') as f:
-                        info = json.load(f)
-                    media_list.append(info)
+                    media_list.append(serialization.load(info_file))
                 except Exception:
                     pass
     
     return media_list
 
-def format_for_prompt(messages):
-    """Форматирует сообщения для отправки в LLM"""
+def format_for_prompt(messages, analytics_summary=None):
+    """Форматирует сообщения для отправки в LLM (со сводкой статистики, если передана)"""
     if not messages:
         return "Переписка пуста."
     
     formatted = []
+    if analytics_summary:
+        formatted.append(analytics_summary + "\n")
     formatted.append("=== ПЕРЕПИСКА ИЗ TELEGRAM ===\n")
     
     # Группируем сообщения по дате
@@ -806,6 +1130,8 @@ def format_for_prompt(messages):
             formatted.append(f"[{time_part}] {sender}: 🎤 {text}")
         elif msg['type'] == 'video':
             text = msg.get('text', '[видеосообщение]')
+            if msg.get('transcription'):
+                text += f" (речь: {msg['transcription']})"
             formatted.append(f"[{time_part}] {sender}: 🎥 {text}")
         elif msg['type'] == 'photo':
             text = msg.get('text', '[фото]')
@@ -817,32 +1143,51 @@ def format_for_prompt(messages):
     formatted.append("\n=== КОНЕЦ ПЕРЕПИСКИ ===")
     return '\n'.join(formatted)
 
-async def transcribe_audio(audio_path):
+async def transcribe_audio(audio_path, duration=None):
     """Расшифровывает аудиофайл с помощью Whisper"""
-    try:
-        # Проверяем, установлен ли faster-whisper
-        try:
-            from faster_whisper import WhisperModel
-        except ImportError:
-            print("faster-whisper не установлен. Установите: pip install faster-whisper")
-            return None
-        
-        # Загружаем модель Whisper
-        model = WhisperModel("base", device="cpu", compute_type="int8")
-        
-        # Расшифровываем аудио
-        segments, info = model.transcribe(audio_path, language="ru")
-        
-        # Собираем текст
-        text = " ".join([segment.text for segment in segments])
-        return text.strip()
-        
-    except Exception as e:
-        print(f"Ошибка расшифровки аудио {audio_path}: {e}")
-        return None
+    # Модель faster-whisper выбирается по длительности и загружается один раз
+    return await asr.transcribe(audio_path, asr.BACKEND_FASTER, cache=TRANSCRIPTION_CACHE, duration=duration)
 
-async def export_chat_for_llm(client, chat_id, limit=1000):
-    """Экспортирует чат в формате для LLM"""
+async def _transcribe_voice_when_ready(future, msg_data, voice_path, duration=None):
+    """Расшифровывает голосовое, как только планировщик его скачал"""
+    result = await future
+    if result["status"] not in (DOWNLOADED, EXISTS):
+        return
+    transcription = await transcribe_audio(voice_path, duration)
+    if transcription:
+        msg_data["text"] = transcription
+
+async def _transcribe_video_when_ready(future, msg_data, video_path, duration=None):
+    """Расшифровывает звуковую дорожку видео после скачивания (длинные — по кускам)"""
+    result = await future
+    if result["status"] not in (DOWNLOADED, EXISTS):
+        return
+    transcript = await asr.transcribe_detailed(
+        video_path, asr.BACKEND_FASTER, cache=TRANSCRIPTION_CACHE, duration=duration
+    )
+    if transcript and transcript["text"]:
+        msg_data["transcription"] = transcript["text"]
+        msg_data["segments"] = transcript["segments"]
+
+async def export_chat_for_llm(client, chat_id, limit=1000, transcribe_video=False, trace=False, shards=None,
+                              max_file_mb=None, max_total_mb=None, defer_video=False,
+                              include_analytics=ANALYTICS_IN_PROMPT):
+    """Экспортирует чат в формате для LLM, замеряя время по этапам"""
+    status_key = f"export_{chat_id}"
+    with tracing.trace_job(status_key, record_events=trace) as tracer:
+        result = await _export_chat_for_llm(client, chat_id, limit, transcribe_video, shards,
+                                            max_file_mb, max_total_mb, defer_video, include_analytics)
+    
+    timings = tracer.breakdown()
+    EXPORT_STATUS.setdefault(status_key, {})["timings"] = timings
+    result["timings"] = timings
+    if trace and "export_dir" in result:
+        result["trace_file"] = save_trace(tracer, result["export_dir"])
+    return result
+
+async def _export_chat_for_llm(client, chat_id, limit, transcribe_video, shards,
+                               max_file_mb, max_total_mb, defer_video, include_analytics):
+    client = wrap_client(client)
     try:
         # Инициализируем статус экспорта
         status_key = f"export_{chat_id}"
@@ -879,167 +1224,196 @@ async def export_chat_for_llm(client, chat_id, limit=1000):
         photo_count = 0
         document_count = 0
         
-        # Сначала подсчитаем общее количество сообщений
-        total_messages = 0
-        async for _ in client.iter_messages(chat_id, limit=limit):
-            total_messages += 1
+        # Количество сообщений одним запросом (total), без обхода истории
+        with tracing.span("count_messages"):
+            total_messages = await count_messages(client, chat_id, limit=limit)
         
         # Обновляем статус
         EXPORT_STATUS[status_key]["total"] = total_messages
         
-        # Получаем сообщения
-        async for message in client.iter_messages(chat_id, limit=limit):
-            processed_count += 1
-            
-            # Обновляем статус каждые 10 сообщений
-            if processed_count % 10 == 0:
-                EXPORT_STATUS[status_key].update({
-                    "processed": processed_count,
-                    "text_count": text_count,
-                    "voice_count": voice_count,
-                    "video_count": video_count,
-                    "photo_count": photo_count,
-                    "document_count": document_count
-                })
-            
-            # Определяем отправителя
-            if message.from_id:
-                try:
-                    sender = await client.get_entity(message.from_id)
-                    sender_name = getattr(sender, 'first_name', None) or getattr(sender, 'username', None) or 'Unknown'
-                except:
-                    sender_name = 'Unknown'
-            else:
-                sender_name = 'me'
-            
-            # Форматируем время
-            time_str = message.date.strftime("%Y-%m-%dT%H:%M:%S")
-            
-            msg_data = {
-                "from": sender_name,
-                "time": time_str,
-                "message_id": message.id
-            }
-            
-            # Обрабатываем разные типы сообщений
-            if message.text:
-                text_count += 1
-                msg_data.update({
-                    "type": "text",
-                    "text": message.text
-                })
-                messages.append(msg_data)
-                
-            elif message.voice:
-                # Скачиваем голосовое сообщение
-                date_str = message.date.strftime("%Y-%m-%d_%H-%M-%S")
-                voice_file = f"voice_{date_str}_{message.id}.ogg"
-                voice_path = os.path.join(media_dir, voice_file)
-                
-                if not os.path.exists(voice_path):
-                    await client.download_media(message.voice, voice_path)
-                    # Подсчитываем размер файла
-                    if os.path.exists(voice_path):
-                        file_size = os.path.getsize(voice_path)
-                        total_size_mb += file_size / (1024 * 1024)
-                        downloaded_files += 1
-                
-                # Расшифровываем аудио
-                transcription = await transcribe_audio(voice_path)
-                
-                voice_count += 1
-                msg_data.update({
-                    "type": "voice",
-                    "file": voice_file,
-                    "text": transcription or "[аудиосообщение без расшифровки]",
-                    "duration": getattr(message.voice, 'duration', None)
-                })
-                messages.append(msg_data)
-                
-            elif message.video:
-                # Скачиваем видео
-                date_str = message.date.strftime("%Y-%m-%d_%H-%M-%S")
-                video_file = f"video_{date_str}_{message.id}.mp4"
-                video_path = os.path.join(media_dir, video_file)
-                
-                if not os.path.exists(video_path):
-                    await client.download_media(message.video, video_path)
-                    # Подсчитываем размер файла
-                    if os.path.exists(video_path):
-                        file_size = os.path.getsize(video_path)
-                        total_size_mb += file_size / (1024 * 1024)
-                        downloaded_files += 1
-                
-                video_count += 1
-                msg_data.update({
-                    "type": "video",
-                    "file": video_file,
-                    "text": getattr(message, 'caption', None) or "[видеосообщение]",
-                    "duration": getattr(message.video, 'duration', None)
-                })
-                messages.append(msg_data)
-                
-            elif message.photo:
-                photo_count += 1
-                # Скачиваем фото
-                date_str = message.date.strftime("%Y-%m-%d_%H-%M-%S")
-                photo_file = f"photo_{date_str}_{message.id}.jpg"
-                photo_path = os.path.join(media_dir, photo_file)
+        # Медиа скачивает планировщик: голосовые первыми, видео последними
+        scheduler = MediaScheduler(client, max_file_mb=max_file_mb, max_job_mb=max_total_mb,
+                                   defer=["video"] if defer_video else None)
+        scheduled = []
+        post_tasks = []
+        # Колоночная копия для аналитики пишется пачками по ходу экспорта
+        columns = await file_io.run(ColumnarWriter, export_dir)
+        
+        try:
+            async with scheduler:
+                # Получаем сообщения (при shards > 1 — параллельно по диапазонам id)
+                async for message in iter_history(client, chat_id, limit=limit, shards=shards):
+                    processed_count += 1
                 
-                if not os.path.exists(photo_path):
-                    await client.download_media(message.photo, photo_path)
-                    # Подсчитываем размер файла
-                    if os.path.exists(photo_path):
-                        file_size = os.path.getsize(photo_path)
-                        total_size_mb += file_size / (1024 * 1024)
-                        downloaded_files += 1
+                    # Обновляем статус каждые 10 сообщений
+                    if processed_count % 10 == 0:
+                        EXPORT_STATUS[status_key].update({
+                            "processed": processed_count,
+                            "text_count": text_count,
+                            "voice_count": voice_count,
+                            "video_count": video_count,
+                            "photo_count": photo_count,
+                            "document_count": document_count,
+                            "timings": tracing.breakdown()
+                        })
                 
-                msg_data.update({
-                    "type": "photo",
-                    "file": photo_file,
-                    "text": getattr(message, 'caption', None) or "[фото]"
-                })
-                messages.append(msg_data)
+                    # Определяем отправителя
+                    if message.from_id:
+                        try:
+                            sender = await client.get_entity(message.from_id)
+                            sender_name = getattr(sender, 'first_name', None) or getattr(sender, 'username', None) or 'Unknown'
+                        except:
+                            sender_name = 'Unknown'
+                    else:
+                        sender_name = 'me'
                 
-            elif message.document:
-                document_count += 1
-                # Скачиваем документ
-                date_str = message.date.strftime("%Y-%m-%d_%H-%M-%S")
-                doc_name = getattr(message.document, 'attributes', [{}])[0].get('file_name', f'document_{message.id}')
-                doc_file = f"doc_{date_str}_{message.id}_{doc_name}"
-                doc_path = os.path.join(media_dir, doc_file)
+                    # Форматируем время
+                    time_str = message.date.strftime("%Y-%m-%dT%H:%M:%S")
                 
-                if not os.path.exists(doc_path):
-                    await client.download_media(message.document, doc_path)
-                    # Подсчитываем размер файла
-                    if os.path.exists(doc_path):
-                        file_size = os.path.getsize(doc_path)
-                        total_size_mb += file_size / (1024 * 1024)
-                        downloaded_files += 1
+                    msg_data = {
+                        "from": sender_name,
+                        "time": time_str,
+                        "message_id": message.id
+                    }
+                    reply_to = getattr(message, 'reply_to_msg_id', None)
+                    if reply_to:
+                        msg_data["reply_to"] = reply_to
                 
-                msg_data.update({
-                    "type": "document",
-                    "file": doc_file,
-                    "text": getattr(message, 'caption', None) or f"[документ: {doc_name}]"
-                })
-                messages.append(msg_data)
+                    # Обрабатываем разные типы сообщений
+                    if message.text:
+                        text_count += 1
+                        msg_data.update({
+                            "type": "text",
+                            "text": message.text
+                        })
+                        messages.append(msg_data)
+                        if columns.append(msg_data):
+                            await columns.flush_async()
+                    
+                    elif message.voice:
+                        # Голосовое — в очередь с высшим приоритетом, расшифровка сразу после скачивания
+                        date_str = message.date.strftime("%Y-%m-%d_%H-%M-%S")
+                        voice_file = f"voice_{date_str}_{message.id}.ogg"
+                        voice_path = os.path.join(media_dir, voice_file)
+                        duration = media_duration(message)
+                    
+                        voice_count += 1
+                        msg_data.update({
+                            "type": "voice",
+                            "file": voice_file,
+                            "text": "[аудиосообщение без расшифровки]",
+                            "duration": duration
+                        })
+                        messages.append(msg_data)
+                        future = scheduler.submit("voice", message.id, message.voice, voice_path)
+                        scheduled.append((msg_data, future))
+                        task = asyncio.create_task(_transcribe_voice_when_ready(future, msg_data, voice_path, duration))
+                        # В колоночный экспорт — уже с расшифровкой
+                        task.add_done_callback(lambda _, msg_data=msg_data: columns.append(msg_data))
+                        post_tasks.append(task)
+                    
+                    elif message.video:
+                        # Видео — последним в очереди; при defer_video только метаданные (если не нужна расшифровка)
+                        date_str = message.date.strftime("%Y-%m-%d_%H-%M-%S")
+                        video_file = f"video_{date_str}_{message.id}.mp4"
+                        video_path = os.path.join(media_dir, video_file)
+                        duration = media_duration(message)
+                    
+                        video_count += 1
+                        msg_data.update({
+                            "type": "video",
+                            "file": video_file,
+                            "text": getattr(message, 'caption', None) or "[видеосообщение]",
+                            "duration": duration
+                        })
+                        messages.append(msg_data)
+                        future = scheduler.submit("video", message.id, message.video, video_path, allow_defer=not transcribe_video)
+                        scheduled.append((msg_data, future))
+                    
+                        # Расшифровываем звуковую дорожку (длинные записи — параллельно по кускам)
+                        if transcribe_video:
+                            task = asyncio.create_task(_transcribe_video_when_ready(future, msg_data, video_path, duration))
+                            task.add_done_callback(lambda _, msg_data=msg_data: columns.append(msg_data))
+                            post_tasks.append(task)
+                        elif columns.append(msg_data):
+                            await columns.flush_async()
+                    
+                    elif message.photo:
+                        photo_count += 1
+                        date_str = message.date.strftime("%Y-%m-%d_%H-%M-%S")
+                        photo_file = f"photo_{date_str}_{message.id}.jpg"
+                        photo_path = os.path.join(media_dir, photo_file)
+                    
+                        msg_data.update({
+                            "type": "photo",
+                            "file": photo_file,
+                            "text": getattr(message, 'caption', None) or "[фото]"
+                        })
+                        messages.append(msg_data)
+                        if columns.append(msg_data):
+                            await columns.flush_async()
+                        scheduled.append((msg_data, scheduler.submit("photo", message.id, message.photo, photo_path)))
+                    
+                    elif message.document:
+                        document_count += 1
+                        date_str = message.date.strftime("%Y-%m-%d_%H-%M-%S")
+                        doc_name = next(
+                            (attr.file_name for attr in getattr(message.document, 'attributes', []) if getattr(attr, 'file_name', None)),
+                            f'document_{message.id}'
+                        )
+                        doc_file = f"doc_{date_str}_{message.id}_{doc_name}"
+                        doc_path = os.path.join(media_dir, doc_file)
+                    
+                        msg_data.update({
+                            "type": "document",
+                            "file": doc_file,
+                            "text": getattr(message, 'caption', None) or f"[документ: {doc_name}]"
+                        })
+                        messages.append(msg_data)
+                        if columns.append(msg_data):
+                            await columns.flush_async()
+                        scheduled.append((msg_data, scheduler.submit("document", message.id, message.document, doc_path)))
+        
+            # Дожидаемся расшифровок и учитываем итоги скачивания
+            await asyncio.gather(*post_tasks)
+            for msg_data, future in scheduled:
+                result = future.result()
+                if result["status"] == DOWNLOADED:
+                    total_size_mb += result["size"] / (1024 * 1024)
+                    downloaded_files += 1
+                elif result["status"] not in (EXISTS,):
+                    msg_data["media_status"] = result["status"]
+            deferred_file = await file_io.run(scheduler.write_deferred, media_dir)
+            with tracing.span("write_files"):
+                columns_file = await file_io.run(columns.close)
+        except BaseException:
+            # Расшифровки, ждущие скачивания, не должны пережить экспорт
+            for task in post_tasks:
+                task.cancel()
+            await asyncio.gather(*post_tasks, return_exceptions=True)
+            # Недописанный колоночный файл не должен остаться для аналитики
+            await file_io.run(columns.abort)
+            raise
         
         # Сортируем сообщения по времени
         messages.sort(key=lambda x: x['time'])
         
         # Сохраняем в JSON
-        json_file = os.path.join(export_dir, "chat_export.json")
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, indent=2, ensure_ascii=False)
+        with tracing.span("write_files"):
+            await file_io.run(storage.write_messages, os.path.join(export_dir, "chat_export.json"), messages)
         
         # Создаём текстовый файл для LLM с полной перепиской
-        prompt_file = os.path.join(export_dir, "chat_for_llm.txt")
-        formatted_text = format_for_prompt(messages)
-        with open(prompt_file, 'w', encoding='utf-8') as f:
-            f.write(formatted_text)
+        analytics_summary = None
+        if include_analytics:
+            with tracing.span("analytics"):
+                analytics_summary = await file_io.run(
+                    lambda: analytics.summary_text(analytics.analyze(read_columns(export_dir))))
+        with tracing.span("format_prompt"):
+            formatted_text = format_for_prompt(messages, analytics_summary)
+        with tracing.span("write_files"):
+            await file_io.run(storage.write_text, os.path.join(export_dir, "chat_for_llm.txt"), formatted_text)
         
         # Создаём отдельный файл только с текстовыми сообщениями
-        text_only_file = os.path.join(export_dir, "text_messages.txt")
         text_messages = []
         text_messages.append("=== ТЕКСТОВЫЕ СООБЩЕНИЯ ===\n")
         
@@ -1060,8 +1434,8 @@ async def export_chat_for_llm(client, chat_id, limit=1000):
         
         text_messages.append("\n=== КОНЕЦ ТЕКСТОВЫХ СООБЩЕНИЙ ===")
         
-        with open(text_only_file, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(text_messages))
+        with tracing.span("write_files"):
+            await file_io.run(storage.write_text, os.path.join(export_dir, "text_messages.txt"), '\n'.join(text_messages))
         
         # Обновляем финальный статус
         EXPORT_STATUS[status_key] = {
@@ -1072,7 +1446,8 @@ async def export_chat_for_llm(client, chat_id, limit=1000):
             "voice_count": voice_count,
             "video_count": video_count,
             "photo_count": photo_count,
-            "document_count": document_count
+            "document_count": document_count,
+            "media": scheduler.stats()
         }
         
         # Создаём метаданные
@@ -1089,12 +1464,17 @@ async def export_chat_for_llm(client, chat_id, limit=1000):
             "voice_count": len([m for m in messages if m['type'] == 'voice']),
             "video_count": len([m for m in messages if m['type'] == 'video']),
             "photo_count": len([m for m in messages if m['type'] == 'photo']),
-            "document_count": len([m for m in messages if m['type'] == 'document'])
+            "document_count": len([m for m in messages if m['type'] == 'document']),
+            "media": scheduler.stats(),
+            "deferred": scheduler.deferred,
+            "skipped": scheduler.skipped,
+            "columns_file": columns_file,
+            "columns_format": columns.format
         }
         
         meta_file = os.path.join(export_dir, "metadata.json")
-        with open(meta_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        with tracing.span("write_files"):
+            await file_io.write(meta_file, metadata, pretty=True)
         
         return {
             "status": "success",
@@ -1103,7 +1483,8 @@ async def export_chat_for_llm(client, chat_id, limit=1000):
             "metadata": metadata,
             "messages_count": len(messages),
             "downloaded_files": downloaded_files,
-            "total_size_mb": round(total_size_mb, 2)
+            "total_size_mb": round(total_size_mb, 2),
+            "deferred_file": deferred_file
         }
         
     except Exception as e:
@@ -1116,18 +1497,23 @@ async def export_chat_for_llm(client, chat_id, limit=1000):
         return {"status": "error", "detail": str(e)}
 
 @app.post("/telegram/chat/{chat_id}/export-llm")
-async def export_chat_llm(chat_id: int, data: TelegramDownloadRequest, limit: int = 1000):
+async def export_chat_llm(chat_id: int, data: TelegramDownloadRequest, limit: int = 1000, transcribe_video: bool = False, trace: bool = False, shards: Optional[int] = None,
+                          max_file_mb: Optional[float] = None, max_total_mb: Optional[float] = None, defer_video: bool = False,
+                          include_analytics: Optional[bool] = None):
     """Экспортирует чат в формате для LLM"""
     session_path = get_session_path(data.api_id, data.phone)
     client = None
     try:
-        client = TelegramClient(session_path, data.api_id, data.api_hash)
+        client = wrap_client(TelegramClient(session_path, data.api_id, data.api_hash))
         await client.connect()
         if not await client.is_user_authorized():
             await client.disconnect()
             raise HTTPException(status_code=401, detail="Not authorized")
         
-        result = await export_chat_for_llm(client, chat_id, limit)
+        if include_analytics is None:
+            include_analytics = ANALYTICS_IN_PROMPT
+        result = await export_chat_for_llm(client, chat_id, limit, transcribe_video, trace, shards,
+                                           max_file_mb, max_total_mb, defer_video, include_analytics)
         
         if result["status"] == "success":
             return result
@@ -1152,6 +1538,10 @@ async def export_chat_llm(chat_id: int, data: TelegramDownloadRequest, limit: in
 @app.get("/telegram/llm-exports")
 async def list_llm_exports():
     """Получить список экспортов для LLM"""
+    return await file_io.run(read_export_metadata)
+
+def read_export_metadata():
+    """metadata.json всех экспортов для LLM"""
     if not os.path.exists(LLM_EXPORT_DIR):
         return []
     
@@ -1162,14 +1552,70 @@ async def list_llm_exports():
             meta_file = os.path.join(export_path, "metadata.json")
             if os.path.exists(meta_file):
                 try:
-                    with open(meta_file, 'r', encoding='utf-8') as f:
-                        metadata = json.load(f)
-                    exports.append(metadata)
+                    exports.append(serialization.load(meta_file))
                 except Exception:
                     pass
     
     return exports
 
+@app.get("/telegram/llm-exports/{chat_id}/analytics")
+async def get_llm_export_analytics(chat_id: int, tz_offset: float = analytics.ANALYTICS_TZ_OFFSET,
+                                   session_gap: int = analytics.ANALYTICS_SESSION_GAP):
+    """Статистика переписки без LLM: время ответа, тепловая карта, метрики отправителей"""
+    result = await file_io.run(export_analytics, chat_id, tz_offset, session_gap)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Export not found")
+    return result
+
+def export_analytics(chat_id: int, tz_offset: float, session_gap: int) -> Optional[dict]:
+    """Статистика экспорта чата (None, если экспорта нет); выполняется в потоке"""
+    if os.path.exists(LLM_EXPORT_DIR):
+        for export_dir in os.listdir(LLM_EXPORT_DIR):
+            export_path = os.path.join(LLM_EXPORT_DIR, export_dir)
+            if not export_dir.startswith(f"{chat_id}_"):
+                continue
+            # Колоночный экспорт читается через memmap, старые экспорты — из chat_export.json
+            columns = read_columns(export_path)
+            json_file = os.path.join(export_path, "chat_export.json")
+            if columns is None and storage.exists(json_file):
+                columns = analytics.arrays_from_messages(storage.read_messages(json_file))
+            if columns is not None:
+                result = analytics.analyze(columns, tz_offset_hours=tz_offset, session_gap=session_gap)
+                result["summary"] = analytics.summary_text(result)
+                return result
+    return None
+
+@app.get("/telegram/llm-exports/{chat_id}/{name}")
+async def get_llm_export_file(chat_id: int, name: str):
+    """Содержимое файла экспорта (сжатый или обычный — читается прозрачно)"""
+    if name not in storage.CONVERTIBLE_FILES:
+        raise HTTPException(status_code=400, detail=f"Supported files: {', '.join(storage.CONVERTIBLE_FILES)}")
+    if os.path.exists(LLM_EXPORT_DIR):
+        for export_dir in os.listdir(LLM_EXPORT_DIR):
+            path = os.path.join(LLM_EXPORT_DIR, export_dir, name)
+            if export_dir.startswith(f"{chat_id}_") and storage.exists(path):
+                if name.endswith(".json"):
+                    return await file_io.run(storage.read_messages, path)
+                return Response(content=await file_io.run(storage.read_text, path),
+                                media_type="text/plain; charset=utf-8")
+    raise HTTPException(status_code=404, detail="Export not found")
+
+@app.post("/storage/compress")
+async def compress_storage(compression: Optional[str] = None):
+    """Фоновая конвертация экспортов в сжатый формат (по умолчанию STORAGE_COMPRESSION или gzip)"""
+    try:
+        started = await storage.convert_in_background([LLM_EXPORT_DIR, MEDIA_DOWNLOAD_DIR], compression)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not started:
+        raise HTTPException(status_code=409, detail="Conversion already running")
+    return storage.CONVERSION_STATUS
+
+@app.get("/storage/compress-status")
+async def compress_storage_status():
+    """Прогресс фоновой конвертации"""
+    return storage.CONVERSION_STATUS
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001) 
\ No newline at end of file
@@ -4,17 +4,30 @@
 """
 
 import os
-import json
+import time
 import asyncio
 from datetime import datetime
 from typing import List, Dict, Optional
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
 
+from services import asr
+from services import metrics
+from services import rate_limiter
+from services import storage
+from services import analytics
+from services import llm_pool
+from services import batch
+from services import file_io
+from services import loop_lag
+from services.llm import GENERATIONS
+
 # Импортируем нашу систему анализа
+_import_started = time.perf_counter()
 from telegram_analyzer import TelegramAnalyzer
+asr.IMPORT_TIMINGS["telegram_analyzer"] = round(time.perf_counter() - _import_started, 3)
 
 app = FastAPI(title="Telegram Analyzer API", version="2.0")
 
@@ -31,6 +44,21 @@ app.add_middleware(
 telegram_analyzer = None
 active_chats = {}
 
+
+def _dispatcher_chats() -> Dict:
+    """Статистика очередей диспетчера для метрик"""
+    if not telegram_analyzer or not telegram_analyzer.dispatcher:
+        return {}
+    return telegram_analyzer.dispatcher.stats()["chats"]
+
+metrics.QUEUE_DEPTH.set_function(lambda: {
+    (f"listen:{name}",): chat["queue_depth"] for name, chat in _dispatcher_chats().items()
+})
+LISTEN_DROPPED = metrics.gauge("listen_dropped_messages", "Отброшенные из-за переполнения очереди сообщения", ["chat"])
+LISTEN_DROPPED.set_function(lambda: {
+    (name,): chat["dropped"] for name, chat in _dispatcher_chats().items()
+})
+
 # Модели данных
 class TelegramAuthRequest(BaseModel):
     api_id: int
@@ -44,15 +72,29 @@ class TelegramCodeRequest(BaseModel):
 class ChatRequest(BaseModel):
     chat: str
     limit: int = 3000
+    trace: bool = False
+    shards: Optional[int] = None
 
 class AnalysisRequest(BaseModel):
     chat: str
     messages_count: int = 30
 
+class BatchProfileRequest(BaseModel):
+    """Чаты для пакетного обновления профилей (по умолчанию — все live-файлы)"""
+    chats: Optional[List[str]] = None
+    priority: int = 0
+    parallelism: Optional[int] = None
+
 @app.on_event("startup")
 async def startup_event():
     """Инициализация при запуске"""
     print("🚀 Запуск Telegram Analyzer API v2.0")
+    print(f"📦 Импорты при старте: {asr.startup_report()['imports']}")
+    loop_lag.MONITOR.start()
+    
+    # Модель Whisper можно прогреть заранее, не задерживая старт
+    if asr.ASR_PRELOAD:
+        asr.preload_in_background(asr.BACKEND_OPENAI)
 
 @app.get("/")
 async def root():
@@ -66,10 +108,54 @@ async def root():
             "/telegram/download": "Скачивание истории чата",
             "/telegram/listen": "Слушание новых сообщений",
             "/telegram/profile": "Получение профиля чата",
-            "/telegram/analysis": "Анализ сообщений"
+            "/telegram/analysis": "Анализ сообщений",
+            "/system/startup": "Стоимость импортов и загрузки моделей",
+            "/system/loop-lag": "Задержка цикла событий",
+            "/metrics": "Метрики Prometheus"
         }
     }
 
+@app.get("/system/startup")
+async def startup_report():
+    """Отчёт о времени импортов и загрузки моделей"""
+    return {
+        "status": "success",
+        "report": asr.startup_report()
+    }
+
+@app.get("/system/loop-lag")
+async def loop_lag_report():
+    """Задержка цикла событий: последние замеры, p50/p99 и максимум"""
+    return {
+        "status": "success",
+        "loop_lag": loop_lag.MONITOR.stats(),
+        "file_io_threads": file_io.FILE_IO_THREADS
+    }
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Метрики в формате Prometheus"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/asr/stats")
+async def asr_stats():
+    """Статистика распознавания по маршрутам (RTF) и кэшу расшифровок"""
+    return {
+        "status": "success",
+        "routes": asr.route_stats(),
+        "cache": telegram_analyzer.transcription_cache.stats() if telegram_analyzer else None
+    }
+
+@app.get("/telegram/rate-limits")
+async def telegram_rate_limits():
+    """Текущие лимиты запросов к Telegram по аккаунтам и статистика FloodWait"""
+    return {"status": "success", "accounts": rate_limiter.stats()}
+
+@app.get("/llm/backends")
+async def llm_backends():
+    """Состояние пула LLM-бэкендов: загрузка, здоровье, очередь по владельцам"""
+    return {"status": "success", **llm_pool.POOL.stats(), "single_flight": GENERATIONS.stats()}
+
 @app.post("/telegram/connect")
 async def telegram_connect(data: TelegramAuthRequest):
     """Подключение к Telegram и отправка кода"""
@@ -141,14 +227,15 @@ async def download_chat_history(data: ChatRequest):
         raise HTTPException(status_code=400, detail="Сначала выполните авторизацию")
     
     try:
-        success = await telegram_analyzer.download_history(data.chat, data.limit)
+        success = await telegram_analyzer.download_history(data.chat, data.limit, data.trace, data.shards)
         
         if success:
             return {
                 "status": "success",
                 "message": f"История чата {data.chat} скачана",
                 "chat": data.chat,
-                "limit": data.limit
+                "limit": data.limit,
+                "timings": telegram_analyzer.job_timings.get(data.chat)
             }
         else:
             raise HTTPException(status_code=500, detail="Ошибка скачивания истории")
@@ -157,7 +244,7 @@ async def download_chat_history(data: ChatRequest):
         raise HTTPException(status_code=400, detail=f"Ошибка: {str(e)}")
 
 @app.post("/telegram/listen")
-async def start_listening(data: ChatRequest, background_tasks: BackgroundTasks):
+async def start_listening(data: ChatRequest):
     """Запускает слушание новых сообщений"""
     global telegram_analyzer, active_chats
     
@@ -165,21 +252,24 @@ async def start_listening(data: ChatRequest, background_tasks: BackgroundTasks):
         raise HTTPException(status_code=400, detail="Сначала выполните авторизацию")
     
     try:
+        # Подписываем чат на общий диспетчер клиента
+        if not await telegram_analyzer.listen_to_new_messages(data.chat):
+            raise HTTPException(status_code=400, detail=f"Не удалось начать слушание {data.chat}")
+        
         # Добавляем в активные чаты
         active_chats[data.chat] = {
             "started_at": datetime.now().isoformat(),
             "status": "listening"
         }
         
-        # Запускаем слушание в фоне
-        background_tasks.add_task(telegram_analyzer.listen_to_new_messages, data.chat)
-        
         return {
             "status": "success",
             "message": f"Слушание чата {data.chat} запущено",
             "chat": data.chat
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка: {str(e)}")
 
@@ -196,18 +286,11 @@ async def get_chat_profile(chat: str):
         profile_file = f"data/profiles/{chat_key}_profile.json"
         analysis_file = f"data/profiles/{chat_key}_last_analysis.txt"
         
-        profile = {}
+        # Загружаем профиль и последний анализ (вне цикла событий)
+        profile = await file_io.read(profile_file, {})
         analysis = ""
-        
-        # Загружаем профиль
-        if os.path.exists(profile_file):
-            with open(profile_file, 'r', encoding='utf-8') as f:
-                profile = json.load(f)
-        
-        # Загружаем последний анализ
         if os.path.exists(analysis_file):
-            with open(analysis_file, 'r', encoding='utf-8') as f:
-                analysis = f.read()
+            analysis = await file_io.read_text(analysis_file)
         
         return {
             "status": "success",
@@ -231,9 +314,8 @@ async def get_chat_messages(chat: str, limit: int = 50):
         
         live_file = f"data/live/{chat_key}.json"
         
-        if os.path.exists(live_file):
-            with open(live_file, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
+        if storage.exists(live_file):
+            messages = await file_io.run(storage.read_messages, live_file)
             
             # Возвращаем последние сообщения
             recent_messages = messages[-limit:] if len(messages) > limit else messages
@@ -253,12 +335,74 @@ async def get_chat_messages(chat: str, limit: int = 50):
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка: {str(e)}")
 
+@app.get("/telegram/analytics/{chat}")
+async def get_chat_analytics(chat: str, tz_offset: float = analytics.ANALYTICS_TZ_OFFSET,
+                             session_gap: int = analytics.ANALYTICS_SESSION_GAP):
+    """Статистика переписки без LLM: время ответа, тепловая карта, метрики отправителей"""
+    chat_key = chat if chat.startswith('@') else f"chat_{chat}"
+    live_file = f"data/live/{chat_key}.json"
+    if not storage.exists(live_file):
+        raise HTTPException(status_code=404, detail=f"Файл с сообщениями для {chat} не найден")
+    
+    def compute():
+        columns = analytics.arrays_from_messages(storage.read_messages(live_file))
+        result = analytics.analyze(columns, tz_offset_hours=tz_offset, session_gap=session_gap)
+        result["summary"] = analytics.summary_text(result)
+        return result
+    
+    result = await file_io.run(compute)
+    return {"status": "success", "chat": chat, **result}
+
+@app.post("/telegram/analysis/batch")
+async def refresh_profiles_batch(data: BatchProfileRequest):
+    """Пакетное обновление профилей по сохранённым сообщениям (возвращает batch_id)"""
+    if not telegram_analyzer:
+        raise HTTPException(status_code=400, detail="Сначала подключитесь к Telegram")
+    
+    if data.chats is not None:
+        chat_keys = [chat if chat.startswith('@') else f"chat_{chat}" for chat in data.chats]
+    else:
+        names = os.listdir("data/live") if os.path.exists("data/live") else []
+        chat_keys = sorted({name.split(".json", 1)[0] for name in names if ".json" in name})
+    
+    items = [key for key in dict.fromkeys(chat_keys) if storage.exists(f"data/live/{key}.json")]
+    skipped = {key: "no live file" for key in chat_keys if key not in items}
+    
+    async def refresh(chat_key: str) -> dict:
+        messages = await file_io.run(storage.read_messages, f"data/live/{chat_key}.json")
+        if not messages:
+            raise ValueError("Нет сообщений")
+        analysis = await telegram_analyzer.analyze_new_message(chat_key, messages[-1])
+        if analysis is None:
+            raise RuntimeError("Ошибка обновления профиля")
+        return {"analysis": analysis}
+    
+    job = batch.RUNNER.submit(items, refresh, data.priority, data.parallelism, "profile", skipped)
+    return {"status": "success", "batch": job.stats(include_results=False)}
+
+@app.get("/telegram/analysis/batch/{batch_id}")
+async def refresh_profiles_batch_status(batch_id: str, results: bool = True):
+    """Прогресс пакета и результаты по чатам"""
+    job = batch.RUNNER.get(batch_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Пакет не найден")
+    return {"status": "success", "batch": job.stats(include_results=results)}
+
+@app.delete("/telegram/analysis/batch/{batch_id}")
+async def refresh_profiles_batch_cancel(batch_id: str):
+    """Отменяет ещё не начатые чаты пакета"""
+    if not batch.RUNNER.cancel(batch_id):
+        raise HTTPException(status_code=404, detail="Пакет не найден или уже завершён")
+    return {"status": "success", "batch": batch.RUNNER.get(batch_id).stats(include_results=False)}
+
 @app.get("/telegram/active")
 async def get_active_chats():
     """Получает список активных чатов"""
+    dispatcher = telegram_analyzer.dispatcher if telegram_analyzer else None
     return {
         "status": "success",
-        "active_chats": active_chats
+        "active_chats": active_chats,
+        "dispatcher": dispatcher.stats() if dispatcher else None
     }
 
 @app.delete("/telegram/stop/{chat}")
@@ -268,6 +412,8 @@ async def stop_listening(chat: str):
     
     if chat in active_chats:
         del active_chats[chat]
+        if telegram_analyzer:
+            await telegram_analyzer.stop_listening(chat)
         return {
             "status": "success",
             "message": f"Слушание чата {chat} остановлено"
@@ -291,7 +437,7 @@ async def list_files():
         # Список live файлов
         if os.path.exists("data/live"):
             for file in os.listdir("data/live"):
-                if file.endswith('.json'):
+                if file.endswith('.json') or '.jsonl.' in file:
                     files["live"].append(file)
         
         # Список профилей
@@ -313,5 +459,21 @@ async def list_files():
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка: {str(e)}")
 
+@app.post("/storage/compress")
+async def compress_storage(compression: Optional[str] = None):
+    """Фоновая конвертация live-файлов в сжатый формат (по умолчанию STORAGE_COMPRESSION или gzip)"""
+    try:
+        started = await storage.convert_in_background(["data/live"], compression)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not started:
+        raise HTTPException(status_code=409, detail="Конвертация уже выполняется")
+    return storage.CONVERSION_STATUS
+
+@app.get("/storage/compress-status")
+async def compress_storage_status():
+    """Прогресс фоновой конвертации"""
+    return storage.CONVERSION_STATUS
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8001) 
\ No newline at end of file
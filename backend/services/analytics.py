@@ -0,0 +1,212 @@
+"""
+Векторная аналитика переписки на NumPy: время ответа, тепловые карты, метрики по отправителям
+
+Считается по столбцам (время, коды отправителей, длины, типы) — из
+колоночного экспорта (services.columnar) или из списка сообщений. Все
+расчёты — операции над целыми массивами без циклов по сообщениям, поэтому
+чат на миллион сообщений обрабатывается за доли секунды.
+"""
+
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from services.columnar import MESSAGE_TYPES
+
+# Сдвиг часового пояса для тепловых карт, часы
+ANALYTICS_TZ_OFFSET = float(os.getenv("ANALYTICS_TZ_OFFSET", "0"))
+# Пауза, после которой сообщение начинает новый разговор (инициатива), с
+ANALYTICS_SESSION_GAP = int(os.getenv("ANALYTICS_SESSION_GAP", str(6 * 3600)))
+# Сколько самых активных отправителей выводить
+ANALYTICS_TOP_SENDERS = int(os.getenv("ANALYTICS_TOP_SENDERS", "50"))
+
+# Границы корзин гистограммы времени ответа, с
+RESPONSE_BUCKETS = [0, 60, 300, 900, 3600, 6 * 3600, 24 * 3600, np.iinfo(np.int64).max]
+RESPONSE_BUCKET_LABELS = ["<1м", "1-5м", "5-15м", "15-60м", "1-6ч", "6-24ч", ">24ч"]
+
+WEEKDAYS = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+
+
+def arrays_from_messages(messages: List[Dict]) -> Dict:
+    """Столбцы в формате read_columns из списка сообщений (live-файл, chat_export)"""
+    senders: Dict[str, int] = {}
+    type_codes = {t: i for i, t in enumerate(MESSAGE_TYPES)}
+    times, sender_codes, lengths, types = [], [], [], []
+    for msg in messages:
+        moment = datetime.fromisoformat(msg["time"])
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        times.append(int(moment.timestamp()))
+        sender_codes.append(senders.setdefault(msg.get("from") or "", len(senders)))
+        lengths.append(len(msg.get("transcription") or msg.get("text") or ""))
+        types.append(type_codes.get(msg.get("type"), 0))
+    return {
+        "time": np.asarray(times, dtype=np.int64),
+        "sender": np.asarray(sender_codes, dtype=np.int32),
+        "text_len": np.asarray(lengths, dtype=np.int32),
+        "type": np.asarray(types, dtype=np.int8),
+        "rows": len(messages),
+        "dictionaries": {"sender": list(senders), "type": list(MESSAGE_TYPES)},
+    }
+
+
+def _group_percentiles(groups: np.ndarray, values: np.ndarray, n_groups: int, quantiles) -> Dict:
+    """Количество, среднее и квантили целых values по группам — одной сортировкой
+
+    Группа и значение упаковываются в один ключ int64 (группа в старших
+    32 битах): сортировка одного массива быстрее lexsort по двум.
+    """
+    values = np.clip(values, 0, 0xFFFFFFFF).astype(np.int64)
+    counts = np.bincount(groups, minlength=n_groups)
+    sums = np.bincount(groups, weights=values, minlength=n_groups)
+    ordered = np.sort((groups.astype(np.int64) << 32) | values) & 0xFFFFFFFF
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    result = {"count": counts, "mean": np.divide(sums, counts, out=np.zeros(n_groups), where=counts > 0)}
+    for name, q in quantiles.items():
+        index = starts + np.floor(q * np.maximum(counts - 1, 0)).astype(np.int64)
+        picked = ordered[np.minimum(index, max(len(ordered) - 1, 0))] if len(ordered) else np.zeros(n_groups)
+        result[name] = np.where(counts > 0, picked, 0)
+    return result
+
+
+def _quantiles(values: np.ndarray) -> Dict:
+    if not len(values):
+        return {"count": 0, "mean": None, "median": None, "p90": None}
+    # partition вместо полной сортировки percentile
+    k50, k90 = int(0.5 * (len(values) - 1)), int(0.9 * (len(values) - 1))
+    part = np.partition(values, [k50, k90])
+    median, p90 = part[k50], part[k90]
+    return {"count": int(len(values)), "mean": round(float(values.mean()), 1),
+            "median": round(float(median), 1), "p90": round(float(p90), 1)}
+
+
+def analyze(columns: Dict, tz_offset_hours: float = ANALYTICS_TZ_OFFSET,
+            session_gap: int = ANALYTICS_SESSION_GAP, top_senders: int = ANALYTICS_TOP_SENDERS) -> Dict:
+    """Метрики переписки по столбцам time/sender/text_len/type"""
+    started = time.perf_counter()
+    times = np.asarray(columns["time"], dtype=np.int64)
+    if not len(times):
+        return {"messages": 0, "senders": {}, "elapsed_ms": 0.0}
+
+    senders = np.asarray(columns["sender"], dtype=np.int64)
+    lengths = np.asarray(columns["text_len"], dtype=np.int64)
+    types = np.asarray(columns["type"], dtype=np.int64)
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind="stable")
+        times, senders, lengths, types = times[order], senders[order], lengths[order], types[order]
+
+    sender_names = columns["dictionaries"]["sender"]
+    type_names = columns["dictionaries"].get("type", list(MESSAGE_TYPES))
+    n_senders = max(len(sender_names), int(senders.max()) + 1)
+    n_types = max(len(type_names), int(types.max()) + 1)
+
+    # Инициатива: первое сообщение после паузы дольше session_gap
+    gaps = np.diff(times)
+    starts = np.concatenate(([True], gaps > session_gap))
+
+    # Ответы: смена отправителя внутри одного разговора
+    is_response = (senders[1:] != senders[:-1]) & ~starts[1:]
+    response_times = gaps[is_response]
+    responders = senders[1:][is_response]
+
+    initiated = np.bincount(senders[starts], minlength=n_senders)
+
+    # Тепловая карта день недели × час в заданном часовом поясе (1970-01-01 — четверг)
+    local = times + int(tz_offset_hours * 3600)
+    days = local // 86400
+    hours = (local % 86400) // 3600
+    weekdays = (days + 3) % 7
+    heatmap = np.bincount(weekdays * 24 + hours, minlength=7 * 24).reshape(7, 24)
+
+    counts = np.bincount(senders, minlength=n_senders)
+    type_counts = np.bincount(senders * n_types + types, minlength=n_senders * n_types).reshape(n_senders, n_types)
+    text_mask = types == (type_names.index("text") if "text" in type_names else 0)
+    length_stats = _group_percentiles(senders[text_mask], lengths[text_mask], n_senders, {"median": 0.5, "p90": 0.9})
+    response_stats = _group_percentiles(responders, response_times, n_senders, {"median": 0.5, "p90": 0.9})
+
+    per_sender = {}
+    total_starts = int(starts.sum())
+    for code in np.argsort(-counts, kind="stable")[:top_senders]:
+        if not counts[code]:
+            break
+        name = sender_names[code] if code < len(sender_names) else str(code)
+        per_sender[name] = {
+            "messages": int(counts[code]),
+            "share": round(float(counts[code] / len(times)), 3),
+            "types": {type_names[t]: int(type_counts[code, t]) for t in range(n_types) if type_counts[code, t]},
+            "text_length": {
+                "mean": round(float(length_stats["mean"][code]), 1),
+                "median": int(length_stats["median"][code]),
+                "p90": int(length_stats["p90"][code])
+            },
+            "response_s": {
+                "count": int(response_stats["count"][code]),
+                "mean": round(float(response_stats["mean"][code]), 1),
+                "median": int(response_stats["median"][code]),
+                "p90": int(response_stats["p90"][code])
+            },
+            "initiated": int(initiated[code]),
+            "initiative_ratio": round(float(initiated[code] / total_starts), 3) if total_starts else 0.0
+        }
+
+    histogram, _ = np.histogram(response_times, bins=RESPONSE_BUCKETS)
+    hourly = heatmap.sum(axis=0)
+    weekly = heatmap.sum(axis=1)
+    return {
+        "messages": int(len(times)),
+        "period": {
+            "first": datetime.fromtimestamp(int(times[0]), timezone.utc).isoformat(),
+            "last": datetime.fromtimestamp(int(times[-1]), timezone.utc).isoformat()
+        },
+        "sender_count": int(np.count_nonzero(counts)),
+        "conversations": total_starts,
+        "response_s": {
+            **_quantiles(response_times),
+            "histogram": dict(zip(RESPONSE_BUCKET_LABELS, histogram.tolist()))
+        },
+        "text_length": _quantiles(lengths[text_mask]),
+        "heatmap": {
+            "tz_offset_hours": tz_offset_hours,
+            "weekday_hour": heatmap.tolist(),
+            "hourly": hourly.tolist(),
+            "weekly": dict(zip(WEEKDAYS, weekly.tolist())),
+            "busiest_hour": int(hourly.argmax()),
+            "busiest_weekday": WEEKDAYS[int(weekly.argmax())]
+        },
+        "senders": per_sender,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+
+def _duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 60:
+        return f"{int(seconds)} с"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+
+def summary_text(result: Dict, max_senders: int = 5) -> str:
+    """Краткая сводка метрик для контекста LLM (несколько строк)"""
+    if not result.get("messages"):
+        return ""
+    lines = [
+        "=== СТАТИСТИКА ПЕРЕПИСКИ ===",
+        f"Сообщений: {result['messages']}, участников: {result['sender_count']}, "
+        f"разговоров: {result['conversations']}",
+        f"Время ответа: медиана {_duration(result['response_s']['median'])}, "
+        f"90% — до {_duration(result['response_s']['p90'])}",
+        f"Пик активности: {result['heatmap']['busiest_hour']}:00, {result['heatmap']['busiest_weekday']}"
+    ]
+    for name, sender in list(result["senders"].items())[:max_senders]:
+        lines.append(
+            f"• {name}: {round(sender['share'] * 100)}% сообщений, начинает {round(sender['initiative_ratio'] * 100)}% "
+            f"разговоров, отвечает за {_duration(sender['response_s']['median'] if sender['response_s']['count'] else None)}, "
+            f"средняя длина {round(sender['text_length']['mean'])} симв."
+        )
+    return "\n".join(lines)
@@ -0,0 +1,366 @@
+"""
+Распознавание речи с ленивой загрузкой Whisper и тяжёлых зависимостей
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from services import metrics
+from services import tracing
+
+logger = logging.getLogger(__name__)
+
+BACKEND_OPENAI = "openai-whisper"
+BACKEND_FASTER = "faster-whisper"
+
+# Настройки через переменные окружения
+ASR_MODEL = os.getenv("ASR_MODEL", "base")
+ASR_LANGUAGE = os.getenv("ASR_LANGUAGE", "ru")
+ASR_PRELOAD = os.getenv("ASR_PRELOAD", "").lower() in ("1", "true", "yes")
+ASR_VAD = os.getenv("ASR_VAD", "1").lower() in ("1", "true", "yes")
+
+# Маршрутизация по длительности: короткие клипы — на быструю модель, длинные — на точную
+ASR_SHORT_MODEL = os.getenv("ASR_SHORT_MODEL", "tiny")
+ASR_LONG_MODEL = os.getenv("ASR_LONG_MODEL", "small")
+ASR_SHORT_MAX_SECONDS = float(os.getenv("ASR_SHORT_MAX_SECONDS", "15"))
+ASR_LONG_MIN_SECONDS = float(os.getenv("ASR_LONG_MIN_SECONDS", "120"))
+
+# Параллельная расшифровка длинных записей по кускам в отдельных процессах
+ASR_WORKERS = int(os.getenv("ASR_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+ASR_THREADS_PER_WORKER = int(os.getenv("ASR_THREADS_PER_WORKER", "2"))
+ASR_PARALLEL_MIN_SECONDS = float(os.getenv("ASR_PARALLEL_MIN_SECONDS", "300"))
+ASR_SEGMENT_SECONDS = float(os.getenv("ASR_SEGMENT_SECONDS", "60"))
+# Сколько файлов расшифровывается одновременно (остальные ждут в очереди пула)
+ASR_CONCURRENCY = int(os.getenv("ASR_CONCURRENCY", "1"))
+
+ROUTE_SHORT = "short"
+ROUTE_DEFAULT = "default"
+ROUTE_LONG = "long"
+ROUTE_FIXED = "fixed"
+
+SAMPLE_RATE = 16000
+
+_BACKEND_MODULES = {
+    BACKEND_OPENAI: "whisper",
+    BACKEND_FASTER: "faster_whisper",
+}
+
+# Время импорта модулей и загрузки моделей (секунды)
+IMPORT_TIMINGS: Dict[str, float] = {}
+MODEL_LOAD_TIMINGS: Dict[str, float] = {}
+
+# Статистика по маршрутам: длительность аудио, речи и время обработки
+ROUTE_STATS: Dict[str, Dict] = {}
+
+_models: Dict[tuple, object] = {}
+_failed: Dict[tuple, str] = {}
+_lock = threading.Lock()
+_process_pool = None
+_thread_pool = None
+
+
+def timed_import(module_name: str):
+    """Импортирует модуль и запоминает, сколько занял импорт"""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    IMPORT_TIMINGS[module_name] = round(time.perf_counter() - start, 3)
+    logger.info(f"📦 Импорт {module_name}: {IMPORT_TIMINGS[module_name]} с")
+    return module
+
+
+def backend_available(backend: str) -> bool:
+    """Проверяет (один раз), что пакет бэкенда установлен"""
+    key = (backend, None)
+    if key in _failed:
+        return False
+    try:
+        timed_import(_BACKEND_MODULES[backend])
+        return True
+    except ImportError as e:
+        _failed[key] = str(e)
+        logger.error(f"❌ {backend} не установлен: {e}")
+        return False
+
+
+def load_model(backend: str = BACKEND_OPENAI, name: str = ASR_MODEL):
+    """Возвращает модель Whisper, загружая её при первом обращении"""
+    key = (backend, name)
+    if key in _models:
+        return _models[key]
+    if key in _failed:
+        return None
+
+    with _lock:
+        if key in _models:
+            return _models[key]
+        if key in _failed:
+            return None
+
+        start = time.perf_counter()
+        try:
+            module = timed_import(_BACKEND_MODULES[backend])
+            if backend == BACKEND_FASTER:
+                model = module.WhisperModel(name, device="cpu", compute_type="int8")
+            else:
+                model = module.load_model(name)
+        except ImportError as e:
+            _failed[key] = str(e)
+            logger.error(f"❌ {backend} не установлен: {e}")
+            return None
+        except Exception as e:
+            _failed[key] = str(e)
+            logger.error(f"❌ Ошибка загрузки Whisper ({backend}:{name}): {e}")
+            return None
+
+        MODEL_LOAD_TIMINGS[f"{backend}:{name}"] = round(time.perf_counter() - start, 3)
+        _models[key] = model
+        logger.info(f"✅ Whisper модель {backend}:{name} загружена за {MODEL_LOAD_TIMINGS[f'{backend}:{name}']} с")
+        return model
+
+
+def route_for_duration(duration: Optional[float]) -> Tuple[str, str]:
+    """Выбирает маршрут и модель по длительности аудио (секунды)"""
+    if duration is None:
+        return ROUTE_DEFAULT, ASR_MODEL
+    if duration <= ASR_SHORT_MAX_SECONDS:
+        return ROUTE_SHORT, ASR_SHORT_MODEL
+    if duration >= ASR_LONG_MIN_SECONDS:
+        return ROUTE_LONG, ASR_LONG_MODEL
+    return ROUTE_DEFAULT, ASR_MODEL
+
+
+def load_audio(path: str, backend: str = BACKEND_OPENAI):
+    """Декодирует файл в 16 кГц mono float32 средствами выбранного бэкенда"""
+    module = timed_import(_BACKEND_MODULES[backend])
+    if backend == BACKEND_FASTER:
+        return module.decode_audio(path, sampling_rate=SAMPLE_RATE)
+    return module.load_audio(path)
+
+
+def _run_model(model, backend: str, audio, language: str) -> List[Dict]:
+    """Один проход модели по уже декодированному аудио, сегменты с таймкодами"""
+    if backend == BACKEND_FASTER:
+        segments, info = model.transcribe(audio, language=language)
+        return [{"start": segment.start, "end": segment.end, "text": segment.text.strip()} for segment in segments]
+    result = model.transcribe(audio, language=language)
+    return [
+        {"start": segment["start"], "end": segment["end"], "text": segment["text"].strip()}
+        for segment in result.get("segments", [])
+    ]
+
+
+def _init_worker(threads: int):
+    """Ограничивает число потоков BLAS/torch в процессе-воркере"""
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+
+
+def _transcribe_chunk(backend: str, name: str, language: str, audio, offset: float) -> List[Dict]:
+    """Расшифровка одного куска в процессе-воркере; таймкоды сдвигаются на offset"""
+    model = load_model(backend, name)
+    if model is None:
+        raise RuntimeError(_failed.get((backend, name), f"Модель {backend}:{name} недоступна"))
+    return [
+        {"start": segment["start"] + offset, "end": segment["end"] + offset, "text": segment["text"]}
+        for segment in _run_model(model, backend, audio, language)
+    ]
+
+
+def _get_process_pool():
+    global _process_pool
+    with _lock:
+        if _process_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _process_pool = ProcessPoolExecutor(
+                max_workers=ASR_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(ASR_THREADS_PER_WORKER,)
+            )
+        return _process_pool
+
+
+def _transcribe_parallel(backend: str, name: str, language: str, audio) -> Tuple[List[Dict], float]:
+    """Режет запись в паузах, расшифровывает куски параллельно и склеивает по порядку"""
+    from services import vad
+    chunks = vad.split_at_silence(audio, SAMPLE_RATE, ASR_SEGMENT_SECONDS)
+    pool = _get_process_pool()
+    futures = [
+        pool.submit(_transcribe_chunk, backend, name, language, audio[start:end], start / SAMPLE_RATE)
+        for start, end in chunks
+    ]
+    segments = []
+    for future in futures:
+        segments.extend(future.result())
+    speech_seconds = sum(end - start for start, end in chunks) / SAMPLE_RATE
+    return segments, speech_seconds
+
+
+def _record_route(route: str, audio_seconds: float, speech_seconds: float, elapsed: float):
+    with _lock:
+        stats = ROUTE_STATS.setdefault(route, {
+            "count": 0,
+            "audio_seconds": 0.0,
+            "speech_seconds": 0.0,
+            "processing_seconds": 0.0
+        })
+        stats["count"] += 1
+        stats["audio_seconds"] += audio_seconds
+        stats["speech_seconds"] += speech_seconds
+        stats["processing_seconds"] += elapsed
+    metrics.ASR_AUDIO_SECONDS.inc(audio_seconds, route=route)
+    metrics.ASR_PROCESSING_SECONDS.inc(elapsed, route=route)
+    if audio_seconds:
+        metrics.ASR_RTF.observe(elapsed / audio_seconds, route=route)
+
+
+def transcribe_detailed_sync(path: str, backend: str = BACKEND_OPENAI, name: Optional[str] = None,
+                             language: str = ASR_LANGUAGE, cache=None,
+                             duration: Optional[float] = None) -> Optional[Dict]:
+    """Расшифровывает аудиофайл (блокирующий вызов): {"text", "segments"}
+
+    Если модель не задана явно, она выбирается по длительности (duration).
+    Перед распознаванием тишина вырезается VAD (ASR_VAD), таймкоды
+    сегментов остаются в шкале исходной записи. Записи длиннее
+    ASR_PARALLEL_MIN_SECONDS режутся в паузах и расшифровываются
+    параллельно в ASR_WORKERS процессах.
+    """
+    if name:
+        route, model_name = ROUTE_FIXED, name
+    else:
+        route, model_name = route_for_duration(duration)
+    cache_model = f"{model_name}+vad" if ASR_VAD else model_name
+
+    audio_hash = None
+    if cache is not None:
+        audio_hash = cache.file_hash(path)
+        cached = cache.get_entry(audio_hash, backend, cache_model, language)
+        if cached is not None:
+            return {"text": cached.get("text", ""), "segments": cached.get("segments") or []}
+
+    if not backend_available(backend):
+        return None
+
+    start = time.perf_counter()
+    audio = load_audio(path, backend)
+    audio_seconds = len(audio) / SAMPLE_RATE
+
+    if ASR_WORKERS > 1 and audio_seconds >= ASR_PARALLEL_MIN_SECONDS:
+        segments, speech_seconds = _transcribe_parallel(backend, model_name, language, audio)
+    else:
+        model = load_model(backend, model_name)
+        if model is None:
+            return None
+
+        speech = None
+        if ASR_VAD:
+            from services import vad
+            speech = vad.speech_segments(audio, SAMPLE_RATE)
+            audio = vad.trim_silence(audio, SAMPLE_RATE)
+        speech_seconds = len(audio) / SAMPLE_RATE
+
+        # Сплошная тишина — модель не вызываем
+        segments = _run_model(model, backend, audio, language) if len(audio) else []
+        if speech:
+            for segment in segments:
+                segment["start"] = vad.to_original_time(segment["start"], speech, SAMPLE_RATE)
+                segment["end"] = vad.to_original_time(segment["end"], speech, SAMPLE_RATE)
+
+    _record_route(route, audio_seconds, speech_seconds, time.perf_counter() - start)
+
+    for segment in segments:
+        segment["start"] = round(segment["start"], 2)
+        segment["end"] = round(segment["end"], 2)
+    result = {
+        "text": " ".join(segment["text"] for segment in segments if segment["text"]).strip(),
+        "segments": segments
+    }
+
+    if cache is not None:
+        cache.put(audio_hash, backend, cache_model, language, result["text"], result["segments"])
+    return result
+
+
+def transcribe_sync(path: str, backend: str = BACKEND_OPENAI, name: Optional[str] = None,
+                    language: str = ASR_LANGUAGE, cache=None, duration: Optional[float] = None) -> Optional[str]:
+    """Расшифровывает аудиофайл (блокирующий вызов), только текст"""
+    result = transcribe_detailed_sync(path, backend, name, language, cache, duration)
+    return result["text"] if result is not None else None
+
+
+def _get_thread_pool() -> ThreadPoolExecutor:
+    """Пул потоков расшифровки: не больше ASR_CONCURRENCY моделей работают одновременно"""
+    global _thread_pool
+    with _lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(max_workers=max(1, ASR_CONCURRENCY), thread_name_prefix="asr")
+        return _thread_pool
+
+
+async def transcribe_detailed(path: str, backend: str = BACKEND_OPENAI, name: Optional[str] = None,
+                              language: str = ASR_LANGUAGE, cache=None,
+                              duration: Optional[float] = None) -> Optional[Dict]:
+    """Расшифровка с таймкодами в пуле потоков, не блокируя event loop"""
+    try:
+        loop = asyncio.get_running_loop()
+        with tracing.span("whisper", file=os.path.basename(path)):
+            return await loop.run_in_executor(_get_thread_pool(), transcribe_detailed_sync, path, backend, name, language, cache, duration)
+    except Exception as e:
+        logger.error(f"❌ Ошибка расшифровки аудио {path}: {e}")
+        return None
+
+
+async def transcribe(path: str, backend: str = BACKEND_OPENAI, name: Optional[str] = None,
+                     language: str = ASR_LANGUAGE, cache=None, duration: Optional[float] = None) -> Optional[str]:
+    """Расшифровывает аудиофайл в пуле потоков, не блокируя event loop"""
+    result = await transcribe_detailed(path, backend, name, language, cache, duration)
+    return result["text"] if result is not None else None
+
+
+def route_stats() -> Dict:
+    """Статистика по маршрутам с real-time factor (время обработки / длительность аудио)"""
+    with _lock:
+        report = {}
+        for route, stats in ROUTE_STATS.items():
+            audio_seconds = stats["audio_seconds"]
+            report[route] = {
+                "count": stats["count"],
+                "audio_seconds": round(audio_seconds, 2),
+                "speech_seconds": round(stats["speech_seconds"], 2),
+                "processing_seconds": round(stats["processing_seconds"], 2),
+                "rtf": round(stats["processing_seconds"] / audio_seconds, 3) if audio_seconds else None
+            }
+        return report
+
+
+def preload_in_background(backend: str = BACKEND_OPENAI, names: Optional[list] = None) -> threading.Thread:
+    """Загружает модели всех маршрутов в фоновом потоке, чтобы первая расшифровка не ждала"""
+    names = names or list(dict.fromkeys([ASR_SHORT_MODEL, ASR_MODEL, ASR_LONG_MODEL]))
+
+    def preload():
+        for name in names:
+            load_model(backend, name)
+
+    thread = threading.Thread(target=preload, name="asr-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def startup_report() -> Dict:
+    """Отчёт о стоимости импортов и загрузки моделей"""
+    return {
+        "imports": dict(IMPORT_TIMINGS),
+        "models": dict(MODEL_LOAD_TIMINGS),
+        "loaded_models": [f"{backend}:{name}" for backend, name in _models],
+        "failed_models": {f"{backend}:{name or '*'}": error for (backend, name), error in _failed.items()},
+        "preload": ASR_PRELOAD,
+    }
@@ -0,0 +1,178 @@
+"""
+Пакетный анализ многих чатов с ограничением параллельности и приоритетами
+
+Пакет — список элементов (чатов) и корутина work(item) для одного элемента.
+Элементы всех пакетов выполняются общими слотами (BATCH_MAX_PARALLEL);
+свободный слот получает пакет с наибольшим приоритетом, у которого
+запущено меньше его собственного лимита parallelism. Прогресс и результаты
+по каждому элементу доступны по batch_id, пока пакет хранится
+(последние BATCH_KEEP завершённых).
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timezone
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_PARALLEL = int(os.getenv("BATCH_MAX_PARALLEL", "4"))
+BATCH_KEEP = int(os.getenv("BATCH_KEEP", "50"))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+CANCELLED = "cancelled"
+
+
+class Batch:
+    """Один пакет: элементы, лимит параллельности, прогресс"""
+
+    def __init__(self, items: List[str], work: Callable[[str], Awaitable], priority: int, parallelism: int,
+                 kind: str, skipped: Optional[Dict[str, str]] = None):
+        self.batch_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.work = work
+        self.priority = priority
+        self.parallelism = max(1, parallelism)
+        self.pending = deque(items)
+        self.running = 0
+        self.status = QUEUED
+        self.created_at = datetime.now(timezone.utc).isoformat()
+        self.started = time.monotonic()
+        self.finished_at: Optional[str] = None
+        self.items: Dict[str, Dict] = {item: {"status": QUEUED} for item in items}
+        for item, reason in (skipped or {}).items():
+            self.items[item] = {"status": "skipped", "reason": reason}
+        self.done_event = asyncio.Event()
+        self.order = 0
+
+    def counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for entry in self.items.values():
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        return counts
+
+    def stats(self, include_results: bool = True) -> Dict:
+        counts = self.counts()
+        finished = sum(counts.get(status, 0) for status in ("success", "error", "skipped", CANCELLED))
+        return {
+            "batch_id": self.batch_id,
+            "kind": self.kind,
+            "status": self.status,
+            "priority": self.priority,
+            "parallelism": self.parallelism,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "total": len(self.items),
+            "progress": round(finished / len(self.items), 3) if self.items else 1.0,
+            "counts": counts,
+            "items": self.items if include_results else None
+        }
+
+
+class BatchRunner:
+    """Планировщик пакетов: общий лимит слотов, приоритет, лимит на пакет"""
+
+    def __init__(self, max_parallel: int = BATCH_MAX_PARALLEL):
+        self.max_parallel = max(1, max_parallel)
+        self.running = 0
+        self.batches: Dict[str, Batch] = {}
+        self._order = 0
+
+    def submit(self, items: List[str], work: Callable[[str], Awaitable], priority: int = 0,
+               parallelism: Optional[int] = None, kind: str = "analysis",
+               skipped: Optional[Dict[str, str]] = None) -> Batch:
+        """Ставит пакет в очередь; work(item) возвращает результат элемента (dict или текст)"""
+        batch = Batch(items, work, priority, parallelism or self.max_parallel, kind, skipped)
+        self._order += 1
+        batch.order = self._order
+        self.batches[batch.batch_id] = batch
+        logger.info(f"📦 Пакет {batch.batch_id}: {len(items)} элементов, приоритет {priority}, "
+                    f"параллельно {batch.parallelism}")
+        if not batch.pending:
+            self._finish(batch)
+        self._fill()
+        return batch
+
+    def _next_batch(self) -> Optional[Batch]:
+        ready = [b for b in self.batches.values() if b.pending and b.running < b.parallelism]
+        if not ready:
+            return None
+        return min(ready, key=lambda b: (-b.priority, b.order))
+
+    def _fill(self):
+        """Запускает элементы, пока есть свободные слоты"""
+        while self.running < self.max_parallel:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            item = batch.pending.popleft()
+            batch.items[item]["status"] = RUNNING
+            batch.running += 1
+            batch.status = RUNNING
+            self.running += 1
+            asyncio.get_running_loop().create_task(self._run(batch, item))
+        metrics.JOBS_IN_PROGRESS.set(self.running, kind="batch")
+        metrics.QUEUE_DEPTH.set(sum(len(b.pending) for b in self.batches.values()), queue="batch")
+
+    async def _run(self, batch: Batch, item: str):
+        entry = batch.items[item]
+        started = time.perf_counter()
+        try:
+            result = await batch.work(item)
+            entry.update({"status": "success", "result": result})
+        except Exception as e:
+            logger.error(f"❌ Пакет {batch.batch_id}, {item}: {e}")
+            entry.update({"status": "error", "error": str(e)})
+        finally:
+            entry["elapsed_s"] = round(time.perf_counter() - started, 3)
+            batch.running -= 1
+            self.running -= 1
+            if not batch.pending and not batch.running:
+                self._finish(batch)
+            self._fill()
+
+    def _finish(self, batch: Batch):
+        if batch.status != CANCELLED:
+            batch.status = COMPLETED
+        batch.finished_at = datetime.now(timezone.utc).isoformat()
+        batch.done_event.set()
+        counts = batch.counts()
+        logger.info(f"✅ Пакет {batch.batch_id} завершён за {time.monotonic() - batch.started:.1f} с: {counts}")
+        # Храним только последние BATCH_KEEP завершённых пакетов
+        finished = [b for b in self.batches.values() if b.finished_at]
+        for old in sorted(finished, key=lambda b: b.order)[:-BATCH_KEEP]:
+            self.batches.pop(old.batch_id, None)
+
+    def cancel(self, batch_id: str) -> bool:
+        """Снимает ещё не начатые элементы пакета (запущенные доработают)"""
+        batch = self.batches.get(batch_id)
+        if batch is None or batch.finished_at:
+            return False
+        while batch.pending:
+            batch.items[batch.pending.popleft()]["status"] = CANCELLED
+        batch.status = CANCELLED
+        if not batch.running:
+            self._finish(batch)
+        return True
+
+    def get(self, batch_id: str) -> Optional[Batch]:
+        return self.batches.get(batch_id)
+
+    def stats(self) -> Dict:
+        return {
+            "max_parallel": self.max_parallel,
+            "running": self.running,
+            "batches": [b.stats(include_results=False) for b in self.batches.values()]
+        }
+
+
+# Общий планировщик процесса
+RUNNER = BatchRunner()
@@ -0,0 +1,283 @@
+"""
+Колоночный экспорт сообщений для аналитики (Arrow IPC или столбцы NumPy)
+
+Во время экспорта строки копятся в буфере и сбрасываются на диск пачками
+по COLUMNAR_BATCH, так что память не растёт с размером чата. Из async-кода
+пачки пишутся через flush_async (в пуле потоков file_io), а close — через
+file_io.run, чтобы запись не останавливала цикл событий. С pyarrow
+пишется chat_columns.arrow (Arrow IPC, читается через memory_map), без
+него — каталог chat_columns/ с сырыми столбцами фиксированной ширины и
+schema.json; столбцы открываются как np.memmap без загрузки в память.
+
+Столбцы: message_id, time (unix, с), sender, type, text_len, media_ref,
+reply_to (0 — не ответ). Строковые sender/type/media_ref в формате NumPy
+хранятся кодами, словари — в schema.json.
+"""
+
+import os
+import shutil
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from services import file_io
+from services import serialization
+
+logger = logging.getLogger(__name__)
+
+COLUMNAR_BATCH = int(os.getenv("COLUMNAR_BATCH", "10000"))
+# arrow (если установлен pyarrow) или numpy
+COLUMNAR_FORMAT = os.getenv("COLUMNAR_FORMAT", "arrow").lower()
+
+ARROW_FILE = "chat_columns.arrow"
+NUMPY_DIR = "chat_columns"
+SCHEMA_FILE = "schema.json"
+
+MESSAGE_TYPES = ("text", "voice", "video", "photo", "document")
+
+# Столбцы NumPy-формата: имя -> dtype на диске
+NUMPY_COLUMNS = {
+    "message_id": "<i8",
+    "time": "<i8",
+    "sender": "<i4",
+    "type": "i1",
+    "text_len": "<i4",
+    "media_ref": "<i4",
+    "reply_to": "<i8",
+}
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+def columnar_format(value: Optional[str] = None) -> str:
+    """Действующий формат (arrow без pyarrow заменяется на numpy)"""
+    value = (value or COLUMNAR_FORMAT).lower()
+    if value == "arrow" and pyarrow is None:
+        return "numpy"
+    if value not in ("arrow", "numpy"):
+        raise ValueError(f"Неизвестный колоночный формат: {value}")
+    return value
+
+
+def _timestamp(value: str) -> int:
+    """Время экспорта (ISO без зоны — это UTC из Telegram) в unix-секунды"""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+class ColumnarWriter:
+    """Пишет сообщения экспорта в колоночный файл пачками"""
+
+    def __init__(self, export_dir: str, batch_size: int = COLUMNAR_BATCH, fmt: Optional[str] = None):
+        self.export_dir = export_dir
+        self.batch_size = max(1, batch_size)
+        self.format = columnar_format(fmt)
+        self.rows = 0
+        self._buffer: List[Dict] = []
+        self._aborted = False
+        # Запись пачек, закрытие и отмена идут по очереди (их вызывают из пула потоков)
+        self._lock = threading.Lock()
+        self._arrow_writer = None
+        self._files = {}
+        self._dictionaries = {"sender": {}, "type": {t: i for i, t in enumerate(MESSAGE_TYPES)}, "media_ref": {}}
+
+        # Старые файлы другого формата не должны остаться рядом с новыми
+        for stale in (os.path.join(export_dir, ARROW_FILE), os.path.join(export_dir, NUMPY_DIR)):
+            if os.path.isdir(stale):
+                shutil.rmtree(stale)
+            elif os.path.exists(stale):
+                os.remove(stale)
+
+        if self.format == "arrow":
+            self.path = os.path.join(export_dir, ARROW_FILE)
+            self._schema = pyarrow.schema([
+                ("message_id", pyarrow.int64()),
+                ("time", pyarrow.timestamp("s", tz="UTC")),
+                ("sender", pyarrow.string()),
+                ("type", pyarrow.string()),
+                ("text_len", pyarrow.int32()),
+                ("media_ref", pyarrow.string()),
+                ("reply_to", pyarrow.int64()),
+            ])
+            self._arrow_writer = pyarrow.ipc.new_file(self.path, self._schema)
+        else:
+            self.path = os.path.join(export_dir, NUMPY_DIR)
+            os.makedirs(self.path, exist_ok=True)
+            self._files = {name: open(os.path.join(self.path, f"{name}.bin"), 'wb') for name in NUMPY_COLUMNS}
+
+    def append(self, msg_data: Dict) -> bool:
+        """Добавляет сообщение (dict из экспорта) в буфер; True, если пачка заполнена
+
+        Сам append на диск не пишет: заполненную пачку сбрасывает вызывающий
+        (flush или flush_async), поэтому его можно звать из колбэков цикла событий.
+        """
+        if self._aborted:
+            # Расшифровка, завершившаяся после ошибки экспорта
+            return False
+        self._buffer.append({
+            "message_id": msg_data["message_id"],
+            "time": _timestamp(msg_data["time"]),
+            "sender": msg_data.get("from") or "",
+            "type": msg_data.get("type") or "text",
+            "text_len": len(msg_data.get("transcription") or msg_data.get("text") or ""),
+            "media_ref": msg_data.get("file"),
+            "reply_to": msg_data.get("reply_to") or 0,
+        })
+        return len(self._buffer) >= self.batch_size
+
+    def _code(self, dictionary: str, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        codes = self._dictionaries[dictionary]
+        if value not in codes:
+            codes[value] = len(codes)
+        return codes[value]
+
+    def flush(self):
+        """Сбрасывает накопленную пачку на диск"""
+        rows, self._buffer = self._buffer, []
+        self._write(rows)
+
+    async def flush_async(self):
+        """Сбрасывает пачку в пуле потоков; буфер забирается в цикле событий, где в него пишут"""
+        rows, self._buffer = self._buffer, []
+        await file_io.run(self._write, rows)
+
+    def _write(self, rows: List[Dict]):
+        if not rows:
+            return
+        with self._lock:
+            self._write_rows(rows)
+
+    def _write_rows(self, rows: List[Dict]):
+        if self._aborted:
+            return
+        if self._arrow_writer is not None:
+            columns = {name: [row[name] for row in rows] for name in self._schema.names}
+            columns["reply_to"] = [value or None for value in columns["reply_to"]]
+            self._arrow_writer.write_batch(pyarrow.record_batch(columns, schema=self._schema))
+        else:
+            for name, dtype in NUMPY_COLUMNS.items():
+                if name in self._dictionaries:
+                    values = [self._code(name, row[name]) for row in rows]
+                else:
+                    values = [row[name] for row in rows]
+                self._files[name].write(np.asarray(values, dtype=dtype).tobytes())
+        self.rows += len(rows)
+
+    def close(self) -> str:
+        """Дописывает остаток и закрывает файлы; возвращает путь экспорта
+
+        Из async-кода — через file_io.run и только после последнего append.
+        """
+        self.flush()
+        with self._lock:
+            self._close_files()
+        logger.info(f"🧱 Колоночный экспорт: {self.rows} строк → {self.path}")
+        return self.path
+
+    def _close_files(self):
+        if self._arrow_writer is not None:
+            self._arrow_writer.close()
+            self._arrow_writer = None
+        elif self._files:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+            schema = {
+                "rows": self.rows,
+                "columns": NUMPY_COLUMNS,
+                "dictionaries": {
+                    name: sorted(codes, key=codes.get) for name, codes in self._dictionaries.items()
+                }
+            }
+            serialization.dump(os.path.join(self.path, SCHEMA_FILE), schema)
+
+    def abort(self):
+        """Закрывает файлы без дописывания и удаляет недописанный экспорт (при ошибке)"""
+        self._aborted = True
+        self._buffer = []
+        with self._lock:
+            self._remove_files()
+        logger.warning(f"⚠️ Колоночный экспорт прерван, удалён: {self.path}")
+
+    def _remove_files(self):
+        if self._arrow_writer is not None:
+            try:
+                self._arrow_writer.close()
+            except Exception:
+                pass
+            self._arrow_writer = None
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def columnar_path(export_dir: str) -> Optional[str]:
+    """Колоночный файл экспорта (Arrow или каталог NumPy) или None"""
+    arrow_path = os.path.join(export_dir, ARROW_FILE)
+    if os.path.exists(arrow_path):
+        return arrow_path
+    numpy_path = os.path.join(export_dir, NUMPY_DIR, SCHEMA_FILE)
+    if os.path.exists(numpy_path):
+        return os.path.dirname(numpy_path)
+    return None
+
+
+def _read_arrow(path: str) -> Dict:
+    table = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r')).read_all()
+    columns, dictionaries = {}, {}
+    for name in ("message_id", "text_len"):
+        columns[name] = table.column(name).to_numpy()
+    columns["time"] = table.column("time").cast(pyarrow.int64()).to_numpy()
+    columns["reply_to"] = table.column("reply_to").fill_null(0).to_numpy()
+    for name in ("sender", "type", "media_ref"):
+        encoded = table.column(name).combine_chunks().dictionary_encode()
+        dictionaries[name] = encoded.dictionary.to_pylist()
+        columns[name] = encoded.indices.fill_null(-1).to_numpy().astype(np.int32)
+    columns["rows"] = table.num_rows
+    columns["dictionaries"] = dictionaries
+    return columns
+
+
+def _read_numpy(path: str) -> Dict:
+    schema = serialization.load(os.path.join(path, SCHEMA_FILE))
+    rows = schema["rows"]
+    columns = {}
+    for name, dtype in schema["columns"].items():
+        if rows:
+            columns[name] = np.memmap(os.path.join(path, f"{name}.bin"), dtype=dtype, mode='r', shape=(rows,))
+        else:
+            columns[name] = np.empty(0, dtype=dtype)
+    columns["rows"] = rows
+    columns["dictionaries"] = schema["dictionaries"]
+    return columns
+
+
+def read_columns(export_dir: str) -> Optional[Dict]:
+    """Столбцы экспорта как массивы NumPy (без копирования, где это возможно)
+
+    Возвращает {столбец: массив, "rows": n, "dictionaries": {...}}; sender,
+    type и media_ref — коды в словарях (-1 — нет значения).
+    """
+    path = columnar_path(export_dir)
+    if path is None:
+        return None
+    if path.endswith(ARROW_FILE):
+        if pyarrow is None:
+            raise RuntimeError("Для чтения chat_columns.arrow нужен пакет pyarrow")
+        return _read_arrow(path)
+    return _read_numpy(path)
@@ -0,0 +1,129 @@
+"""
+Единый диспетчер новых сообщений Telegram с очередями по чатам
+"""
+
+import os
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional
+
+from telethon import events
+
+logger = logging.getLogger(__name__)
+
+# Максимальная глубина очереди одного чата
+LISTEN_QUEUE_SIZE = int(os.getenv("LISTEN_QUEUE_SIZE", "100"))
+
+MessageHandler = Callable[[object], Awaitable[None]]
+
+
+class ChatDispatcher:
+    """Один обработчик NewMessage на клиента, раздающий сообщения по очередям чатов"""
+
+    def __init__(self, client, queue_size: int = LISTEN_QUEUE_SIZE):
+        self.client = client
+        self.queue_size = queue_size
+        self.chats: Dict[int, Dict] = {}
+        self._event_filter = events.NewMessage()
+        self._registered = False
+
+    def _register(self):
+        """Регистрирует общий обработчик на клиенте (один раз)"""
+        if not self._registered:
+            self.client.add_event_handler(self._on_new_message, self._event_filter)
+            self._registered = True
+
+    def _unregister(self):
+        """Снимает общий обработчик, если слушать больше нечего"""
+        if self._registered:
+            self.client.remove_event_handler(self._on_new_message, self._event_filter)
+            self._registered = False
+
+    async def _on_new_message(self, event):
+        """Кладёт сообщение в очередь его чата, не блокируя приём обновлений"""
+        chat = self.chats.get(event.chat_id)
+        if chat is None:
+            return
+
+        try:
+            chat["queue"].put_nowait(event.message)
+            chat["received"] += 1
+        except asyncio.QueueFull:
+            chat["dropped"] += 1
+            logger.warning(f"⚠️ Очередь {chat['name']} переполнена, сообщение {event.message.id} отброшено")
+
+    async def _worker(self, chat_id: int):
+        """Последовательно обрабатывает очередь одного чата"""
+        chat = self.chats[chat_id]
+        queue = chat["queue"]
+        while True:
+            message = await queue.get()
+            try:
+                await chat["handler"](message)
+                chat["processed"] += 1
+            except Exception as e:
+                chat["errors"] += 1
+                logger.error(f"❌ Ошибка обработчика {chat['name']}: {e}")
+            finally:
+                queue.task_done()
+
+    def add_chat(self, chat_id: int, handler: MessageHandler, name: Optional[str] = None):
+        """Начинает слушать чат; повторный вызов заменяет обработчик"""
+        if chat_id in self.chats:
+            self.chats[chat_id]["handler"] = handler
+            return
+
+        self.chats[chat_id] = {
+            "name": name or str(chat_id),
+            "handler": handler,
+            "queue": asyncio.Queue(maxsize=self.queue_size),
+            "started_at": datetime.now().isoformat(),
+            "received": 0,
+            "processed": 0,
+            "dropped": 0,
+            "errors": 0,
+        }
+        self.chats[chat_id]["worker"] = asyncio.create_task(self._worker(chat_id))
+        self._register()
+        logger.info(f"👂 Чат {self.chats[chat_id]['name']} добавлен в диспетчер")
+
+    async def remove_chat(self, chat_id: int) -> bool:
+        """Перестаёт слушать чат и останавливает его обработчик"""
+        chat = self.chats.pop(chat_id, None)
+        if chat is None:
+            return False
+
+        chat["worker"].cancel()
+        try:
+            await chat["worker"]
+        except asyncio.CancelledError:
+            pass
+
+        if not self.chats:
+            self._unregister()
+        logger.info(f"🛑 Чат {chat['name']} удалён из диспетчера")
+        return True
+
+    async def close(self):
+        """Останавливает все обработчики"""
+        for chat_id in list(self.chats):
+            await self.remove_chat(chat_id)
+
+    def stats(self) -> Dict:
+        """Глубина очередей и счётчики по каждому чату"""
+        return {
+            "queue_size": self.queue_size,
+            "chats": {
+                chat["name"]: {
+                    "chat_id": chat_id,
+                    "started_at": chat["started_at"],
+                    "queue_depth": chat["queue"].qsize(),
+                    "received": chat["received"],
+                    "processed": chat["processed"],
+                    "dropped": chat["dropped"],
+                    "errors": chat["errors"],
+                }
+                for chat_id, chat in self.chats.items()
+            },
+        }
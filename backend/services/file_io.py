@@ -0,0 +1,83 @@
+"""
+Файловый ввод-вывод вне цикла событий
+
+Чтение и запись документов и текстов (открытие, разбор, сериализация) идут в
+ограниченном пуле потоков, поэтому разбор многомегабайтного live-файла
+не останавливает остальные запросы. Один переход в поток покрывает и
+системные вызовы, и json.load/json.dump — aiofiles переносит в поток только
+чтение байтов, а разбор всё равно шёл бы в цикле событий.
+
+FILE_IO_THREADS=0 выполняет всё прямо в цикле событий (как раньше) —
+для сравнения в benchmarks/bench_loop_lag.py.
+"""
+
+import os
+import asyncio
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from services import serialization
+
+# Потоков для файловых операций (0 — выполнять в цикле событий)
+FILE_IO_THREADS = int(os.getenv("FILE_IO_THREADS", "4"))
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=FILE_IO_THREADS, thread_name_prefix="file_io")
+    return _pool
+
+
+async def run(func: Callable, *args, **kwargs) -> Any:
+    """Выполняет блокирующую функцию (чтение, запись, разбор файла) в пуле потоков"""
+    if FILE_IO_THREADS <= 0:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(), functools.partial(func, *args, **kwargs))
+
+
+def load_text(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def load_texts(paths: List[str]) -> Dict[str, Union[str, Exception]]:
+    """Тексты многих небольших файлов за один заход в поток (ошибка — вместо текста)"""
+    texts: Dict[str, Union[str, Exception]] = {}
+    for path in paths:
+        try:
+            texts[path] = load_text(path)
+        except Exception as e:
+            texts[path] = e
+    return texts
+
+
+def dump_text(path: str, text: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+async def read(path: str, default: Any = None) -> Any:
+    """Документ (JSON или msgpack) из файла или default, если файла нет"""
+    return await run(serialization.load, path, default)
+
+
+async def write(path: str, data: Any, fmt: str = serialization.JSON, pretty: bool = False):
+    """Атомарная запись документа в формате fmt (см. services/serialization.py)"""
+    await run(serialization.dump, path, data, fmt, pretty)
+
+
+async def read_text(path: str) -> str:
+    return await run(load_text, path)
+
+
+async def write_text(path: str, text: str):
+    await run(dump_text, path, text)
@@ -0,0 +1,135 @@
+"""
+Параллельная загрузка истории по диапазонам id сообщений
+
+Диапазон id от самого нового сообщения вниз делится на шарды, каждый
+шард читается своим обходом (offset_id/min_id) через общий ограничитель
+аккаунта, а результат отдаётся в исходном порядке — от новых к старым,
+как у iter_messages.
+"""
+
+import os
+import asyncio
+import logging
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+
+from telethon.tl.types import (
+    InputMessagesFilterDocument, InputMessagesFilterPhotos,
+    InputMessagesFilterRoundVoice, InputMessagesFilterVideo
+)
+
+logger = logging.getLogger(__name__)
+
+# Число шардов по умолчанию (1 — обычный последовательный обход)
+HISTORY_SHARDS = int(os.getenv("HISTORY_SHARDS", "1"))
+# Меньше этого числа id на шард делить диапазон нет смысла
+MIN_SHARD_SIZE = int(os.getenv("MIN_SHARD_SIZE", "1000"))
+
+# Серверные фильтры поиска: Telegram отдаёт только сообщения нужного типа
+MEDIA_FILTERS = {
+    "voice": InputMessagesFilterRoundVoice,   # голосовые и кружки
+    "video": InputMessagesFilterVideo,
+    "photo": InputMessagesFilterPhotos,
+    "document": InputMessagesFilterDocument,
+}
+
+_DONE = object()
+
+
+def split_range(low: int, high: int, shards: int) -> List[Tuple[int, int]]:
+    """Делит id (low, high] на шарды (min_id, max_id] — от новых к старым"""
+    shards = max(1, min(shards, (high - low) // MIN_SHARD_SIZE or 1))
+    step = (high - low) / shards
+    bounds = [high - round(step * i) for i in range(shards)] + [low]
+    return [(bounds[i + 1], bounds[i]) for i in range(shards)]
+
+
+async def _fetch_shard(client, entity, min_id: int, max_id: int, queue: asyncio.Queue, kwargs):
+    """Читает сообщения с id в (min_id, max_id] в очередь шарда"""
+    try:
+        async for message in client.iter_messages(entity, offset_id=max_id + 1, min_id=min_id, **kwargs):
+            queue.put_nowait(message)
+        queue.put_nowait(_DONE)
+    except Exception as e:
+        queue.put_nowait(e)
+
+
+async def iter_history(client, entity, limit: Optional[int] = None, shards: Optional[int] = None,
+                       **kwargs) -> AsyncIterator:
+    """Сообщения чата от новых к старым; при shards > 1 — параллельными диапазонами
+
+    Сообщения шардов буферизуются в памяти до своей очереди выдачи, так что
+    расход памяти не больше, чем у списка всей загруженной истории.
+    """
+    shards = HISTORY_SHARDS if shards is None else shards
+    if shards <= 1 or kwargs.get('reverse') or kwargs.get('offset_id') or kwargs.get('ids') is not None:
+        async for message in client.iter_messages(entity, limit=limit, **kwargs):
+            yield message
+        return
+
+    newest = await client.get_messages(entity, limit=1)
+    if not newest:
+        return
+    high = newest[0].id
+    # С лимитом делим только последние limit id; пропуски (удалённые) дочитываются ниже
+    low = max(0, high - limit) if limit is not None else 0
+    ranges = split_range(low, high, shards)
+    logger.info(f"🧩 Загрузка истории {len(ranges)} шардами: id {low + 1}..{high}")
+
+    queues = [asyncio.Queue() for _ in ranges]
+    tasks = [
+        asyncio.create_task(_fetch_shard(client, entity, min_id, max_id, queue, kwargs))
+        for (min_id, max_id), queue in zip(ranges, queues)
+    ]
+    returned = 0
+    try:
+        for queue in queues:
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if limit is not None and returned >= limit:
+                    return
+                returned += 1
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Дочитываем недостающее до лимита ниже разделённого диапазона
+    if limit is not None and returned < limit and low > 0:
+        async for message in client.iter_messages(entity, limit=limit - returned, offset_id=low + 1, **kwargs):
+            yield message
+
+
+async def count_messages(client, entity, limit: Optional[int] = None, filter=None) -> int:
+    """Число сообщений (с фильтром — подходящих) одним запросом через total"""
+    result = await client.get_messages(entity, limit=0, filter=filter)
+    total = getattr(result, 'total', None) or 0
+    return min(total, limit) if limit is not None else total
+
+
+async def count_media_messages(client, entity, media_types: Iterable[str]) -> int:
+    """Сумма total по фильтрам (оценка сверху: фильтры могут пересекаться)"""
+    counts = await asyncio.gather(*(
+        count_messages(client, entity, filter=MEDIA_FILTERS[media_type]) for media_type in media_types
+    ))
+    return sum(counts)
+
+
+async def iter_media_messages(client, entity, media_types: Iterable[str],
+                              shards: Optional[int] = None) -> AsyncIterator:
+    """Только медиасообщения выбранных типов — по серверному фильтру на каждый тип
+
+    Число запросов пропорционально числу найденных сообщений, а не всей
+    истории; сообщение, попавшее под несколько фильтров, выдаётся один раз.
+    """
+    seen = set()
+    for media_type in media_types:
+        async for message in iter_history(client, entity, shards=shards, filter=MEDIA_FILTERS[media_type]):
+            if message.id in seen:
+                continue
+            seen.add(message.id)
+            yield message
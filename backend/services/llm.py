@@ -1,5 +1,35 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional, Tuple
+
 import httpx
 
+from services import metrics
+from services.llm_pool import POOL, is_backend_error
+from services.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Адреса Ollama (или совместимого сервера, например benchmarks/ollama_stub.py)
+# задаются в services/llm_pool.py: OLLAMA_URL или OLLAMA_BACKENDS
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))
+# Сколько раз повторить запрос на другом бэкенде после ошибки сервера
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "1"))
+# Сколько модель остаётся загруженной после запроса ("30m", "-1" — всегда)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Направлять промпты с общим префиксом (инструкции, сводки) на один бэкенд,
+# где префикс уже в KV-кэше Ollama; сколько префиксов помнить
+LLM_PREFIX_AFFINITY = os.getenv("LLM_PREFIX_AFFINITY", "1").lower() in ("1", "true", "yes")
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", "128"))
+# Добавлять ли сводку статистики (services/analytics.py) в контекст LLM
+ANALYTICS_IN_PROMPT = os.getenv("ANALYTICS_IN_PROMPT", "0").lower() in ("1", "true", "yes")
+# Модель эмбеддингов для поиска релевантных сообщений
+EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
+
 PROMPT_TEMPLATE = '''Ты — аналитик общения и психолог.
 Проанализируй следующую переписку между пользователями. Выдели:
 1. Характеристика каждого участника (темперамент, стиль, эмоции, роль)
@@ -16,22 +46,155 @@ PROMPT_TEMPLATE = '''Ты — аналитик общения и психоло
 def build_prompt(text: str) -> str:
     return PROMPT_TEMPLATE.format(text=text)
 
-async def analyze_with_ollama(prompt: str, model: str) -> str:
-    url = "http://localhost:11434/api/generate"
+def keep_alive():
+    """keep_alive для Ollama: число секунд или строка длительности"""
+    try:
+        return int(OLLAMA_KEEP_ALIVE)
+    except ValueError:
+        return OLLAMA_KEEP_ALIVE
+
+async def _post(path: str, payload: dict, tenant: str = "default", prefer: Optional[str] = None) -> Tuple[dict, str]:
+    """POST на бэкенд пула; возвращает ответ и адрес бэкенда"""
+    for attempt in range(LLM_RETRIES + 1):
+        try:
+            async with POOL.slot(tenant, prefer) as backend:
+                async with httpx.AsyncClient() as client:
+                    response = await client.post(f"{backend.url}{path}", json=payload, timeout=OLLAMA_TIMEOUT)
+                    response.raise_for_status()
+                    return response.json(), backend.url
+        except Exception as e:
+            if attempt >= LLM_RETRIES or not is_backend_error(e) or len(POOL.backends) < 2:
+                raise
+            logger.warning(f"⚠️ Ошибка LLM-бэкенда ({path}): {e}, повторяем на другом")
+
+async def post_to_backend(path: str, payload: dict, tenant: str = "default") -> dict:
+    """POST на наименее загруженный бэкенд пула (с повтором на другом при ошибке сервера)"""
+    return (await _post(path, payload, tenant))[0]
+
+# Бэкенд, последним обработавший префикс: (модель, хэш префикса) -> адрес
+_prefix_backends: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+def _prefix_key(prefix: str, model: str) -> Tuple[str, str]:
+    return (model, hashlib.sha1(prefix.encode("utf-8")).hexdigest())
+
+def _prefix_backend(prefix: str, model: str) -> Optional[str]:
+    """Бэкенд, у которого префикс скорее всего ещё в KV-кэше (None — неизвестен)"""
+    key = _prefix_key(prefix, model)
+    backend_url = _prefix_backends.get(key)
+    metrics.CACHE_REQUESTS.inc(cache="llm_prefix", result="miss" if backend_url is None else "hit")
+    if backend_url is not None:
+        _prefix_backends.move_to_end(key)
+    return backend_url
+
+def _remember_prefix(prefix: str, model: str, backend_url: str):
+    key = _prefix_key(prefix, model)
+    _prefix_backends[key] = backend_url
+    _prefix_backends.move_to_end(key)
+    while len(_prefix_backends) > PREFIX_CACHE_SIZE:
+        _prefix_backends.popitem(last=False)
+
+# Одинаковые одновременные генерации (двойной клик, несколько вкладок) идут в модель один раз
+GENERATIONS = SingleFlight("llm_single_flight")
+
+async def analyze_with_ollama(prompt: str, model: str, tenant: str = "default", prefix: Optional[str] = None) -> str:
+    """Генерация через пул бэкендов; tenant — владелец запроса для честной очереди (чат, API)
+
+    prefix — неизменная часть промпта перед prompt. Промпт уходит целиком,
+    префиксом вперёд, а при LLM_PREFIX_AFFINITY — на бэкенд, который
+    обрабатывал этот префикс последним: Ollama сама берёт совпадающее начало
+    промпта из KV-кэша и заново считает только остаток.
+    Одновременные запросы с теми же моделью и промптом получают один ответ.
+    """
+    return await GENERATIONS.run((model, prefix, prompt), lambda: _generate(prompt, model, tenant, prefix))
+
+async def _generate(prompt: str, model: str, tenant: str, prefix: Optional[str]) -> str:
     payload = {
         "model": model,
-        "prompt": prompt,
-        "stream": False
+        "prompt": prompt if prefix is None else prefix + prompt,
+        "stream": False,
+        "keep_alive": keep_alive()
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json=payload, timeout=120)
-        response.raise_for_status()
-        data = response.json()
-        return data.get("response") or data.get("result") or str(data)
+    start = time.perf_counter()
+    routed = bool(prefix) and LLM_PREFIX_AFFINITY
+    try:
+        data, backend_url = await _post("/api/generate", payload, tenant,
+                                        _prefix_backend(prefix, model) if routed else None)
+        if routed:
+            _remember_prefix(prefix, model, backend_url)
+    except Exception:
+        metrics.LLM_REQUESTS.inc(model=model, status="error")
+        raise
+    finally:
+        metrics.LLM_LATENCY.observe(time.perf_counter() - start, model=model)
+    
+    metrics.LLM_REQUESTS.inc(model=model, status="ok")
+    metrics.LLM_PROMPT_TOKENS.inc(data.get("prompt_eval_count", 0), model=model)
+    metrics.LLM_COMPLETION_TOKENS.inc(data.get("eval_count", 0), model=model)
+    return data.get("response") or data.get("result") or str(data)
 
-async def analyze_text(text: str, model: str) -> str:
+async def stream_with_ollama(prompt: str, model: str, tenant: str = "default") -> AsyncIterator[str]:
+    """Токены ответа по мере генерации; одинаковые одновременные запросы делят один поток"""
+    async for token in GENERATIONS.stream((model, None, prompt), lambda: _generate_stream(prompt, model, tenant)):
+        yield token
+
+async def _generate_stream(prompt: str, model: str, tenant: str) -> AsyncIterator[str]:
+    payload = {"model": model, "prompt": prompt, "stream": True, "keep_alive": keep_alive()}
+    start = time.perf_counter()
+    final = {}
+    try:
+        async with POOL.slot(tenant) as backend:
+            async with httpx.AsyncClient() as client:
+                async with client.stream("POST", f"{backend.url}/api/generate", json=payload,
+                                         timeout=OLLAMA_TIMEOUT) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.strip():
+                            continue
+                        chunk = json.loads(line)
+                        if chunk.get("response"):
+                            yield chunk["response"]
+                        if chunk.get("done"):
+                            final = chunk
+    except Exception:
+        metrics.LLM_REQUESTS.inc(model=model, status="error")
+        raise
+    finally:
+        metrics.LLM_LATENCY.observe(time.perf_counter() - start, model=model)
+    
+    metrics.LLM_REQUESTS.inc(model=model, status="ok")
+    metrics.LLM_PROMPT_TOKENS.inc(final.get("prompt_eval_count", 0), model=model)
+    metrics.LLM_COMPLETION_TOKENS.inc(final.get("eval_count", 0), model=model)
+
+async def embed_with_ollama(texts: List[str], model: str = EMBED_MODEL, tenant: str = "default") -> List[List[float]]:
+    """Эмбеддинги текстов одним запросом /api/embed (старые Ollama — /api/embeddings по одному)"""
+    start = time.perf_counter()
+    try:
+        try:
+            embeddings = (await post_to_backend("/api/embed", {"model": model, "input": texts,
+                                                               "keep_alive": keep_alive()}, tenant))["embeddings"]
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            embeddings = [
+                (await post_to_backend("/api/embeddings", {"model": model, "prompt": text}, tenant))["embedding"]
+                for text in texts
+            ]
+    except Exception:
+        metrics.LLM_REQUESTS.inc(model=model, status="error")
+        raise
+    finally:
+        metrics.LLM_LATENCY.observe(time.perf_counter() - start, model=model)
+    
+    metrics.LLM_REQUESTS.inc(model=model, status="ok")
+    return embeddings
+
+async def analyze_text(text: str, model: str, tenant: str = "api") -> str:
     prompt = build_prompt(text)
-    return await analyze_with_ollama(prompt, model)
+    return await analyze_with_ollama(prompt, model, tenant)
+
+async def analyze_text_stream(text: str, model: str, tenant: str = "api") -> AsyncIterator[str]:
+    async for token in stream_with_ollama(build_prompt(text), model, tenant):
+        yield token
 
 # --- Заглушка для получения сообщений из Telegram ---
 def get_messages():
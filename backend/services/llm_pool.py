@@ -0,0 +1,257 @@
+"""
+Пул LLM-бэкендов (несколько серверов Ollama) с общей очередью запросов
+
+OLLAMA_BACKENDS — список адресов через запятую, у каждого можно указать
+лимит одновременных запросов: "http://gpu1:11434|4,http://gpu2:11434|2".
+Без него используется один OLLAMA_URL с лимитом OLLAMA_CONCURRENCY.
+
+Запрос получает бэкенд с наименьшей относительной загрузкой. Если все
+заняты, запрос ждёт в очереди своего «владельца» (чата, аккаунта, API):
+свободные места раздаются владельцам по кругу, поэтому один чат с сотней
+запросов не задерживает остальные. Бэкенд после LLM_EJECT_FAILURES ошибок
+подряд или неудачной проверки /api/tags исключается из выдачи, пока
+фоновая проверка не увидит его снова живым.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, List, Optional
+
+import httpx
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434").rstrip("/")
+OLLAMA_BACKENDS = os.getenv("OLLAMA_BACKENDS", "")
+# Одновременных запросов к бэкенду без явного лимита
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "4"))
+# Ошибок подряд до исключения бэкенда и период проверки /api/tags, с
+LLM_EJECT_FAILURES = int(os.getenv("LLM_EJECT_FAILURES", "3"))
+LLM_HEALTH_INTERVAL = float(os.getenv("LLM_HEALTH_INTERVAL", "15"))
+LLM_HEALTH_TIMEOUT = float(os.getenv("LLM_HEALTH_TIMEOUT", "5"))
+
+LLM_BACKEND_ACTIVE = metrics.gauge("llm_backend_active", "Выполняющиеся запросы на LLM-бэкенде", ["backend"])
+LLM_BACKEND_HEALTHY = metrics.gauge("llm_backend_healthy", "Бэкенд в выдаче (1) или исключён (0)", ["backend"])
+
+
+class Backend:
+    """Один сервер Ollama: лимит, загрузка и состояние"""
+
+    def __init__(self, url: str, limit: int = OLLAMA_CONCURRENCY):
+        self.url = url.rstrip("/")
+        self.limit = max(1, limit)
+        self.active = 0
+        self.healthy = True
+        self.failures = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency: Optional[float] = None
+
+    @property
+    def load(self) -> float:
+        return self.active / self.limit
+
+    def stats(self) -> Dict:
+        return {
+            "url": self.url,
+            "limit": self.limit,
+            "active": self.active,
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_s": round(self.latency, 3) if self.latency is not None else None
+        }
+
+
+def parse_backends(value: str = OLLAMA_BACKENDS) -> List[Backend]:
+    """Бэкенды из строки "url|лимит,url" (пусто — один OLLAMA_URL)"""
+    backends = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        url, _, limit = item.partition("|")
+        backends.append(Backend(url, int(limit) if limit else OLLAMA_CONCURRENCY))
+    return backends or [Backend(OLLAMA_URL)]
+
+
+class LLMPool:
+    """Выдаёт бэкенды запросам: наименее загруженный, честная очередь по владельцам"""
+
+    def __init__(self, backends: List[Backend]):
+        self.backends = backends
+        self._waiters: Dict[str, deque] = {}
+        self._turns: deque = deque()
+        self._health_task: Optional[asyncio.Task] = None
+        for backend in backends:
+            LLM_BACKEND_HEALTHY.set(1, backend=backend.url)
+
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _pick(self) -> Optional[Backend]:
+        """Наименее загруженный бэкенд со свободным местом
+
+        Если исключены все бэкенды, выбираем среди них: запрос быстрее
+        получит ошибку, чем будет ждать проверки здоровья.
+        """
+        candidates = [b for b in self.backends if b.healthy] or self.backends
+        free = [b for b in candidates if b.active < b.limit]
+        if not free:
+            return None
+        return min(free, key=lambda b: (b.load, b.latency or 0.0))
+
+    def _take(self, backend: Backend) -> Backend:
+        backend.active += 1
+        backend.requests += 1
+        LLM_BACKEND_ACTIVE.set(backend.active, backend=backend.url)
+        return backend
+
+    def _dispatch(self):
+        """Раздаёт свободные места ожидающим владельцам по кругу"""
+        while self._turns:
+            backend = self._pick()
+            if backend is None:
+                break
+            tenant = self._turns.popleft()
+            waiters = self._waiters[tenant]
+            future = waiters.popleft()
+            if waiters:
+                self._turns.append(tenant)
+            else:
+                del self._waiters[tenant]
+            if not future.done():
+                future.set_result(self._take(backend))
+        metrics.QUEUE_DEPTH.set(self.queued(), queue="llm")
+
+    async def acquire(self, tenant: str = "default", prefer: Optional[str] = None) -> Backend:
+        """Ждёт свободное место на одном из бэкендов
+
+        prefer — адрес бэкенда, на котором уже вычислен префикс промпта
+        (KV-кэш): он берётся, если исправен и свободен.
+        """
+        self._ensure_health_checks()
+        if not self._turns:
+            preferred = next((b for b in self.backends if b.url == prefer), None)
+            if preferred is not None and preferred.healthy and preferred.active < preferred.limit:
+                return self._take(preferred)
+            backend = self._pick()
+            if backend is not None:
+                return self._take(backend)
+
+        future = asyncio.get_running_loop().create_future()
+        if tenant not in self._waiters:
+            self._waiters[tenant] = deque()
+            self._turns.append(tenant)
+        self._waiters[tenant].append(future)
+        metrics.QUEUE_DEPTH.set(self.queued(), queue="llm")
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Место уже выдано, но запрос отменён — возвращаем его
+                self.release(future.result())
+            raise
+
+    def slot(self, tenant: str = "default", prefer: Optional[str] = None) -> "_Slot":
+        """async with pool.slot(tenant) as backend: ... — место на время запроса"""
+        return _Slot(self, tenant, prefer)
+
+    def release(self, backend: Backend, ok: Optional[bool] = None, elapsed: Optional[float] = None):
+        """Возвращает место; ok=False — ошибка бэкенда, ok=None — не учитывать"""
+        backend.active -= 1
+        LLM_BACKEND_ACTIVE.set(backend.active, backend=backend.url)
+        if ok:
+            backend.failures = 0
+            if elapsed is not None:
+                backend.latency = elapsed if backend.latency is None else 0.8 * backend.latency + 0.2 * elapsed
+        elif ok is False:
+            backend.errors += 1
+            backend.failures += 1
+            if backend.healthy and backend.failures >= LLM_EJECT_FAILURES and len(self.backends) > 1:
+                self._set_health(backend, False)
+        self._dispatch()
+
+    def _set_health(self, backend: Backend, healthy: bool):
+        if backend.healthy != healthy:
+            backend.healthy = healthy
+            backend.failures = 0
+            LLM_BACKEND_HEALTHY.set(int(healthy), backend=backend.url)
+            if healthy:
+                logger.info(f"✅ LLM-бэкенд {backend.url} снова в выдаче")
+                self._dispatch()
+            else:
+                logger.warning(f"⚠️ LLM-бэкенд {backend.url} исключён из выдачи")
+
+    async def check(self, backend: Backend) -> bool:
+        """Проверяет бэкенд запросом /api/tags"""
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await client.get(f"{backend.url}/api/tags", timeout=LLM_HEALTH_TIMEOUT)
+                response.raise_for_status()
+            healthy = True
+        except Exception:
+            healthy = False
+        # Единственный бэкенд не исключаем: запросам всё равно некуда идти
+        self._set_health(backend, healthy or len(self.backends) == 1)
+        return healthy
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(LLM_HEALTH_INTERVAL)
+            await asyncio.gather(*(self.check(backend) for backend in self.backends))
+
+    def _ensure_health_checks(self):
+        """Запускает фоновую проверку в текущем цикле событий (при нескольких бэкендах)"""
+        if len(self.backends) < 2 or LLM_HEALTH_INTERVAL <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        task = self._health_task
+        if task is None or task.done() or task.get_loop() is not loop:
+            self._health_task = loop.create_task(self._health_loop())
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self.queued(),
+            "queued_by_tenant": {tenant: len(waiters) for tenant, waiters in self._waiters.items()},
+            "backends": [backend.stats() for backend in self.backends]
+        }
+
+
+class _Slot:
+    """Место на бэкенде; ошибки сервера учитываются для исключения бэкенда"""
+
+    def __init__(self, pool: LLMPool, tenant: str, prefer: Optional[str] = None):
+        self.pool = pool
+        self.tenant = tenant
+        self.prefer = prefer
+        self.backend: Optional[Backend] = None
+        self.started = 0.0
+
+    async def __aenter__(self) -> Backend:
+        self.backend = await self.pool.acquire(self.tenant, self.prefer)
+        self.started = time.perf_counter()
+        return self.backend
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc is None:
+            ok = True
+        else:
+            ok = False if is_backend_error(exc) else None
+        self.pool.release(self.backend, ok, time.perf_counter() - self.started)
+        return False
+
+
+def is_backend_error(error: Optional[BaseException]) -> bool:
+    """Ошибка сервера (сеть, таймаут, 5xx), а не запроса (4xx) или отмены"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (httpx.TransportError, OSError))
+
+# Общий пул процесса
+POOL = LLMPool(parse_backends())
@@ -0,0 +1,92 @@
+"""
+Монитор задержки цикла событий
+
+Фоновая задача засыпает на LOOP_LAG_INTERVAL и измеряет, насколько позже
+она проснулась. Задержка — время, в течение которого цикл был занят чем-то
+блокирующим (разбор большого файла, тяжёлые вычисления) и не обслуживал
+остальные запросы.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Optional
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+# Сколько последних замеров хранить для перцентилей
+LOOP_LAG_WINDOW = int(os.getenv("LOOP_LAG_WINDOW", "600"))
+# Задержка, о которой пишем предупреждение в лог, с
+LOOP_LAG_WARN = float(os.getenv("LOOP_LAG_WARN", "0.5"))
+
+LOOP_LAG = metrics.histogram("event_loop_lag_seconds", "Задержка цикла событий",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+def _percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class LoopLagMonitor:
+    """Замеры задержки цикла событий в скользящем окне"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, window: int = LOOP_LAG_WINDOW):
+        self.interval = interval
+        self.samples: deque = deque(maxlen=window)
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запускает замеры в текущем цикле событий (повторный вызов ничего не делает)"""
+        if self.interval <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        task = self._task
+        if task is None or task.done() or task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def reset(self):
+        self.samples.clear()
+        self.max_lag = 0.0
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, time.perf_counter() - started - self.interval))
+
+    def record(self, lag: float):
+        self.samples.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        LOOP_LAG.observe(lag)
+        if lag >= LOOP_LAG_WARN:
+            logger.warning(f"🐢 Цикл событий был заблокирован на {lag * 1000:.0f} мс")
+
+    def stats(self) -> Dict:
+        samples = list(self.samples)
+        if not samples:
+            return {"samples": 0, "interval_s": self.interval}
+        return {
+            "samples": len(samples),
+            "interval_s": self.interval,
+            "last_ms": round(samples[-1] * 1000, 2),
+            "p50_ms": round(_percentile(samples, 0.5) * 1000, 2),
+            "p99_ms": round(_percentile(samples, 0.99) * 1000, 2),
+            "max_window_ms": round(max(samples) * 1000, 2),
+            "max_ms": round(self.max_lag * 1000, 2)
+        }
+
+
+# Общий монитор процесса
+MONITOR = LoopLagMonitor()
@@ -0,0 +1,181 @@
+"""
+Докачиваемое скачивание медиа: .part-файл, учёт скачанных диапазонов, проверка размера
+
+Файл сначала пишется в <path>.part, рядом в <path>.part.json хранятся
+скачанные диапазоны байт. После обрыва скачивание продолжается с конца
+последнего записанного куска, а в итоговый путь файл попадает только
+атомарным переименованием после сверки размера с метаданными документа.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional
+
+from services import file_io
+from services import metrics
+from services import tracing
+from services import serialization
+from services.rate_limiter import flood_wait_seconds
+from services.telegram_client import media_type_of
+
+logger = logging.getLogger(__name__)
+
+# Размер куска (Telegram принимает кратные 4 КБ до 512 КБ)
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(512 * 1024)))
+# Файлы меньше этого размера скачиваются одним запросом (тоже через .part)
+RESUMABLE_MIN_SIZE = int(os.getenv("RESUMABLE_MIN_SIZE", str(512 * 1024)))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+# Журнал диапазонов сохраняется раз в столько кусков или секунд (и при выходе)
+STATE_SAVE_CHUNKS = int(os.getenv("STATE_SAVE_CHUNKS", "16"))
+STATE_SAVE_INTERVAL = float(os.getenv("STATE_SAVE_INTERVAL", "2"))
+
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".part.json"
+
+
+class IncompleteDownloadError(Exception):
+    """Размер скачанного файла не совпал с размером из метаданных"""
+
+
+def expected_size(media) -> Optional[int]:
+    """Размер из метаданных документа (у фото его нет)"""
+    size = getattr(media, 'size', None)
+    if isinstance(size, int) and getattr(media, 'mime_type', None) is not None:
+        return size
+    return None
+
+
+def is_complete(path: str, media) -> bool:
+    """Файл уже скачан полностью (размер совпадает с метаданными, если они есть)"""
+    if not os.path.exists(path):
+        return False
+    size = expected_size(media)
+    return size is None or os.path.getsize(path) == size
+
+
+def _merge(ranges: List[List[int]]) -> List[List[int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _load_state(state_path: str, size: int) -> List[List[int]]:
+    """Скачанные диапазоны [начало, конец) из служебного файла"""
+    try:
+        state = serialization.load(state_path, {})
+        if state.get("size") == size:
+            return _merge(state.get("ranges", []))
+    except (OSError, ValueError):
+        pass
+    return []
+
+
+def _save_state(state_path: str, size: int, ranges: List[List[int]]):
+    serialization.dump(state_path, {"size": size, "chunk_size": DOWNLOAD_CHUNK_SIZE, "ranges": ranges},
+                       serialization.store_format())
+
+
+def _open_part(part_path: str, offset: int):
+    f = open(part_path, 'r+b' if os.path.exists(part_path) else 'wb')
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def _persist(f, state_path: str, size: int, ranges: List[List[int]]):
+    """Сбрасывает записанное на диск и только потом отмечает его в журнале"""
+    f.flush()
+    _save_state(state_path, size, ranges)
+
+
+async def _download_chunks(client, media, part_path: str, state_path: str, size: int):
+    """Докачивает .part с конца непрерывно скачанного начала файла
+
+    Запись кусков и журнала идёт в пуле файловых операций; журнал
+    обновляется раз в STATE_SAVE_CHUNKS кусков или STATE_SAVE_INTERVAL
+    секунд и при выходе, в том числе по ошибке. После обрыва перекачивается
+    не больше, чем скачано с последнего сохранения журнала.
+    """
+    ranges = _load_state(state_path, size)
+    offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+    # Выравниваем по куску: всё, что дальше записанного в журнал, перекачиваем
+    offset -= offset % DOWNLOAD_CHUNK_SIZE
+    ranges = [[0, offset]] if offset else []
+    if offset:
+        logger.info(f"⏯️ Докачка {os.path.basename(part_path)} с {offset} из {size} байт")
+
+    f = await file_io.run(_open_part, part_path, offset)
+    unsaved = 0
+    saved_at = time.monotonic()
+    try:
+        async for chunk in client.iter_download(media, offset=offset, request_size=DOWNLOAD_CHUNK_SIZE,
+                                                chunk_size=DOWNLOAD_CHUNK_SIZE, file_size=size):
+            await file_io.run(f.write, chunk)
+            ranges = _merge(ranges + [[offset, offset + len(chunk)]])
+            offset += len(chunk)
+            unsaved += 1
+            if offset >= size:
+                break
+            if unsaved >= STATE_SAVE_CHUNKS or time.monotonic() - saved_at >= STATE_SAVE_INTERVAL:
+                await file_io.run(_persist, f, state_path, size, ranges)
+                unsaved = 0
+                saved_at = time.monotonic()
+    finally:
+        # Файл скачан целиком — журнал не нужен, его удалит download_resumable
+        if unsaved and offset < size:
+            await file_io.run(_persist, f, state_path, size, ranges)
+        await file_io.run(f.close)
+
+
+async def download_resumable(client, media, path: str) -> str:
+    """Скачивает медиа в path через .part-файл с докачкой и проверкой размера"""
+    if is_complete(path, media):
+        return path
+    size = expected_size(media)
+    if os.path.exists(path):
+        # Неполный файл от прежнего прямого скачивания — доверять ему нельзя
+        logger.warning(f"⚠️ {os.path.basename(path)}: {os.path.getsize(path)} байт вместо {size}, скачиваем заново")
+        os.remove(path)
+
+    part_path = path + PART_SUFFIX
+    state_path = path + STATE_SUFFIX
+    start = time.perf_counter()
+
+    if size is None or size < RESUMABLE_MIN_SIZE or not hasattr(client, 'iter_download'):
+        result = await client.download_media(media, part_path)
+        if isinstance(result, str) and result != part_path:
+            part_path = result
+    else:
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                with tracing.span("media_download", type=media_type_of(media)):
+                    await _download_chunks(client, media, part_path, state_path, size)
+                break
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+            except Exception as e:
+                # FloodWait уже учтён ограничителем: следующий запрос дождётся паузы
+                if flood_wait_seconds(e) is None:
+                    raise
+                error = e
+            if attempt == DOWNLOAD_RETRIES:
+                raise error
+            logger.warning(f"🔁 Обрыв скачивания {os.path.basename(path)} ({error}), попытка {attempt + 1}")
+        metrics.observe_media(media_type_of(media), part_path, time.perf_counter() - start)
+
+    if not os.path.exists(part_path):
+        raise IncompleteDownloadError(f"{os.path.basename(path)}: файл не получен")
+    actual = os.path.getsize(part_path)
+    if size is not None and actual != size:
+        raise IncompleteDownloadError(f"{os.path.basename(path)}: {actual} байт вместо {size}")
+
+    os.replace(part_path, path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return path
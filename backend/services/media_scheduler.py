@@ -0,0 +1,175 @@
+"""
+Планировщик скачивания медиа: приоритеты, лимиты объёма и отложенное видео
+
+Медиа задачи ставятся в очередь с приоритетом (голосовые > фото >
+документы > видео) и скачиваются несколькими воркерами, поэтому
+голосовые для расшифровки не ждут больших видео. Файлы больше лимита
+пропускаются, общий объём задачи ограничен, а отложенные типы (видео)
+сохраняются только как метаданные в deferred_media.json — их можно
+докачать позже.
+"""
+
+import os
+import asyncio
+import itertools
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from services import serialization
+from services.media_download import download_resumable, expected_size, is_complete
+
+logger = logging.getLogger(__name__)
+
+MEDIA_PRIORITY = {"voice": 0, "photo": 1, "document": 2, "video": 3}
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "4"))
+# Лимиты по умолчанию в МБ (0 — без ограничения)
+MEDIA_MAX_FILE_MB = float(os.getenv("MEDIA_MAX_FILE_MB", "0"))
+MEDIA_MAX_JOB_MB = float(os.getenv("MEDIA_MAX_JOB_MB", "0"))
+# Типы, которые по умолчанию откладываются (например, "video")
+MEDIA_DEFER = [t.strip() for t in os.getenv("MEDIA_DEFER", "").split(",") if t.strip()]
+
+DEFERRED_FILE = "deferred_media.json"
+
+DOWNLOADED = "downloaded"
+EXISTS = "exists"
+SKIPPED = "skipped"
+DEFERRED = "deferred"
+FAILED = "error"
+
+
+class MediaScheduler:
+    """Очередь скачивания медиа одной задачи с приоритетами и лимитами
+
+    Использование:
+        async with MediaScheduler(client) as scheduler:
+            future = scheduler.submit("voice", message.id, message.voice, path)
+        # после выхода из блока все файлы скачаны, future.result() — итог
+    """
+
+    def __init__(self, client, workers: int = MEDIA_WORKERS, max_file_mb: Optional[float] = None,
+                 max_job_mb: Optional[float] = None, defer: Optional[Iterable[str]] = None):
+        self.client = client
+        self.workers = max(1, workers)
+        max_file_mb = MEDIA_MAX_FILE_MB if max_file_mb is None else max_file_mb
+        max_job_mb = MEDIA_MAX_JOB_MB if max_job_mb is None else max_job_mb
+        self.max_file_bytes = int(max_file_mb * 1024 * 1024) if max_file_mb else None
+        self.max_job_bytes = int(max_job_mb * 1024 * 1024) if max_job_mb else None
+        self.defer = set(MEDIA_DEFER if defer is None else defer)
+
+        self.bytes_downloaded = 0
+        self.bytes_in_flight = 0
+        self.counts = {status: 0 for status in (DOWNLOADED, EXISTS, SKIPPED, DEFERRED, FAILED)}
+        self.deferred: List[Dict] = []
+        self.skipped: List[Dict] = []
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._tasks = []
+
+    async def __aenter__(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self._queue.join()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            # Незавершённые при ошибке задачи не должны зависнуть навсегда
+            while not self._queue.empty():
+                _, _, item = self._queue.get_nowait()
+                if not item["future"].done():
+                    item["future"].cancel()
+
+    def _finish(self, future: asyncio.Future, status: str, **info) -> asyncio.Future:
+        self.counts[status] += 1
+        future.set_result({"status": status, **info})
+        return future
+
+    def submit(self, kind: str, message_id: int, media, path: str, allow_defer: bool = True) -> asyncio.Future:
+        """Ставит файл в очередь; future вернёт {"status": ..., "path", "size"}"""
+        future = asyncio.get_running_loop().create_future()
+        size = expected_size(media)
+        entry = {"message_id": message_id, "type": kind, "path": path, "size": size}
+
+        if is_complete(path, media):
+            return self._finish(future, EXISTS, path=path, size=os.path.getsize(path))
+        if allow_defer and kind in self.defer:
+            self.deferred.append(entry)
+            return self._finish(future, DEFERRED, path=path, size=size)
+        if self.max_file_bytes and size is not None and size > self.max_file_bytes:
+            self.skipped.append({**entry, "reason": "max_file_mb"})
+            return self._finish(future, SKIPPED, path=path, size=size, reason="max_file_mb")
+
+        item = {"entry": entry, "media": media, "future": future}
+        self._queue.put_nowait((MEDIA_PRIORITY.get(kind, len(MEDIA_PRIORITY)), next(self._seq), item))
+        return future
+
+    async def _worker(self):
+        while True:
+            _, _, item = await self._queue.get()
+            entry, future = item["entry"], item["future"]
+            size = entry["size"] or 0
+            try:
+                # Объём задачи проверяется при старте скачивания: первыми бюджет получают приоритетные типы
+                if self.max_job_bytes and self.bytes_downloaded + self.bytes_in_flight + size > self.max_job_bytes:
+                    self.skipped.append({**entry, "reason": "max_job_mb"})
+                    self._finish(future, SKIPPED, path=entry["path"], size=entry["size"], reason="max_job_mb")
+                    continue
+                self.bytes_in_flight += size
+                try:
+                    await download_resumable(self.client, item["media"], entry["path"])
+                finally:
+                    self.bytes_in_flight -= size
+                actual = os.path.getsize(entry["path"])
+                self.bytes_downloaded += actual
+                self._finish(future, DOWNLOADED, path=entry["path"], size=actual)
+            except asyncio.CancelledError:
+                # Файл, который скачивался при отмене, не должен оставить future без ответа
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка скачивания {os.path.basename(entry['path'])}: {e}")
+                self._finish(future, FAILED, path=entry["path"], size=entry["size"], error=str(e))
+            finally:
+                self._queue.task_done()
+
+    def write_deferred(self, directory: str) -> Optional[str]:
+        """Дописывает отложенные файлы в deferred_media.json (метаданные без байтов)"""
+        if not self.deferred:
+            return None
+        manifest_path = os.path.join(directory, DEFERRED_FILE)
+        entries = {entry["message_id"]: entry for entry in load_deferred(directory)}
+        for entry in self.deferred:
+            entries[entry["message_id"]] = entry
+        save_deferred(directory, list(entries.values()))
+        return manifest_path
+
+    def stats(self) -> Dict:
+        return {
+            **self.counts,
+            "queued": self._queue.qsize(),
+            "downloaded_mb": round(self.bytes_downloaded / (1024 * 1024), 2),
+            "max_file_mb": round(self.max_file_bytes / (1024 * 1024), 2) if self.max_file_bytes else None,
+            "max_job_mb": round(self.max_job_bytes / (1024 * 1024), 2) if self.max_job_bytes else None,
+            "deferred_types": sorted(self.defer)
+        }
+
+
+def load_deferred(directory: str) -> List[Dict]:
+    manifest_path = os.path.join(directory, DEFERRED_FILE)
+    if not os.path.exists(manifest_path):
+        return []
+    return serialization.load(manifest_path)
+
+
+def save_deferred(directory: str, entries: List[Dict]):
+    manifest_path = os.path.join(directory, DEFERRED_FILE)
+    if not entries:
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        return
+    serialization.dump(manifest_path, entries, pretty=True)
@@ -0,0 +1,218 @@
+"""
+Иерархическая память чата: сводки по дням → по неделям → по всей истории
+
+Сводка строится один раз, когда её период закрыт (в чате есть сообщения
+более позднего дня/недели), и больше не пересчитывается. Закрытые дни
+текущей недели хранят дневные сводки; при закрытии недели они сворачиваются
+в недельную, а недельная — в общую сводку (предыдущая общая + новая неделя).
+Старые недели без дневных сводок (первичная загрузка истории) сводятся
+прямо из сообщений.
+
+Контекст для обновления профиля — общая сводка и не более шести дневных
+сводок текущей недели, поэтому его размер не зависит от длины чата.
+
+Файл памяти чата (data/summaries/<chat>.json):
+    days    — {"2024-01-15": {"summary", "messages"}} закрытые дни текущей недели
+    weeks   — {"2024-W03": {"summary", "messages"}} закрытые недели
+    overall — {"summary", "through": последняя свёрнутая неделя}
+"""
+
+import os
+import asyncio
+import logging
+from datetime import date
+from typing import Awaitable, Callable, Dict, List
+
+from services import file_io
+from services import serialization
+
+logger = logging.getLogger(__name__)
+
+# Максимум символов переписки в одном запросе сводки (длиннее — по частям)
+SUMMARY_INPUT_CHARS = int(os.getenv("SUMMARY_INPUT_CHARS", "12000"))
+
+DAY_PROMPT = """Кратко перескажи переписку за {period}: о чём говорили, важные события и решения,
+настроение и поведение каждого участника. Не больше 8 предложений.
+
+Переписка:
+{text}
+"""
+
+ROLLUP_PROMPT = """Объедини сводки переписки за {period} в одну краткую сводку: главные темы,
+события, изменения в отношениях и поведении участников. Не больше 10 предложений.
+
+Сводки:
+{text}
+"""
+
+OVERALL_PROMPT = """Обнови общую сводку всей истории переписки с учётом новых недель.
+Сохрани важное из прежней сводки, добавь новое, опиши, как менялись отношения.
+Не больше 15 предложений.
+
+Прежняя сводка:
+{previous}
+
+Новые недели:
+{text}
+"""
+
+
+def _week_of(day: str) -> str:
+    year, week, _ = date.fromisoformat(day).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def _message_line(msg: Dict) -> str:
+    text = msg.get("transcription") or msg.get("text") or ""
+    return f"[{msg['time'].replace('T', ' ')[:16]}] {msg.get('from', '')}: {text}"
+
+
+def _chunks(lines: List[str], limit: int = SUMMARY_INPUT_CHARS) -> List[str]:
+    """Склеивает строки в куски не длиннее limit символов"""
+    chunks, current, size = [], [], 0
+    for line in lines:
+        if current and size + len(line) > limit:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _chunks_by_size(weeks: List[str], summaries: Dict[str, Dict]) -> List[List[str]]:
+    """Группы недель, сводки которых помещаются в один запрос"""
+    groups, current, size = [], [], 0
+    for week in weeks:
+        length = len(summaries[week]["summary"])
+        if current and size + length > SUMMARY_INPUT_CHARS:
+            groups.append(current)
+            current, size = [], 0
+        current.append(week)
+        size += length
+    if current:
+        groups.append(current)
+    return groups
+
+
+class ChatMemory:
+    """Сводки одного чата, сохраняемые в файл (msgpack или JSON, см. services/serialization.py)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = asyncio.Lock()
+        self.data = {"days": {}, "weeks": {}, "overall": {"summary": "", "through": None}}
+        if os.path.exists(path):
+            self.data.update(serialization.load(path))
+
+    async def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        await file_io.write(self.path, self.data, serialization.store_format())
+
+    async def _summarize_lines(self, lines: List[str], period: str, prompt: str,
+                               summarize: Callable[[str], Awaitable[str]]) -> str:
+        """Сводка строк; если они не помещаются в один запрос — сводка сводок частей"""
+        parts = [await summarize(prompt.format(period=period, text=chunk)) for chunk in _chunks(lines)]
+        if len(parts) == 1:
+            return parts[0]
+        return await self._summarize_lines(parts, period, ROLLUP_PROMPT, summarize)
+
+    async def _summarize_day(self, day: str, messages: List[Dict], summarize: Callable[[str], Awaitable[str]]):
+        lines = [_message_line(msg) for msg in messages]
+        summary = await self._summarize_lines(lines, day, DAY_PROMPT, summarize)
+        self.data["days"][day] = {"summary": summary, "messages": len(messages)}
+        await self._save()
+
+    async def update(self, messages: List[Dict], summarize: Callable[[str], Awaitable[str]]) -> int:
+        """Строит сводки закрытых периодов, которых ещё нет; возвращает число новых сводок
+
+        summarize(prompt) -> текст — вызов LLM. При ошибке уже построенные
+        сводки сохраняются, а остальные достраиваются при следующем вызове.
+        """
+        days: Dict[str, List[Dict]] = {}
+        for msg in messages:
+            if msg.get("time") and (msg.get("transcription") or msg.get("text")):
+                days.setdefault(msg["time"][:10], []).append(msg)
+        if not days:
+            return 0
+
+        current_day = max(days)
+        current_week = _week_of(current_day)
+        overall = self.data["overall"]
+        built = 0
+        try:
+            # Закрытые недели: из дневных сводок, а при первичной загрузке — из сообщений
+            weeks: Dict[str, List[str]] = {}
+            for day in sorted(days):
+                weeks.setdefault(_week_of(day), []).append(day)
+            for week, week_days in sorted(weeks.items()):
+                done = overall["through"] is not None and week <= overall["through"]
+                if week >= current_week or done or week in self.data["weeks"]:
+                    continue
+                count = sum(len(days[day]) for day in week_days)
+                if any(day in self.data["days"] for day in week_days):
+                    # Неделя копила дневные сводки: досводим её последние дни
+                    for day in week_days:
+                        if day not in self.data["days"]:
+                            await self._summarize_day(day, days[day], summarize)
+                            built += 1
+                    lines = [f"{day}: {self.data['days'][day]['summary']}" for day in week_days]
+                    summary = await self._summarize_lines(lines, f"неделю {week}", ROLLUP_PROMPT, summarize)
+                else:
+                    lines = [_message_line(msg) for day in week_days for msg in days[day]]
+                    summary = await self._summarize_lines(lines, f"неделю {week}", DAY_PROMPT, summarize)
+                self.data["weeks"][week] = {"summary": summary, "messages": count}
+                for day in week_days:
+                    self.data["days"].pop(day, None)
+                built += 1
+                await self._save()
+
+            # Новые закрытые недели сворачиваются в общую сводку
+            pending = sorted(week for week in self.data["weeks"]
+                             if overall["through"] is None or week > overall["through"])
+            for chunk_weeks in _chunks_by_size(pending, self.data["weeks"]):
+                text = "\n".join(f"{week}: {self.data['weeks'][week]['summary']}" for week in chunk_weeks)
+                overall["summary"] = await summarize(OVERALL_PROMPT.format(
+                    previous=overall["summary"] or "(пока нет)", text=text))
+                overall["through"] = chunk_weeks[-1]
+                built += 1
+                await self._save()
+
+            # Закрытые дни текущей недели
+            for day in sorted(days):
+                if day >= current_day or _week_of(day) != current_week or day in self.data["days"]:
+                    continue
+                await self._summarize_day(day, days[day], summarize)
+                built += 1
+        finally:
+            if built:
+                logger.info(f"🧠 Память {os.path.basename(self.path)}: новых сводок {built}")
+        return built
+
+    def context(self) -> str:
+        """Общая сводка и дневные сводки текущей недели для промпта (пусто, если сводок нет)"""
+        parts = []
+        if self.data["overall"]["summary"]:
+            parts.append(f"📚 Вся история (по {self.data['overall']['through']}):\n{self.data['overall']['summary']}")
+        # Недели, ещё не свёрнутые в общую сводку (если свёртка прервалась)
+        through = self.data["overall"]["through"]
+        for week, entry in sorted(self.data["weeks"].items()):
+            if through is None or week > through:
+                parts.append(f"📅 Неделя {week}:\n{entry['summary']}")
+        for day, entry in sorted(self.data["days"].items()):
+            parts.append(f"🗓️ {day}:\n{entry['summary']}")
+        return "\n\n".join(parts)
+
+
+_memories: Dict[str, ChatMemory] = {}
+
+
+async def get_memory(path: str) -> ChatMemory:
+    """Память чата (файл читается один раз на процесс, вне цикла событий)"""
+    memory = _memories.get(path)
+    if memory is None:
+        loaded = await file_io.run(ChatMemory, path)
+        # Пока файл читался, память мог загрузить другой запрос
+        memory = _memories.setdefault(path, loaded)
+    return memory
@@ -0,0 +1,231 @@
+"""
+Метрики в текстовом формате Prometheus (без внешних зависимостей)
+"""
+
+import os
+import time
+import threading
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items
+        ]
+
+
+class Gauge(_Metric):
+    """Значение задаётся set() или вычисляется при выгрузке функцией"""
+    type_name = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (),
+                 function: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple, float] = {}
+        self._function = function
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], Dict[Tuple, float]]):
+        """function() -> {(значения меток,): значение}"""
+        self._function = function
+
+    def render(self) -> List[str]:
+        if self._function is not None:
+            try:
+                items = list(self._function().items())
+            except Exception:
+                items = []
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: Dict[Tuple, Dict] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        with self._lock:
+            items = [(key, dict(series, counts=list(series["counts"]))) for key, series in self._series.items()]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                le = f'le="{_format_value(bound) if bound == float("inf") else bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.setdefault(metric.name, metric)
+        return self._metrics[metric.name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name: str, help_text: str, labels: Iterable[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help_text, labels))
+
+
+def gauge(name: str, help_text: str, labels: Iterable[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, help_text, labels))
+
+
+def histogram(name: str, help_text: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help_text, labels, buckets))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# --- Telegram ---
+TELEGRAM_CALLS = counter("telegram_api_calls_total", "Вызовы Telegram API", ["method"])
+TELEGRAM_ERRORS = counter("telegram_api_errors_total", "Ошибки вызовов Telegram API", ["method", "error"])
+TELEGRAM_LATENCY = histogram("telegram_api_latency_seconds", "Длительность вызовов Telegram API", ["method"])
+TELEGRAM_FLOOD_WAIT = counter("telegram_flood_wait_seconds_total", "Суммарное время FloodWait", ["method"])
+TELEGRAM_RATE = gauge("telegram_rate_limit", "Текущий лимит запросов в секунду (0 — без ограничения)", ["account"])
+MESSAGES_INGESTED = counter("messages_ingested_total", "Сообщения, полученные из Telegram, по чатам", ["chat"])
+
+# --- Медиа ---
+MEDIA_BYTES = counter("media_bytes_total", "Скачано байт медиа", ["type"])
+MEDIA_DOWNLOADS = counter("media_downloads_total", "Скачанные медиафайлы", ["type"])
+MEDIA_LATENCY = histogram("media_download_seconds", "Длительность скачивания медиафайла", ["type"])
+
+# --- Распознавание речи ---
+ASR_AUDIO_SECONDS = counter("asr_audio_seconds_total", "Длительность распознанного аудио", ["route"])
+ASR_PROCESSING_SECONDS = counter("asr_processing_seconds_total", "Время распознавания", ["route"])
+ASR_RTF = histogram("asr_real_time_factor", "Real-time factor распознавания", ["route"],
+                    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5))
+
+# --- LLM ---
+LLM_REQUESTS = counter("llm_requests_total", "Запросы к LLM", ["model", "status"])
+LLM_LATENCY = histogram("llm_request_seconds", "Длительность запроса к LLM", ["model"])
+LLM_PROMPT_TOKENS = counter("llm_prompt_tokens_total", "Токены промпта", ["model"])
+LLM_COMPLETION_TOKENS = counter("llm_completion_tokens_total", "Сгенерированные токены", ["model"])
+
+# --- Очереди и кэши ---
+QUEUE_DEPTH = gauge("queue_depth", "Глубина очередей задач", ["queue"])
+JOBS_IN_PROGRESS = gauge("jobs_in_progress", "Выполняющиеся задачи", ["kind"])
+CACHE_REQUESTS = counter("cache_requests_total", "Обращения к кэшам", ["cache", "result"])
+
+
+@asynccontextmanager
+async def telegram_call(method: str):
+    """Считает вызов Telegram API, его длительность, ошибки и FloodWait"""
+    TELEGRAM_CALLS.inc(method=method)
+    start = time.perf_counter()
+    try:
+        yield
+    except StopAsyncIteration:
+        raise
+    except Exception as e:
+        error = type(e).__name__
+        TELEGRAM_ERRORS.inc(method=method, error=error)
+        if error.startswith("FloodWait") and getattr(e, "seconds", None):
+            TELEGRAM_FLOOD_WAIT.inc(e.seconds, method=method)
+        raise
+    finally:
+        TELEGRAM_LATENCY.observe(time.perf_counter() - start, method=method)
+
+
+def observe_media(media_type: str, path: str, seconds: float):
+    """Учитывает скачанный медиафайл"""
+    MEDIA_DOWNLOADS.inc(type=media_type)
+    MEDIA_LATENCY.observe(seconds, type=media_type)
+    try:
+        MEDIA_BYTES.inc(os.path.getsize(path), type=media_type)
+    except OSError:
+        pass
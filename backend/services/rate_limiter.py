@@ -0,0 +1,156 @@
+"""
+Адаптивный ограничитель запросов к Telegram API (token bucket на аккаунт)
+
+Пока Telegram не ответил FloodWait, запросы не ограничиваются (если не задан
+TELEGRAM_RATE). На FloodWait скорость делится пополам от наблюдаемой, все
+запросы аккаунта ждут указанное время и повторяются; после этого скорость
+растёт линейно (AIMD), нащупывая максимальную устойчивую.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Optional
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Начальная скорость, запросов в секунду (0 — без ограничения до первого FloodWait)
+TELEGRAM_RATE = float(os.getenv("TELEGRAM_RATE", "0"))
+TELEGRAM_RATE_MIN = float(os.getenv("TELEGRAM_RATE_MIN", "0.5"))
+TELEGRAM_RATE_MAX = float(os.getenv("TELEGRAM_RATE_MAX", "100"))
+# Прирост скорости за секунду запросов без FloodWait и множитель при FloodWait
+TELEGRAM_RATE_STEP = float(os.getenv("TELEGRAM_RATE_STEP", "0.5"))
+TELEGRAM_RATE_BACKOFF = float(os.getenv("TELEGRAM_RATE_BACKOFF", "0.5"))
+# Сколько запросов можно выполнить подряд без пауз
+TELEGRAM_BURST = float(os.getenv("TELEGRAM_BURST", "5"))
+# FloodWait дольше этого не пережидаем, а отдаём ошибку
+FLOOD_MAX_WAIT = int(os.getenv("FLOOD_MAX_WAIT", "600"))
+FLOOD_MAX_RETRIES = int(os.getenv("FLOOD_MAX_RETRIES", "5"))
+
+# Окно для оценки фактической скорости запросов
+OBSERVED_WINDOW = 100
+
+
+def flood_wait_seconds(error: Exception) -> Optional[int]:
+    """Сколько секунд просит подождать Telegram (FloodWait, SlowModeWait) или None"""
+    name = type(error).__name__
+    if name.startswith("FloodWait") or name.startswith("FloodPremiumWait") or name.startswith("SlowModeWait"):
+        return int(getattr(error, "seconds", 0) or 0)
+    return None
+
+
+class AdaptiveRateLimiter:
+    """Token bucket с AIMD-подстройкой скорости по FloodWait"""
+
+    def __init__(self, account: str, rate: float = TELEGRAM_RATE):
+        self.account = account
+        self.rate: Optional[float] = rate or None
+        self.tokens = TELEGRAM_BURST
+        self.blocked_until = 0.0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.retries = 0
+        self.requests = 0
+        self._updated = time.monotonic()
+        self._recent = deque(maxlen=OBSERVED_WINDOW)
+        self._lock = asyncio.Lock()
+
+    def observed_rate(self) -> Optional[float]:
+        """Фактическая скорость последних запросов"""
+        if len(self._recent) < 2:
+            return None
+        elapsed = self._recent[-1] - self._recent[0]
+        return (len(self._recent) - 1) / elapsed if elapsed > 0 else None
+
+    async def acquire(self):
+        """Ждёт окончания FloodWait и свободного токена"""
+        async with self._lock:
+            now = time.monotonic()
+            if self.blocked_until > now:
+                await asyncio.sleep(self.blocked_until - now)
+                now = time.monotonic()
+
+            if self.rate is not None:
+                self.tokens = min(TELEGRAM_BURST, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    now = time.monotonic()
+                    self.tokens = 1
+                    self._updated = now
+                self.tokens -= 1
+
+            self.requests += 1
+            self._recent.append(now)
+
+    def on_success(self):
+        """Аддитивный рост: +TELEGRAM_RATE_STEP запросов/с за секунду без FloodWait"""
+        if self.rate is not None:
+            self.rate = min(TELEGRAM_RATE_MAX, self.rate + TELEGRAM_RATE_STEP / self.rate)
+
+    def on_flood_wait(self, seconds: int):
+        """Мультипликативное снижение и пауза для всех запросов аккаунта"""
+        base = self.rate or self.observed_rate() or TELEGRAM_RATE_MAX
+        self.rate = min(TELEGRAM_RATE_MAX, max(TELEGRAM_RATE_MIN, base * TELEGRAM_RATE_BACKOFF))
+        self.tokens = 0
+        self._updated = time.monotonic()
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+
+    async def call(self, method: str, func, *args, **kwargs):
+        """Выполняет запрос с учётом лимита, повторяя его после FloodWait"""
+        attempt = 0
+        while True:
+            await self.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                seconds = flood_wait_seconds(e)
+                if seconds is None or seconds > FLOOD_MAX_WAIT or attempt >= FLOOD_MAX_RETRIES:
+                    raise
+                attempt += 1
+                self.retries += 1
+                self.on_flood_wait(seconds)
+                logger.warning(f"⏳ FloodWait {seconds} с на {method} ({self.account}), "
+                               f"скорость снижена до {self.rate:.2f} запр/с, попытка {attempt}")
+                continue
+            self.on_success()
+            return result
+
+    def stats(self) -> Dict:
+        observed = self.observed_rate()
+        blocked_for = self.blocked_until - time.monotonic()
+        return {
+            "rate": round(self.rate, 2) if self.rate is not None else None,
+            "observed_rate": round(observed, 2) if observed is not None else None,
+            "blocked_for_s": round(blocked_for, 1) if blocked_for > 0 else 0,
+            "requests": self.requests,
+            "flood_waits": self.flood_waits,
+            "flood_wait_seconds": self.flood_wait_seconds,
+            "retries": self.retries
+        }
+
+
+_limiters: Dict[str, AdaptiveRateLimiter] = {}
+
+
+def get_limiter(account: str) -> AdaptiveRateLimiter:
+    """Один ограничитель на аккаунт — общий для всех клиентов и задач"""
+    limiter = _limiters.get(account)
+    if limiter is None:
+        limiter = _limiters[account] = AdaptiveRateLimiter(account)
+    return limiter
+
+
+def stats() -> Dict:
+    return {account: limiter.stats() for account, limiter in _limiters.items()}
+
+
+metrics.TELEGRAM_RATE.set_function(lambda: {
+    (account,): limiter.rate or 0 for account, limiter in _limiters.items()
+})
@@ -0,0 +1,200 @@
+"""
+Сериализация хранилищ: быстрый JSON и компактный двоичный формат
+
+Все файлы данных пишутся и читаются через этот модуль:
+    json    — для файлов, которые читают люди (экспорты, профили, метаданные,
+              настройки); orjson, если установлен, иначе стандартный json
+    msgpack — для внутренних хранилищ (live-файлы, память чата, кэши);
+              без пакета msgpack вместо него пишется JSON
+
+Формат определяется при чтении по первому байту, поэтому старые файлы
+(JSON с отступами) читаются как раньше и переводятся в новый формат при
+следующей записи. Списки сообщений в msgpack хранятся потоком объектов
+(по одному на сообщение): новое сообщение дописывается в конец файла.
+"""
+
+import os
+import json
+import logging
+import threading
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+# Формат внутренних хранилищ: msgpack или json
+STORE_FORMAT = os.getenv("STORE_FORMAT", MSGPACK).lower()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_warned = False
+
+
+def store_format(value: Optional[str] = None) -> str:
+    """Действующий формат внутренних хранилищ (msgpack без пакета заменяется на json)"""
+    global _warned
+    value = (value or STORE_FORMAT).lower()
+    if value not in (JSON, MSGPACK):
+        raise ValueError(f"Неизвестный формат хранилища: {value}")
+    if value == MSGPACK and msgpack is None:
+        if not _warned:
+            logger.warning("⚠️ Пакет msgpack не установлен, внутренние хранилища пишутся в JSON")
+            _warned = True
+        return JSON
+    return value
+
+
+def is_msgpack(head: bytes) -> bool:
+    """Начало msgpack-файла: словарь или массив (JSON начинается с текста или BOM)"""
+    if not head:
+        return False
+    first = head[0]
+    return 0x80 <= first <= 0x9f or 0xdc <= first <= 0xdf
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if hasattr(value, "tolist"):
+        # Числа и массивы NumPy
+        return value.tolist()
+    raise TypeError(f"Тип {type(value).__name__} не сериализуется")
+
+
+def dumps_json(data: Any, pretty: bool = False) -> bytes:
+    """JSON в UTF-8; pretty — с отступом 2 для чтения человеком"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=_default, option=option)
+    return json.dumps(data, ensure_ascii=False, indent=2 if pretty else None,
+                      separators=None if pretty else (",", ":"), default=_default).encode('utf-8')
+
+
+def loads_json(data) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _packer():
+    return msgpack.Packer(default=_default, use_bin_type=True)
+
+
+def dumps(data: Any, fmt: str = JSON, pretty: bool = False) -> bytes:
+    """Документ в формате fmt"""
+    if store_format(fmt) == MSGPACK:
+        return _packer().pack(data)
+    return dumps_json(data, pretty)
+
+
+def loads(data: bytes) -> Any:
+    """Документ из байтов любого формата"""
+    if data.startswith(b"\xef\xbb\xbf"):
+        data = data[3:]
+    if is_msgpack(data[:1]):
+        if msgpack is None:
+            raise RuntimeError("Файл в формате msgpack: для чтения нужен пакет msgpack")
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    return loads_json(data)
+
+
+def dump(path: str, data: Any, fmt: str = JSON, pretty: bool = False):
+    """Записывает документ атомарно: во временный файл и переименованием
+
+    Временный файл свой у каждого потока: одновременные записи одного файла
+    не портят друг друга, остаётся последняя.
+    """
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(dumps(data, fmt, pretty))
+    os.replace(tmp_path, path)
+
+
+def load(path: str, default: Any = None) -> Any:
+    """Документ из файла любого формата или default, если файла нет"""
+    if not os.path.exists(path):
+        return default
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def write_messages(f, messages: Iterable[Dict], fmt: str = JSON):
+    """Пишет список сообщений в двоичный поток по одному: JSON-массив по сообщению
+    на строку или поток msgpack (без буфера на весь файл)"""
+    if store_format(fmt) == MSGPACK:
+        packer = _packer()
+        for message in messages:
+            f.write(packer.pack(message))
+        return
+    separator = b"[\n"
+    for message in messages:
+        f.write(separator)
+        f.write(dumps_json(message))
+        separator = b",\n"
+    f.write(b"[]\n" if separator == b"[\n" else b"\n]\n")
+
+
+def dumps_message(message: Dict, fmt: str = JSON) -> bytes:
+    """Одно сообщение для дописывания в конец файла (msgpack) или строки JSON Lines"""
+    if store_format(fmt) == MSGPACK:
+        return _packer().pack(message)
+    return dumps_json(message) + b"\n"
+
+
+def iter_messages(f) -> Iterator[Dict]:
+    """Сообщения из двоичного файла любого формата (поток msgpack читается частями)"""
+    head = f.read(3)
+    if head == b"\xef\xbb\xbf":
+        head = b""
+    if is_msgpack(head):
+        if msgpack is None:
+            raise RuntimeError("Файл в формате msgpack: для чтения нужен пакет msgpack")
+        unpacker = msgpack.Unpacker(raw=False, strict_map_key=False)
+        unpacker.feed(head)
+        while True:
+            for item in unpacker:
+                # Весь список одним массивом (запись другим инструментом)
+                if isinstance(item, list):
+                    yield from item
+                else:
+                    yield item
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                return
+            unpacker.feed(chunk)
+    data = head + f.read()
+    if data.strip():
+        yield from loads_json(data)
+
+
+def file_format(path: str) -> Optional[str]:
+    """Формат существующего файла (None — файла нет или он пуст)"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(3)
+    except FileNotFoundError:
+        return None
+    if not head:
+        return None
+    return MSGPACK if is_msgpack(head) else JSON
+
+
+def codecs() -> Dict[str, str]:
+    """Доступные реализации (для отчётов и бенчмарков)"""
+    return {
+        "json": "orjson" if orjson is not None else "json",
+        "store_format": store_format()
+    }
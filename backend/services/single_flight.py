@@ -0,0 +1,111 @@
+"""
+Single-flight: одинаковые одновременные запросы выполняются один раз
+
+Первый запрос с ключом запускает работу отдельной задачей, остальные
+с тем же ключом, пришедшие до её окончания, ждут тот же результат (или ту
+же ошибку). Отмена одного из ожидающих (клиент закрыл вкладку) не
+прерывает работу для остальных. Для потоков (стриминг токенов) каждый
+подписчик получает все куски с начала — и уже отданные, и новые.
+"""
+
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _consume_exception(task: asyncio.Task):
+    """Ошибка задачи, которую уже никто не ждёт, не должна попадать в лог как «never retrieved»"""
+    if not task.cancelled():
+        task.exception()
+
+
+class _Broadcast:
+    """Куски потока, накопленные для всех подписчиков"""
+
+    def __init__(self):
+        self.chunks: List = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+    async def produce(self, source: AsyncIterator):
+        try:
+            async for chunk in source:
+                async with self.changed:
+                    self.chunks.append(chunk)
+                    self.changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self.changed:
+                self.done = True
+                self.changed.notify_all()
+
+    async def subscribe(self) -> AsyncIterator:
+        position = 0
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: position < len(self.chunks) or self.done)
+                chunks = self.chunks[position:]
+                finished = self.done
+            for chunk in chunks:
+                yield chunk
+            position += len(chunks)
+            if finished and position >= len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class SingleFlight:
+    """Объединяет одновременные вызовы с одинаковым ключом"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self._streams: Dict[Hashable, _Broadcast] = {}
+        self.leaders = 0
+        self.joined = 0
+
+    def _count(self, joined: bool):
+        if joined:
+            self.joined += 1
+        else:
+            self.leaders += 1
+        metrics.CACHE_REQUESTS.inc(cache=self.name, result="joined" if joined else "leader")
+
+    async def run(self, key: Hashable, work: Callable[[], Awaitable]):
+        """Результат work(); если такой же вызов уже идёт — его результат"""
+        task = self._calls.get(key)
+        self._count(task is not None)
+        if task is None:
+            task = asyncio.ensure_future(work())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._calls.pop(key, None) if self._calls.get(key) is t else None)
+            task.add_done_callback(_consume_exception)
+        return await asyncio.shield(task)
+
+    async def stream(self, key: Hashable, source: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """Куски потока source(); к уже идущему потоку с тем же ключом подключается с начала"""
+        broadcast = self._streams.get(key)
+        self._count(broadcast is not None)
+        if broadcast is None:
+            broadcast = self._streams[key] = _Broadcast()
+            broadcast.task = asyncio.ensure_future(broadcast.produce(source()))
+            broadcast.task.add_done_callback(
+                lambda t: self._streams.pop(key, None) if self._streams.get(key) is broadcast else None)
+        async for chunk in broadcast.subscribe():
+            yield chunk
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self._calls),
+            "streams_in_flight": len(self._streams),
+            "leaders": self.leaders,
+            "joined": self.joined
+        }
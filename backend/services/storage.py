@@ -0,0 +1,334 @@
+"""
+Хранение экспортов и live-файлов: по желанию сжатый построчный формат
+
+STORAGE_COMPRESSION=gzip|zstd включает запись в сжатом виде: списки
+сообщений пишутся как JSON Lines (<имя>.jsonl.gz / .jsonl.zst), тексты —
+как <имя>.txt.gz / .txt.zst. Каждая запись — отдельная строка, поэтому файл
+читается потоком, а новые сообщения дописываются новым кадром сжатия без
+перезаписи файла. Чтение прозрачно: по базовому имени (chat_export.json)
+находится любой из вариантов на диске.
+
+Без сжатия списки сообщений кодируются services/serialization.py: JSON
+(по сообщению на строку) или поток msgpack для внутренних хранилищ
+(fmt="msgpack"), в который новое сообщение дописывается без перезаписи.
+"""
+
+import os
+import io
+import gzip
+import asyncio
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from services import serialization
+
+logger = logging.getLogger(__name__)
+
+# none (JSON или msgpack и обычный текст), gzip или zstd
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "none").lower()
+GZIP_LEVEL = int(os.getenv("STORAGE_GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("STORAGE_ZSTD_LEVEL", "10"))
+
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+# Файлы, которые фоновая задача переводит в сжатый формат
+CONVERTIBLE_FILES = ("chat_export.json", "chat_for_llm.txt", "text_messages.txt", "llm_analysis.txt")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Блокировки файлов по базовому пути: запись, дозапись и конвертация одного
+# файла из разных потоков идут по очереди (иначе конвертация, прочитавшая
+# файл до дозаписи, удалит старый вариант вместе с новым сообщением)
+_path_locks: Dict[str, threading.RLock] = {}
+_path_locks_guard = threading.Lock()
+
+
+def compression(value: Optional[str] = None) -> str:
+    """Действующий формат сжатия (zstd без пакета zstandard заменяется на gzip)"""
+    value = (value or STORAGE_COMPRESSION).lower()
+    if value in ("", "none", "off"):
+        return "none"
+    if value == "zstd" and zstandard is None:
+        logger.warning("⚠️ Пакет zstandard не установлен, используем gzip")
+        return "gzip"
+    if value not in EXTENSIONS:
+        raise ValueError(f"Неизвестный формат сжатия: {value}")
+    return value
+
+
+def _is_list_file(path: str) -> bool:
+    return path.endswith(".json") or path.endswith(".jsonl")
+
+
+def variants(path: str) -> List[str]:
+    """Все возможные имена файла на диске для базового пути"""
+    base = path[:-1] if path.endswith(".jsonl") else path
+    names = [base]
+    stem = base[:-len(".json")] + ".jsonl" if base.endswith(".json") else base
+    for ext in EXTENSIONS.values():
+        names.append(stem + ext)
+    return names
+
+
+def target_path(path: str, method: Optional[str] = None) -> str:
+    """Имя файла на диске для записи в формате method"""
+    method = compression(method)
+    if method == "none":
+        return path
+    stem = path[:-len(".json")] + ".jsonl" if path.endswith(".json") else path
+    return stem + EXTENSIONS[method]
+
+
+def resolve(path: str) -> Optional[str]:
+    """Существующий вариант файла (несжатый, .gz или .zst) или None"""
+    for name in variants(path):
+        if os.path.exists(name):
+            return name
+    return None
+
+
+def path_lock(path: str) -> threading.RLock:
+    """Блокировка файла, общая для всех его вариантов (несжатый, .gz, .zst)"""
+    key = os.path.abspath(variants(path)[0])
+    with _path_locks_guard:
+        lock = _path_locks.get(key)
+        if lock is None:
+            lock = _path_locks[key] = threading.RLock()
+        return lock
+
+
+def exists(path: str) -> bool:
+    return resolve(path) is not None
+
+
+def _method_of(actual_path: str) -> str:
+    for method, ext in EXTENSIONS.items():
+        if actual_path.endswith(ext):
+            return method
+    return "none"
+
+
+def _open_read(actual_path: str):
+    method = _method_of(actual_path)
+    if method == "gzip":
+        return gzip.open(actual_path, 'rt', encoding='utf-8')
+    if method == "zstd":
+        if zstandard is None:
+            raise RuntimeError(f"{os.path.basename(actual_path)}: для чтения нужен пакет zstandard")
+        # read_across_frames: дописанные кадры читаются как один поток
+        reader = zstandard.ZstdDecompressor().stream_reader(open(actual_path, 'rb'), read_across_frames=True,
+                                                            closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(actual_path, 'r', encoding='utf-8')
+
+
+def _is_live(path: str) -> bool:
+    return os.path.basename(os.path.dirname(path)) == "live"
+
+
+def _default_format(path: str) -> str:
+    """live-файлы — внутреннее хранилище (serialization.STORE_FORMAT), экспорты — JSON"""
+    return serialization.store_format() if _is_live(path) else serialization.JSON
+
+
+def _compress(data: bytes, method: str) -> bytes:
+    if method == "gzip":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def _open_write(path: str, method: str):
+    """Двоичный поток записи: данные сжимаются по мере записи, без буфера на весь файл"""
+    if method == "gzip":
+        return gzip.open(path, 'wb', compresslevel=GZIP_LEVEL)
+    if method == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, 'wb'), closefd=True)
+    return open(path, 'wb')
+
+
+def _remove_other_variants(path: str, keep: str):
+    for name in variants(path):
+        if name != keep and os.path.exists(name):
+            os.remove(name)
+
+
+def write_messages(path: str, messages: List[Dict], method: Optional[str] = None, fmt: Optional[str] = None) -> str:
+    """Сохраняет список сообщений; возвращает фактический путь файла
+
+    fmt — формат несжатого файла (json или msgpack); по умолчанию msgpack
+    для live-файлов и JSON для экспортов. Сжатые файлы — всегда JSON Lines.
+    """
+    method = compression(method)
+    actual = target_path(path, method)
+    tmp_path = actual + ".tmp"
+    with path_lock(path):
+        with _open_write(tmp_path, method) as f:
+            if method == "none":
+                serialization.write_messages(f, messages, fmt or _default_format(path))
+            else:
+                for message in messages:
+                    f.write(serialization.dumps_message(message, serialization.JSON))
+        os.replace(tmp_path, actual)
+        _remove_other_variants(path, actual)
+    return actual
+
+
+def iter_messages(path: str) -> Iterator[Dict]:
+    """Сообщения файла по одному (сжатый JSON Lines читается потоком)"""
+    actual = resolve(path)
+    if actual is None:
+        return
+    if _method_of(actual) == "none" and not actual.endswith(".jsonl"):
+        with open(actual, 'rb') as f:
+            yield from serialization.iter_messages(f)
+        return
+    with _open_read(actual) as f:
+        for line in f:
+            if line.strip():
+                yield serialization.loads_json(line)
+
+
+def read_messages(path: str) -> List[Dict]:
+    """Список сообщений из любого варианта файла ([] если файла нет)"""
+    return list(iter_messages(path))
+
+
+def append_message(path: str, message: Dict, method: Optional[str] = None, fmt: Optional[str] = None) -> str:
+    """Дописывает сообщение без перезаписи: в сжатый файл — новым кадром, в msgpack — в конец
+
+    Несжатый JSON переписывается целиком (при fmt=msgpack — уже в msgpack).
+    """
+    with path_lock(path):
+        return _append_message(path, message, method, fmt)
+
+
+def _append_message(path: str, message: Dict, method: Optional[str], fmt: Optional[str]) -> str:
+    actual = resolve(path)
+    method = compression(method) if actual is None else _method_of(actual)
+    fmt = serialization.store_format(fmt) if fmt else _default_format(path)
+    if method == "none":
+        existing = serialization.file_format(actual) if actual else None
+        if existing != serialization.MSGPACK or fmt != serialization.MSGPACK:
+            messages = read_messages(path) if actual else []
+            messages.append(message)
+            return write_messages(path, messages, "none", fmt)
+        with open(actual, 'ab') as f:
+            f.write(serialization.dumps_message(message, fmt))
+        return actual
+    actual = actual or target_path(path, method)
+    with open(actual, 'ab') as f:
+        f.write(_compress(serialization.dumps_message(message, serialization.JSON), method))
+    return actual
+
+
+def write_text(path: str, text: str, method: Optional[str] = None) -> str:
+    """Сохраняет текстовый файл; возвращает фактический путь"""
+    method = compression(method)
+    actual = target_path(path, method)
+    tmp_path = actual + ".tmp"
+    with path_lock(path):
+        with _open_write(tmp_path, method) as f:
+            f.write(text.encode('utf-8'))
+        os.replace(tmp_path, actual)
+        _remove_other_variants(path, actual)
+    return actual
+
+
+def read_text(path: str) -> Optional[str]:
+    """Текст из любого варианта файла или None"""
+    actual = resolve(path)
+    if actual is None:
+        return None
+    with _open_read(actual) as f:
+        return f.read()
+
+
+def convert(path: str, method: Optional[str] = None) -> Optional[Dict]:
+    """Переписывает файл в формат method; возвращает размеры до и после
+
+    Файл держится заблокированным от чтения до удаления старого варианта:
+    live-сообщение, пришедшее во время конвертации, допишется уже в новый файл.
+    """
+    method = compression(method)
+    with path_lock(path):
+        actual = resolve(path)
+        if actual is None or _method_of(actual) == method:
+            return None
+        before = os.path.getsize(actual)
+        if _is_list_file(path):
+            new_path = write_messages(path, read_messages(path), method, _default_format(path))
+        else:
+            new_path = write_text(path, read_text(path), method)
+    return {"file": new_path, "bytes_before": before, "bytes_after": os.path.getsize(new_path)}
+
+
+def convertible_files(root: str) -> Iterator[str]:
+    """Базовые пути экспортов и live-файлов внутри root"""
+    for directory, _, files in os.walk(root):
+        seen = set()
+        for name in files:
+            base = name
+            for ext in EXTENSIONS.values():
+                if base.endswith(ext):
+                    base = base[:-len(ext)]
+            if base.endswith(".jsonl"):
+                base = base[:-1]
+            live = _is_live(os.path.join(directory, base)) and base.endswith(".json")
+            if (base in CONVERTIBLE_FILES or live) and base not in seen:
+                seen.add(base)
+                yield os.path.join(directory, base)
+
+
+def convert_tree(roots: List[str], method: Optional[str] = None, status: Optional[Dict] = None) -> Dict:
+    """Переводит все экспорты и live-файлы в каталогах roots в формат method
+
+    status (если передан) обновляется по ходу работы — для фоновой задачи.
+    """
+    method = compression(method)
+    status = status if status is not None else {}
+    paths = [path for root in roots if os.path.exists(root) for path in convertible_files(root)]
+    status.update({"status": "converting", "compression": method, "total": len(paths), "processed": 0,
+                   "converted": 0, "bytes_before": 0, "bytes_after": 0, "errors": []})
+    for path in paths:
+        try:
+            result = convert(path, method)
+            if result:
+                status["converted"] += 1
+                status["bytes_before"] += result["bytes_before"]
+                status["bytes_after"] += result["bytes_after"]
+        except Exception as e:
+            logger.error(f"❌ Ошибка конвертации {path}: {e}")
+            status["errors"].append({"file": path, "error": str(e)})
+        status["processed"] += 1
+    status["status"] = "completed"
+    logger.info(f"🗜️ Конвертировано файлов: {status['converted']} из {len(paths)}, "
+                f"{status['bytes_before']} → {status['bytes_after']} байт")
+    return status
+
+
+# Состояние фоновой конвертации (одна задача на процесс)
+CONVERSION_STATUS: Dict = {"status": "idle"}
+
+
+async def convert_in_background(roots: List[str], method: Optional[str] = None) -> bool:
+    """Запускает convert_tree в потоке; False, если конвертация уже идёт"""
+    if CONVERSION_STATUS.get("status") == "converting":
+        return False
+    # Без явного формата — настроенный, а если сжатие выключено — gzip
+    method = compression(method) if method else (compression() if compression() != "none" else "gzip")
+    CONVERSION_STATUS.clear()
+    CONVERSION_STATUS.update({"status": "converting", "compression": method})
+
+    async def run():
+        try:
+            await asyncio.to_thread(convert_tree, roots, method, CONVERSION_STATUS)
+        except Exception as e:
+            logger.error(f"❌ Ошибка фоновой конвертации: {e}")
+            CONVERSION_STATUS.update({"status": "error", "error": str(e)})
+
+    asyncio.get_running_loop().create_task(run())
+    return True
@@ -0,0 +1,204 @@
+"""
+Обёртка над TelegramClient: единая точка учёта и ограничения всех запросов к Telegram API
+"""
+
+import os
+import time
+from collections import OrderedDict
+
+from telethon import utils
+
+from services import metrics
+from services import tracing
+from services.rate_limiter import get_limiter, flood_wait_seconds
+
+# Telegram отдаёт историю и диалоги страницами по 100
+PAGE_SIZE = 100
+
+# Сколько сущностей (отправителей, чатов) помнить на клиент
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "10000"))
+
+
+def media_type_of(media) -> str:
+    """Тип медиа для меток метрик"""
+    mime_type = getattr(media, 'mime_type', None) or ''
+    if mime_type.startswith('audio'):
+        return "voice"
+    if mime_type.startswith('video'):
+        return "video"
+    if mime_type:
+        return "document"
+    if 'Photo' in type(media).__name__:
+        return "photo"
+    return "other"
+
+
+def media_duration(message):
+    """Длительность голосового или видео, с
+
+    У документа Telethon нет поля duration: она лежит в атрибуте
+    DocumentAttributeAudio/DocumentAttributeVideo (его же читает message.file).
+    """
+    file = getattr(message, 'file', None)
+    duration = getattr(file, 'duration', None) if file is not None else None
+    if duration is not None:
+        return duration
+    document = getattr(message, 'document', None)
+    for attribute in getattr(document, 'attributes', None) or []:
+        duration = getattr(attribute, 'duration', None)
+        if duration is not None:
+            return duration
+    return None
+
+
+def account_of(client) -> str:
+    """Аккаунт клиента — файл сессии (у разных аккаунтов свои лимиты)"""
+    filename = getattr(getattr(client, 'session', None), 'filename', None)
+    if isinstance(filename, str):
+        return os.path.splitext(os.path.basename(filename))[0]
+    return "default"
+
+
+def _entity_key(entity):
+    """Ключ кэша сущностей или None, если запрос кэшировать нельзя"""
+    if isinstance(entity, (int, str)):
+        return entity
+    try:
+        return utils.get_peer_id(entity)
+    except Exception:
+        pass
+    for attr in ('user_id', 'chat_id', 'channel_id'):
+        value = getattr(entity, attr, None)
+        if value is not None:
+            return (attr, value)
+    return None
+
+
+class TrackedClient:
+    """Прокси к клиенту Telethon: метрики и ограничение скорости вызовов API
+
+    Всё, что не переопределено здесь, передаётся клиенту как есть.
+    """
+
+    def __init__(self, client, account: str = None):
+        self._client = client
+        self.limiter = get_limiter(account or account_of(client))
+        self._entities = OrderedDict()
+        # flood_sleep_threshold клиента не меняем: короткие FloodWait Telethon
+        # пережидает сам, в том числе в вызовах мимо обёртки (send_code_request,
+        # sign_in, служебные запросы). Более долгие приходят сюда ошибкой, и их
+        # обрабатывает ограничитель аккаунта
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    @property
+    def raw_client(self):
+        return self._client
+
+    async def _call(self, method: str, func, *args, **kwargs):
+        """Один запрос к API через ограничитель аккаунта, с метриками на каждую попытку"""
+        async def attempt():
+            async with metrics.telegram_call(method):
+                return await func(*args, **kwargs)
+        return await self.limiter.call(method, attempt)
+
+    async def get_entity(self, entity):
+        key = _entity_key(entity)
+        if key is not None and key in self._entities:
+            self._entities.move_to_end(key)
+            return self._entities[key]
+        with tracing.span("get_entity"):
+            result = await self._call("get_entity", self._client.get_entity, entity)
+        if key is not None:
+            self._entities[key] = result
+            if len(self._entities) > ENTITY_CACHE_SIZE:
+                self._entities.popitem(last=False)
+        return result
+
+    async def get_messages(self, *args, **kwargs):
+        with tracing.span("fetch_messages"):
+            return await self._call("get_messages", self._client.get_messages, *args, **kwargs)
+
+    async def download_media(self, media, file=None, **kwargs):
+        start = time.perf_counter()
+        media_type = media_type_of(media)
+        with tracing.span("media_download", type=media_type):
+            result = await self._call("download_media", self._client.download_media, media, file, **kwargs)
+        if isinstance(result, str):
+            metrics.observe_media(media_type, result, time.perf_counter() - start)
+        return result
+
+    async def iter_download(self, file, *args, **kwargs):
+        """Поблочное скачивание: каждый кусок — запрос через ограничитель
+
+        При FloodWait ограничитель ставит аккаунт на паузу, а ошибка уходит
+        вызывающему, который продолжает скачивание с последнего куска.
+        """
+        iterator = self._client.iter_download(file, *args, **kwargs).__aiter__()
+        while True:
+            await self.limiter.acquire()
+            try:
+                async with metrics.telegram_call("download_chunk"):
+                    chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                seconds = flood_wait_seconds(e)
+                if seconds is not None:
+                    self.limiter.on_flood_wait(seconds)
+                raise
+            self.limiter.on_success()
+            yield chunk
+
+    async def iter_messages(self, entity, limit=None, *, offset_id=0, reverse=False, ids=None, **kwargs):
+        """Постраничный обход истории через get_messages
+
+        Каждая страница — отдельный запрос через ограничитель, поэтому
+        FloodWait посреди истории приводит к паузе и повтору страницы, а не к
+        обрыву обхода.
+        """
+        chat = getattr(entity, 'id', entity)
+        if ids is not None:
+            result = await self.get_messages(entity, ids=ids)
+            for message in (result if isinstance(result, list) else [result]):
+                if message is not None:
+                    yield message
+            return
+
+        kwargs.pop('wait_time', None)
+        # Без границ total ответа — число всех подходящих сообщений: по нему обход
+        # завершается без лишнего пустого запроса в конце
+        unbounded = not (offset_id or kwargs.get('min_id') or kwargs.get('max_id')
+                         or kwargs.get('offset_date') or kwargs.get('add_offset'))
+        returned = 0
+        while limit is None or returned < limit:
+            page_limit = PAGE_SIZE if limit is None else min(PAGE_SIZE, limit - returned)
+            page = await self.get_messages(entity, limit=page_limit, offset_id=offset_id,
+                                           reverse=reverse, **kwargs)
+            for message in page:
+                returned += 1
+                metrics.MESSAGES_INGESTED.inc(chat=chat)
+                yield message
+            if len(page) < page_limit:
+                return
+            if unbounded and getattr(page, 'total', None) is not None and returned >= page.total:
+                return
+            # Следующая страница продолжается от последнего полученного сообщения
+            offset_id = page[-1].id
+            kwargs.pop('offset_date', None)
+            kwargs.pop('add_offset', None)
+
+    async def iter_dialogs(self, *args, **kwargs):
+        """Диалоги одним запросом через ограничитель (при FloodWait список запрашивается заново)"""
+        with tracing.span("fetch_dialogs"):
+            dialogs = await self._call("get_dialogs", self._client.get_dialogs, *args, **kwargs)
+        for dialog in dialogs:
+            yield dialog
+
+
+def wrap_client(client):
+    """Оборачивает клиент в TrackedClient (повторная обёртка не создаётся)"""
+    if client is None or isinstance(client, TrackedClient):
+        return client
+    return TrackedClient(client)
@@ -0,0 +1,115 @@
+"""
+Лёгкие спаны по этапам обработки с разбивкой времени по задаче и экспортом в Chrome trace
+"""
+
+import time
+import asyncio
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from services import serialization
+
+_current_tracer: contextvars.ContextVar = contextvars.ContextVar("tracer", default=None)
+
+
+class Tracer:
+    """Собирает длительности этапов одной задачи (скачивание, экспорт)"""
+
+    def __init__(self, job: str, record_events: bool = False):
+        self.job = job
+        self.record_events = record_events
+        self.started = time.perf_counter()
+        self.stages: Dict[str, Dict] = {}
+        self.events: List[Dict] = []
+        self._task_ids: Dict[int, int] = {}
+
+    def _tid(self) -> int:
+        """Номер асинхронной задачи — отдельная дорожка в Chrome trace"""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = id(task) if task else 0
+        return self._task_ids.setdefault(key, len(self._task_ids) + 1)
+
+    @contextmanager
+    def span(self, name: str, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            duration = end - start
+            stage = self.stages.setdefault(name, {"count": 0, "total_s": 0.0, "max_s": 0.0})
+            stage["count"] += 1
+            stage["total_s"] += duration
+            stage["max_s"] = max(stage["max_s"], duration)
+            if self.record_events:
+                self.events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": round((start - self.started) * 1e6, 1),
+                    "dur": round(duration * 1e6, 1),
+                    "pid": 1,
+                    "tid": self._tid(),
+                    "args": args
+                })
+
+    def breakdown(self) -> Dict:
+        """Суммарное время по этапам (мс), отсортированное по убыванию"""
+        stages = sorted(self.stages.items(), key=lambda item: item[1]["total_s"], reverse=True)
+        return {
+            "wall_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stages": {
+                name: {
+                    "count": stage["count"],
+                    "total_ms": round(stage["total_s"] * 1000, 1),
+                    "avg_ms": round(stage["total_s"] * 1000 / stage["count"], 2),
+                    "max_ms": round(stage["max_s"] * 1000, 1)
+                }
+                for name, stage in stages
+            }
+        }
+
+    def export_chrome(self, path: str):
+        """Сохраняет события в формате Chrome trace (chrome://tracing, Perfetto)"""
+        serialization.dump(path, {
+            "traceEvents": [
+                {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": self.job}},
+                *self.events
+            ],
+            "displayTimeUnit": "ms"
+        })
+
+
+@contextmanager
+def trace_job(job: str, record_events: bool = False):
+    """Делает трассировщик текущим для кода внутри блока (и порождённых задач)"""
+    tracer = Tracer(job, record_events)
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+
+
+def current_tracer() -> Optional[Tracer]:
+    return _current_tracer.get()
+
+
+@contextmanager
+def span(name: str, **args):
+    """Спан в текущем трассировщике; без трассировщика ничего не делает"""
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield
+        return
+    with tracer.span(name, **args):
+        yield
+
+
+def breakdown() -> Optional[Dict]:
+    """Текущая разбивка времени задачи или None вне трассировки"""
+    tracer = _current_tracer.get()
+    return tracer.breakdown() if tracer is not None else None
@@ -0,0 +1,99 @@
+"""
+Дисковый кэш расшифровок по хэшу содержимого аудио
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from services import metrics
+from services import serialization
+
+logger = logging.getLogger(__name__)
+
+# Меняется при изменении формата записей или параметров распознавания
+CACHE_VERSION = 2
+
+
+class TranscriptionCache:
+    """Хранит расшифровки по ключу (хэш аудио, модель, язык)"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        """SHA-256 содержимого файла"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def config_key(backend: str, model: str, language: str) -> str:
+        """Отпечаток конфигурации модели; при её смене старые записи не используются"""
+        raw = f"v{CACHE_VERSION}:{backend}:{model}:{language}"
+        return hashlib.sha1(raw.encode()).hexdigest()[:12]
+
+    def _entry_path(self, audio_hash: str, backend: str, model: str, language: str) -> str:
+        config_dir = os.path.join(self.root, self.config_key(backend, model, language))
+        return os.path.join(config_dir, audio_hash[:2], f"{audio_hash}.json")
+
+    def get_entry(self, audio_hash: str, backend: str, model: str, language: str) -> Optional[Dict]:
+        """Возвращает сохранённую запись (текст и сегменты) или None"""
+        entry_path = self._entry_path(audio_hash, backend, model, language)
+        try:
+            with open(entry_path, 'rb') as f:
+                entry = serialization.loads(f.read())
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            metrics.CACHE_REQUESTS.inc(cache="transcription", result="miss")
+            return None
+
+        with self._lock:
+            self.hits += 1
+        metrics.CACHE_REQUESTS.inc(cache="transcription", result="hit")
+        return entry
+
+    def get(self, audio_hash: str, backend: str, model: str, language: str) -> Optional[str]:
+        """Возвращает сохранённую расшифровку или None"""
+        entry = self.get_entry(audio_hash, backend, model, language)
+        return entry.get("text") if entry is not None else None
+
+    def put(self, audio_hash: str, backend: str, model: str, language: str, text: str,
+            segments: Optional[List[Dict]] = None):
+        """Сохраняет расшифровку (атомарно через временный файл)"""
+        entry_path = self._entry_path(audio_hash, backend, model, language)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        entry = {
+            "audio_hash": audio_hash,
+            "backend": backend,
+            "model": model,
+            "language": language,
+            "text": text,
+            "segments": segments or [],
+            "created_at": datetime.now().isoformat()
+        }
+        try:
+            serialization.dump(entry_path, entry, serialization.store_format())
+        except OSError as e:
+            logger.error(f"❌ Ошибка записи кэша расшифровок: {e}")
+
+    def stats(self) -> Dict:
+        """Статистика попаданий в кэш"""
+        total = self.hits + self.misses
+        return {
+            "root": self.root,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None
+        }
@@ -0,0 +1,102 @@
+"""
+Простое энергетическое определение речи (VAD) для обрезки тишины перед Whisper
+"""
+
+from typing import List, Tuple
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
+def frame_energy(audio: np.ndarray, sample_rate: int = SAMPLE_RATE, frame_ms: int = 30) -> np.ndarray:
+    """RMS-энергия аудио по кадрам фиксированной длины"""
+    frame = int(sample_rate * frame_ms / 1000)
+    frames_count = len(audio) // frame
+    if frames_count == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = audio[:frames_count * frame].reshape(frames_count, frame)
+    return np.sqrt(np.mean(frames.astype(np.float32) ** 2, axis=1))
+
+
+def speech_segments(audio: np.ndarray, sample_rate: int = SAMPLE_RATE, frame_ms: int = 30,
+                    min_silence_ms: int = 500, padding_ms: int = 200,
+                    floor: float = 0.005, ratio: float = 3.0) -> List[Tuple[int, int]]:
+    """Отрезки речи в сэмплах: [(начало, конец), ...]
+
+    Порог адаптивный: уровень шума (10-й перцентиль энергии кадров),
+    умноженный на ratio, но не ниже floor.
+    """
+    energy = frame_energy(audio, sample_rate, frame_ms)
+    if energy.size == 0:
+        return []
+
+    threshold = max(floor, float(np.percentile(energy, 10)) * ratio)
+    voiced = energy > threshold
+    if not voiced.any():
+        return []
+
+    # Границы участков речи по кадрам
+    edges = np.diff(voiced.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    frame = int(sample_rate * frame_ms / 1000)
+    min_gap = max(1, min_silence_ms // frame_ms)
+    padding = int(sample_rate * padding_ms / 1000)
+
+    # Склеиваем участки, разделённые короткими паузами
+    segments = []
+    seg_start, seg_end = starts[0], ends[0]
+    for start, end in zip(starts[1:], ends[1:]):
+        if start - seg_end < min_gap:
+            seg_end = end
+        else:
+            segments.append((seg_start, seg_end))
+            seg_start, seg_end = start, end
+    segments.append((seg_start, seg_end))
+
+    return [
+        (max(0, int(start) * frame - padding), min(len(audio), int(end) * frame + padding))
+        for start, end in segments
+    ]
+
+
+def trim_silence(audio: np.ndarray, sample_rate: int = SAMPLE_RATE, **kwargs) -> np.ndarray:
+    """Оставляет только участки речи"""
+    segments = speech_segments(audio, sample_rate, **kwargs)
+    if not segments:
+        return audio[:0]
+    return np.concatenate([audio[start:end] for start, end in segments])
+
+
+def to_original_time(seconds: float, segments: List[Tuple[int, int]], sample_rate: int = SAMPLE_RATE) -> float:
+    """Переводит время в обрезанном аудио во время исходной записи"""
+    position = int(seconds * sample_rate)
+    for start, end in segments:
+        length = end - start
+        if position <= length:
+            return (start + position) / sample_rate
+        position -= length
+    return segments[-1][1] / sample_rate if segments else seconds
+
+
+def split_at_silence(audio: np.ndarray, sample_rate: int = SAMPLE_RATE, target_seconds: float = 60.0,
+                     **kwargs) -> List[Tuple[int, int]]:
+    """Режет запись на куски примерно по target_seconds, разрезая только в паузах
+
+    Речь без пауз длиннее 2 * target_seconds режется принудительно.
+    """
+    target = int(target_seconds * sample_rate)
+    chunks = []
+    for start, end in speech_segments(audio, sample_rate, **kwargs):
+        # Слишком длинная непрерывная речь
+        while end - start > 2 * target:
+            chunks.append((start, start + target))
+            start += target
+
+        if chunks and end - chunks[-1][0] <= target:
+            chunks[-1] = (chunks[-1][0], end)
+        else:
+            chunks.append((start, end))
+    return chunks
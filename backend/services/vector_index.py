@@ -0,0 +1,238 @@
+"""
+Векторный индекс сообщений чата на диске с приближённым поиском ближайших (IVF)
+
+Каталог индекса чата:
+    vectors.f32  — нормированные эмбеддинги подряд (float32, дописываются)
+    ids.i8       — id сообщений в том же порядке
+    assign.i4    — номер кластера каждого вектора
+    centroids.npy, meta.json — центроиды k-means и служебные данные
+
+Пока векторов мало, поиск точный (одно умножение матрицы на вектор).
+Когда их больше IVF_MIN_SIZE, векторы делятся на кластеры k-means, и
+запрос сравнивается только с векторами IVF_NPROBE ближайших кластеров —
+поиск остаётся сублинейным по размеру истории. Центроиды переобучаются,
+когда индекс вырос вдвое с прошлого обучения.
+"""
+
+import os
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from services import file_io
+from services import serialization
+
+logger = logging.getLogger(__name__)
+
+IVF_MIN_SIZE = int(os.getenv("IVF_MIN_SIZE", "2048"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+IVF_TRAIN_SAMPLE = int(os.getenv("IVF_TRAIN_SAMPLE", "20000"))
+IVF_ITERATIONS = 10
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", "32"))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def _append(buffer: Optional[np.ndarray], count: int, rows: np.ndarray) -> np.ndarray:
+    """Дописывает строки в буфер с удвоением ёмкости (без копии всего индекса на каждое добавление)"""
+    needed = count + len(rows)
+    if buffer is None or len(buffer) < needed:
+        grown = np.empty((max(needed, 2 * count, 64),) + rows.shape[1:], dtype=rows.dtype)
+        if buffer is not None:
+            grown[:count] = buffer[:count]
+        buffer = grown
+    buffer[count:needed] = rows
+    return buffer
+
+
+def _kmeans(vectors: np.ndarray, k: int, seed: int = 0) -> np.ndarray:
+    """Сферический k-means: центроиды — нормированные средние по косинусной близости"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(IVF_ITERATIONS):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        empty = ~sums.any(axis=1)
+        # Пустой кластер получает случайный вектор, чтобы не пропадать
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids.astype(np.float32)
+
+
+class VectorIndex:
+    """Индекс эмбеддингов сообщений одного чата"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = asyncio.Lock()
+        self.meta = {"dim": None, "count": 0, "last_message_id": 0, "trained_count": 0, "model": None}
+        meta_file = self._path("meta.json")
+        if os.path.exists(meta_file):
+            self.meta.update(serialization.load(meta_file))
+        dim = self.meta["dim"]
+        count = self.meta["count"]
+        # Файлы могут быть длиннее meta (обрыв после записи векторов): берём count из meta
+        # Буферы ниже длиннее count (запас ёмкости); действительны первые count строк
+        self._vectors = np.fromfile(self._path("vectors.f32"), dtype=np.float32,
+                                    count=count * dim).reshape(count, dim) if count else None
+        self._ids = np.fromfile(self._path("ids.i8"), dtype=np.int64, count=count) if count else None
+        self.centroids = np.load(self._path("centroids.npy")) if os.path.exists(self._path("centroids.npy")) else None
+        self._assign = np.fromfile(self._path("assign.i4"), dtype=np.int32, count=count) \
+            if self.centroids is not None and count else None
+        self._lists = None
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:self.meta["count"]]
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self.meta["count"]] if self._ids is not None else np.empty(0, np.int64)
+
+    @property
+    def assign(self) -> np.ndarray:
+        return self._assign[:self.meta["count"]]
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def _save_meta(self):
+        serialization.dump(self._path("meta.json"), self.meta, serialization.store_format())
+
+    def _truncate(self, name: str, itemsize: int):
+        """Обрезает хвост файла, не учтённый в meta (после обрыва записи)"""
+        path = self._path(name)
+        if os.path.exists(path) and os.path.getsize(path) != self.meta["count"] * itemsize:
+            with open(path, 'r+b') as f:
+                f.truncate(self.meta["count"] * itemsize)
+
+    def add(self, message_ids: Sequence[int], embeddings, model: Optional[str] = None):
+        """Дописывает векторы в индекс (нормирует и относит к ближайшему кластеру)"""
+        if not len(message_ids):
+            return
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+        ids = np.asarray(message_ids, dtype=np.int64)
+        if self.meta["dim"] is None:
+            self.meta["dim"] = int(vectors.shape[1])
+            self.meta["model"] = model
+        elif vectors.shape[1] != self.meta["dim"]:
+            raise ValueError(f"Размерность эмбеддингов {vectors.shape[1]} вместо {self.meta['dim']}")
+
+        dim = self.meta["dim"]
+        self._truncate("vectors.f32", dim * 4)
+        self._truncate("ids.i8", 8)
+        with open(self._path("vectors.f32"), 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(self._path("ids.i8"), 'ab') as f:
+            f.write(ids.tobytes())
+        count = self.meta["count"]
+        self._vectors = _append(self._vectors, count, vectors)
+        self._ids = _append(self._ids, count, ids)
+
+        if self.centroids is not None:
+            assign = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+            self._truncate("assign.i4", 4)
+            with open(self._path("assign.i4"), 'ab') as f:
+                f.write(assign.tobytes())
+            self._assign = _append(self._assign, count, assign)
+
+        self.meta["count"] = count = count + len(ids)
+        self.meta["last_message_id"] = max(self.meta["last_message_id"], int(ids.max()))
+        if count >= IVF_MIN_SIZE and count >= 2 * self.meta["trained_count"]:
+            self.train()
+        self._save_meta()
+
+    def train(self):
+        """Обучает центроиды k-means (≈√n кластеров) и перераспределяет векторы"""
+        count = len(self.ids)
+        nlist = int(min(1024, max(1, np.sqrt(count))))
+        rng = np.random.default_rng(count)
+        sample = self.vectors[rng.choice(count, size=min(count, IVF_TRAIN_SAMPLE), replace=False)]
+        self.centroids = _kmeans(sample, nlist)
+        self._assign = np.concatenate([
+            np.argmax(self.vectors[i:i + 65536] @ self.centroids.T, axis=1)
+            for i in range(0, count, 65536)
+        ]).astype(np.int32)
+        np.save(self._path("centroids.npy"), self.centroids)
+        self.assign.tofile(self._path("assign.i4"))
+        self.meta["trained_count"] = count
+        self._lists = None
+        logger.info(f"🧭 Индекс {os.path.basename(self.directory)}: {nlist} кластеров на {count} векторов")
+
+    def _inverted_lists(self) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Номера векторов, сгруппированные по кластерам, границы групп и число учтённых векторов
+
+        Векторы, добавленные после построения списков, просматриваются
+        отдельным «хвостом»; списки перестраиваются, когда хвост больше 10%.
+        """
+        count = self.meta["count"]
+        if self._lists is None or count - self._lists[2] > max(1024, count // 10):
+            assign = self.assign
+            order = np.argsort(assign, kind="stable")
+            bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, bounds, count)
+        return self._lists
+
+    def search(self, query, k: int = 10, exclude_ids: Sequence[int] = (),
+               nprobe: int = IVF_NPROBE) -> List[Tuple[int, float]]:
+        """k ближайших по косинусу сообщений: [(message_id, близость)]"""
+        if not len(self.ids) or k <= 0:
+            return []
+        query = _normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        if self.centroids is None:
+            candidates = np.arange(len(self.ids))
+        else:
+            order, bounds, listed = self._inverted_lists()
+            nearest = np.argsort(-(self.centroids @ query))[:nprobe]
+            tail = np.arange(listed, len(self.ids))
+            tail = tail[np.isin(self.assign[listed:], nearest)]
+            candidates = np.concatenate([order[bounds[c]:bounds[c + 1]] for c in nearest] + [tail])
+        if len(exclude_ids):
+            candidates = candidates[~np.isin(self.ids[candidates], np.asarray(exclude_ids, dtype=np.int64))]
+        if not len(candidates):
+            return []
+        scores = self.vectors[candidates] @ query
+        top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.ids[candidates[i]]), float(scores[i])) for i in top]
+
+    async def update(self, messages: List[Dict], embed: Callable, model: Optional[str] = None) -> Dict[int, np.ndarray]:
+        """Эмбеддит ещё не проиндексированные сообщения пачками по EMBED_BATCH
+
+        Возвращает {message_id: вектор} для добавленных сообщений. Запись
+        векторов и переобучение k-means идут в пуле файловых операций, чтобы
+        не останавливать цикл событий.
+        """
+        last_id = self.meta["last_message_id"]
+        pending = [m for m in messages
+                   if (m.get("message_id") or 0) > last_id and (m.get("transcription") or m.get("text"))]
+        added = {}
+        for i in range(0, len(pending), EMBED_BATCH):
+            batch = pending[i:i + EMBED_BATCH]
+            embeddings = await embed([m.get("transcription") or m["text"] for m in batch])
+            await file_io.run(self.add, [m["message_id"] for m in batch], embeddings, model)
+            added.update({m["message_id"]: self.vectors[len(self.ids) - len(batch) + j] for j, m in enumerate(batch)})
+        return added
+
+
+_indexes: Dict[str, VectorIndex] = {}
+
+
+async def get_index(directory: str) -> VectorIndex:
+    """Индекс каталога (загружается с диска один раз на процесс, вне цикла событий)"""
+    index = _indexes.get(directory)
+    if index is None:
+        loaded = await file_io.run(VectorIndex, directory)
+        # Пока индекс загружался, его мог загрузить другой запрос
+        index = _indexes.setdefault(directory, loaded)
+    return index
@@ -4,26 +4,65 @@
 """
 
 import os
-import json
 import asyncio
-import whisper
+from functools import partial
 from datetime import datetime
 from typing import List, Dict, Optional
-from telethon import TelegramClient, events
+from telethon import TelegramClient, utils
 from telethon.tl.types import Message, MessageMediaDocument, MessageMediaPhoto
 from telethon.errors import SessionPasswordNeededError
 import logging
 
+from services import asr
+from services import tracing
+from services.llm import analyze_with_ollama, ANALYTICS_IN_PROMPT
+from services.dispatcher import ChatDispatcher
+from services.transcription_cache import TranscriptionCache
+from services.telegram_client import media_duration, wrap_client
+from services.history_fetch import iter_history
+from services import storage
+from services import memory
+from services import file_io
+from services.media_download import download_resumable, is_complete
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Модель Ollama для построения и обновления профилей
+PROFILE_MODEL = os.getenv("PROFILE_MODEL", "llama3")
+
+# Неизменная часть промпта профиля (идёт первой, чтобы её context переиспользовался)
+PROFILE_INSTRUCTIONS = """
+Анализируй переписку и обновляй профиль пользователя.
+
+Проанализируй:
+1. Тему общения
+2. Тональность (дружелюбная, формальная, эмоциональная)
+3. Стиль общения (лаконичный, подробный, с эмодзи)
+4. Намерения участников
+5. Динамику отношений
+
+Ответь в формате:
+Тема: [тема]
+Тон: [тональность] 
+Стиль: [стиль общения]
+Намерения: [что хотят участники]
+Динамика: [как развиваются отношения]
+"""
+# Сколько релевантных старых сообщений добавлять к последним (0 — не искать)
+EMBED_CONTEXT_K = int(os.getenv("EMBED_CONTEXT_K", "8"))
+# Сколько последних сообщений идёт в промпт профиля целиком (остальное — сводками)
+PROFILE_RECENT_MESSAGES = int(os.getenv("PROFILE_RECENT_MESSAGES", "30"))
+
 class TelegramAnalyzer:
     def __init__(self, api_id: int, api_hash: str, phone: str):
         self.api_id = api_id
         self.api_hash = api_hash
         self.phone = phone
         self.client = None
+        self.dispatcher = None
+        self.listening = {}
         
         # Создаём структуру папок
         self.data_dir = "data"
@@ -31,25 +70,29 @@ class TelegramAnalyzer:
         self.live_dir = os.path.join(self.data_dir, "live")
         self.media_dir = os.path.join(self.data_dir, "media")
         self.profiles_dir = os.path.join(self.data_dir, "profiles")
+        self.transcripts_dir = os.path.join(self.data_dir, "transcripts")
+        self.traces_dir = os.path.join(self.data_dir, "traces")
+        self.embeddings_dir = os.path.join(self.data_dir, "embeddings")
+        self.summaries_dir = os.path.join(self.data_dir, "summaries")
         
         for directory in [self.sessions_dir, self.live_dir, self.media_dir, self.profiles_dir]:
             os.makedirs(directory, exist_ok=True)
         
-        # Инициализируем Whisper
-        try:
-            self.whisper_model = whisper.load_model("base")
-            logger.info("✅ Whisper модель загружена")
-        except Exception as e:
-            logger.error(f"❌ Ошибка загрузки Whisper: {e}")
-            self.whisper_model = None
+        # Whisper загружается лениво; None — модель выбирается по длительности
+        self.whisper_model_name = None
+        self.transcription_cache = TranscriptionCache(self.transcripts_dir)
+        
+        # Разбивка времени по этапам последних скачиваний истории (по чату)
+        self.job_timings = {}
     
     async def connect(self):
         """Подключаемся к Telegram"""
         session_path = os.path.join(self.sessions_dir, f"{self.phone}.session")
-        self.client = TelegramClient(session_path, self.api_id, self.api_hash)
+        self.client = wrap_client(TelegramClient(session_path, self.api_id, self.api_hash))
         
         try:
             await self.client.connect()
+            self.dispatcher = ChatDispatcher(self.client)
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка подключения: {e}")
@@ -97,6 +140,9 @@ class TelegramAnalyzer:
     
     async def disconnect(self):
         """Отключаемся от Telegram"""
+        if self.dispatcher:
+            await self.dispatcher.close()
+            self.listening.clear()
         if self.client:
             await self.client.disconnect()
             logger.info("🔌 Отключено от Telegram")
@@ -110,8 +156,23 @@ class TelegramAnalyzer:
         else:
             return str(chat.id)
     
-    async def download_history(self, chat: str, limit: int = 3000) -> bool:
-        """Скачивает всю историю сообщений"""
+    async def download_history(self, chat: str, limit: int = 3000, trace: bool = False,
+                               shards: Optional[int] = None) -> bool:
+        """Скачивает всю историю сообщений, замеряя время по этапам"""
+        with tracing.trace_job(f"history_{chat}", record_events=trace) as tracer:
+            success = await self._download_history(chat, limit, shards)
+        
+        self.job_timings[chat] = tracer.breakdown()
+        if trace:
+            os.makedirs(self.traces_dir, exist_ok=True)
+            safe_chat = chat.lstrip('@').replace('/', '_')
+            trace_file = os.path.join(self.traces_dir, f"{safe_chat}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+            tracer.export_chrome(trace_file)
+            self.job_timings[chat]["trace_file"] = trace_file
+            logger.info(f"🧭 Трасса сохранена: {trace_file}")
+        return success
+    
+    async def _download_history(self, chat: str, limit: int, shards: Optional[int]) -> bool:
         try:
             # Получаем чат
             if chat.startswith('@'):
@@ -129,25 +190,27 @@ class TelegramAnalyzer:
             messages = []
             processed = 0
             
-            # Скачиваем сообщения
-            async for message in self.client.iter_messages(entity, limit=limit):
+            # Скачиваем сообщения (при shards > 1 — параллельно по диапазонам id)
+            async for message in iter_history(self.client, entity, limit=limit, shards=shards):
                 processed += 1
                 if processed % 100 == 0:
                     logger.info(f"⏳ Обработано сообщений: {processed}")
                 
-                msg_data = await self.process_message(message)
+                with tracing.span("process_message"):
+                    msg_data = await self.process_message(message)
                 if msg_data:
                     messages.append(msg_data)
             
             # Сохраняем в JSON
-            with open(live_file, 'w', encoding='utf-8') as f:
-                json.dump(messages, f, ensure_ascii=False, indent=2)
+            with tracing.span("write_files"):
+                await file_io.run(storage.write_messages, live_file, messages)
             
             logger.info(f"✅ История сохранена: {len(messages)} сообщений")
             
             # Создаём начальный профиль
             if messages:
-                await self.create_initial_profile(chat_key, messages)
+                with tracing.span("initial_profile"):
+                    await self.create_initial_profile(chat_key, messages)
             
             return True
             
@@ -190,7 +253,7 @@ class TelegramAnalyzer:
                 voice_file = await self.download_media(message.voice, "voice")
                 if voice_file:
                     # Расшифровываем аудио
-                    transcription = await self.whisper_transcribe(voice_file)
+                    transcription = await self.whisper_transcribe(voice_file, media_duration(message))
                     msg_data.update({
                         "type": "voice",
                         "text": f"[аудио: {transcription}]" if transcription else "[аудио: не удалось расшифровать]",
@@ -241,8 +304,8 @@ class TelegramAnalyzer:
             
             file_path = os.path.join(self.media_dir, filename)
             
-            if not os.path.exists(file_path):
-                await self.client.download_media(media, file_path)
+            if not is_complete(file_path, media):
+                await download_resumable(self.client, media, file_path)
                 logger.info(f"📁 Скачан файл: {filename}")
             
             return file_path
@@ -251,29 +314,40 @@ class TelegramAnalyzer:
             logger.error(f"❌ Ошибка скачивания медиа: {e}")
             return None
     
-    async def whisper_transcribe(self, file_path: str) -> Optional[str]:
+    async def whisper_transcribe(self, file_path: str, duration: Optional[float] = None) -> Optional[str]:
         """Расшифровывает аудио через Whisper"""
-        if not self.whisper_model:
-            return None
-        
-        try:
-            result = self.whisper_model.transcribe(file_path, language="ru")
-            return result["text"].strip()
-        except Exception as e:
-            logger.error(f"❌ Ошибка расшифровки аудио: {e}")
-            return None
+        return await asr.transcribe(file_path, asr.BACKEND_OPENAI, self.whisper_model_name,
+                                    cache=self.transcription_cache, duration=duration)
+    
+    async def summarize(self, prompt: str, chat_key: str = "default") -> str:
+        """Сводка периода для иерархической памяти (ошибка LLM пробрасывается)"""
+        return await analyze_with_ollama(prompt, PROFILE_MODEL, chat_key)
+    
+    async def update_memory(self, chat_key: str, messages: List[Dict]) -> str:
+        """Достраивает сводки закрытых дней и недель; возвращает контекст памяти для промпта"""
+        chat_memory = await memory.get_memory(os.path.join(self.summaries_dir, f"{chat_key}.json"))
+        async with chat_memory.lock:
+            try:
+                await chat_memory.update(messages, partial(self.summarize, chat_key=chat_key))
+            except Exception as e:
+                logger.warning(f"⚠️ Сводки {chat_key} построены не полностью: {e}")
+        return chat_memory.context()
     
     async def create_initial_profile(self, chat_key: str, messages: List[Dict]):
         """Создаёт начальный профиль на основе истории"""
         try:
-            # Анализируем последние 100 сообщений для создания профиля
-            recent_messages = messages[-100:] if len(messages) > 100 else messages
+            # Вся история сворачивается в сводки, последние сообщения идут целиком
+            summaries = await self.update_memory(chat_key, messages)
+            recent_messages = messages[-PROFILE_RECENT_MESSAGES:]
             
             # Форматируем для анализа
             formatted_messages = self.format_for_prompt(recent_messages)
             
             # Анализируем через LLM
-            analysis = await self.analyze_with_context(formatted_messages, {})
+            analysis = await self.analyze_with_context(formatted_messages, {}, chat_key, summaries)
+            if analysis is None:
+                logger.warning(f"⚠️ Профиль {chat_key} не создан: LLM недоступна")
+                return
             
             # Создаём профиль
             profile = {
@@ -286,22 +360,29 @@ class TelegramAnalyzer:
             
             # Сохраняем профиль
             profile_file = os.path.join(self.profiles_dir, f"{chat_key}_profile.json")
-            with open(profile_file, 'w', encoding='utf-8') as f:
-                json.dump(profile, f, ensure_ascii=False, indent=2)
+            await file_io.write(profile_file, profile, pretty=True)
             
             # Сохраняем последний анализ
             analysis_file = os.path.join(self.profiles_dir, f"{chat_key}_last_analysis.txt")
-            with open(analysis_file, 'w', encoding='utf-8') as f:
-                f.write(analysis)
+            await file_io.write_text(analysis_file, analysis)
             
             logger.info(f"✅ Создан профиль для {chat_key}")
             
         except Exception as e:
             logger.error(f"❌ Ошибка создания профиля: {e}")
     
-    def format_for_prompt(self, messages: List[Dict], profile: Dict = None) -> str:
+    def format_for_prompt(self, messages: List[Dict], profile: Dict = None, analytics_summary: str = None,
+                          relevant_messages: List[Dict] = None) -> str:
         """Форматирует сообщения для LLM"""
         formatted = []
+        if analytics_summary:
+            formatted.append(analytics_summary + "\n")
+        
+        if relevant_messages:
+            formatted.append("🔎 Релевантные сообщения из истории:")
+            for msg in relevant_messages:
+                formatted.append(f"[{msg['time'].replace('T', ' ')}] {msg['from']}: {msg['text']}")
+            formatted.append("\n💬 Последние сообщения:")
         
         for msg in messages:
             time_str = msg['time'].replace('T', ' ')
@@ -316,41 +397,33 @@ class TelegramAnalyzer:
         
         return result
     
-    async def analyze_with_context(self, messages_text: str, profile: Dict) -> str:
-        """Анализирует сообщения с контекстом профиля"""
+    async def analyze_with_context(self, messages_text: str, profile: Dict, chat_key: str = "default",
+                                   summaries: str = None) -> Optional[str]:
+        """Анализирует сообщения с контекстом профиля (chat_key — очередь чата в пуле LLM)
+        
+        При ошибке LLM возвращает None: текст ошибки не должен попасть в профиль.
+        
+        Инструкции и сводки истории меняются редко и идут началом промпта:
+        LLM-слой отправляет его на тот же бэкенд, где это начало уже в
+        KV-кэше Ollama, и заново обрабатываются только новые сообщения.
+        """
         try:
-            # Здесь будет вызов LLM
-            # Пока возвращаем заглушку
+            prefix = PROFILE_INSTRUCTIONS
+            if summaries:
+                prefix += f"\n🧠 Сводки истории:\n{summaries}\n"
             prompt = f"""
-Анализируй переписку и обновляй профиль пользователя.
-
 Переписка:
 {messages_text}
-
-Проанализируй:
-1. Тему общения
-2. Тональность (дружелюбная, формальная, эмоциональная)
-3. Стиль общения (лаконичный, подробный, с эмодзи)
-4. Намерения участников
-5. Динамику отношений
-
-Ответь в формате:
-Тема: [тема]
-Тон: [тональность] 
-Стиль: [стиль общения]
-Намерения: [что хотят участники]
-Динамика: [как развиваются отношения]
-            """
+"""
             
-            # TODO: Заменить на реальный вызов LLM
-            return "Анализ будет выполнен через LLM"
+            return await analyze_with_ollama(prompt, PROFILE_MODEL, chat_key, prefix=prefix)
             
         except Exception as e:
             logger.error(f"❌ Ошибка анализа: {e}")
-            return "Ошибка анализа"
+            return None
     
-    async def listen_to_new_messages(self, chat: str):
-        """Слушает новые сообщения в реальном времени"""
+    async def listen_to_new_messages(self, chat: str) -> bool:
+        """Подписывает чат на новые сообщения через общий диспетчер"""
         try:
             # Получаем чат
             if chat.startswith('@'):
@@ -359,93 +432,132 @@ class TelegramAnalyzer:
                 entity = await self.client.get_entity(int(chat))
             
             chat_key = self.get_chat_key(entity)
+            peer_id = utils.get_peer_id(entity)
             logger.info(f"👂 Слушаем новые сообщения в {chat_key}")
             
-            @self.client.on(events.NewMessage(chats=entity))
-            async def handle_new_message(event):
-                try:
-                    # Обрабатываем новое сообщение
-                    msg_data = await self.process_message(event.message)
-                    if msg_data:
-                        # Добавляем в live файл
-                        await self.add_to_live(chat_key, msg_data)
-                        
-                        # Анализируем с контекстом
-                        await self.analyze_new_message(chat_key, msg_data)
-                        
-                        logger.info(f"📨 Новое сообщение от {msg_data['from']}: {msg_data['text'][:50]}...")
-                
-                except Exception as e:
-                    logger.error(f"❌ Ошибка обработки нового сообщения: {e}")
+            async def handle_new_message(message):
+                # Обрабатываем новое сообщение
+                msg_data = await self.process_message(message)
+                if msg_data:
+                    # Добавляем в live файл
+                    await self.add_to_live(chat_key, msg_data)
+                    
+                    # Анализируем с контекстом
+                    await self.analyze_new_message(chat_key, msg_data)
+                    
+                    logger.info(f"📨 Новое сообщение от {msg_data['from']}: {msg_data['text'][:50]}...")
             
-            # Запускаем слушание
-            await self.client.run_until_disconnected()
+            self.dispatcher.add_chat(peer_id, handle_new_message, chat_key)
+            self.listening[chat] = peer_id
+            return True
             
         except Exception as e:
             logger.error(f"❌ Ошибка запуска слушания: {e}")
+            return False
+    
+    async def stop_listening(self, chat: str) -> bool:
+        """Отписывает чат от диспетчера"""
+        peer_id = self.listening.pop(chat, None)
+        if peer_id is None or not self.dispatcher:
+            return False
+        return await self.dispatcher.remove_chat(peer_id)
     
     async def add_to_live(self, chat_key: str, msg_data: Dict):
         """Добавляет новое сообщение в live файл"""
         try:
             live_file = os.path.join(self.live_dir, f"{chat_key}.json")
             
-            # Загружаем существующие сообщения
-            messages = []
-            if os.path.exists(live_file):
-                with open(live_file, 'r', encoding='utf-8') as f:
-                    messages = json.load(f)
-            
-            # Добавляем новое сообщение
-            messages.append(msg_data)
-            
-            # Сохраняем обратно
-            with open(live_file, 'w', encoding='utf-8') as f:
-                json.dump(messages, f, ensure_ascii=False, indent=2)
+            # Сжатый файл дописывается новым кадром, несжатый — перезаписывается (в потоке)
+            await file_io.run(storage.append_message, live_file, msg_data)
                 
         except Exception as e:
             logger.error(f"❌ Ошибка добавления в live: {e}")
     
-    async def analyze_new_message(self, chat_key: str, new_msg: Dict):
-        """Анализирует новое сообщение с контекстом"""
+    async def find_relevant_messages(self, chat_key: str, new_msg: Dict, all_messages: List[Dict],
+                                     recent_messages: List[Dict]) -> List[Dict]:
+        """Ищет в истории сообщения, близкие к новому, через индекс эмбеддингов
+        
+        Новые сообщения live-файла эмбеддятся инкрементально; при ошибке
+        Ollama возвращается пустой список — в контексте остаются последние.
+        """
+        query_text = new_msg.get("transcription") or new_msg.get("text")
+        if EMBED_CONTEXT_K <= 0 or not query_text or len(all_messages) <= len(recent_messages):
+            return []
+        try:
+            # NumPy и индекс загружаются только при первом поиске
+            from services import vector_index
+            from services.llm import embed_with_ollama, EMBED_MODEL
+            
+            embed = partial(embed_with_ollama, model=EMBED_MODEL, tenant=chat_key)
+            index = await vector_index.get_index(os.path.join(self.embeddings_dir, chat_key))
+            async with index.lock:
+                added = await index.update(all_messages, embed, EMBED_MODEL)
+                query = added.get(new_msg.get("message_id"))
+                if query is None:
+                    query = (await embed([query_text]))[0]
+                recent_ids = [m["message_id"] for m in recent_messages if m.get("message_id")]
+                found = await file_io.run(index.search, query, EMBED_CONTEXT_K, exclude_ids=recent_ids)
+        except Exception as e:
+            logger.warning(f"⚠️ Поиск релевантных сообщений недоступен: {e}")
+            return []
+        
+        found_ids = {message_id for message_id, _ in found}
+        return [m for m in all_messages if m.get("message_id") in found_ids]
+    
+    async def analyze_new_message(self, chat_key: str, new_msg: Dict) -> Optional[str]:
+        """Анализирует новое сообщение с контекстом; возвращает новый анализ (None при ошибке)"""
         try:
             # Загружаем профиль
             profile_file = os.path.join(self.profiles_dir, f"{chat_key}_profile.json")
-            profile = {}
-            if os.path.exists(profile_file):
-                with open(profile_file, 'r', encoding='utf-8') as f:
-                    profile = json.load(f)
+            profile = await file_io.read(profile_file, {})
             
-            # Загружаем последние 30 сообщений
+            # Загружаем последние сообщения (разбор файла — вне цикла событий)
             live_file = os.path.join(self.live_dir, f"{chat_key}.json")
-            recent_messages = []
-            if os.path.exists(live_file):
-                with open(live_file, 'r', encoding='utf-8') as f:
-                    all_messages = json.load(f)
-                    recent_messages = all_messages[-30:]  # Последние 30
+            all_messages = await file_io.run(storage.read_messages, live_file)
+            recent_messages = all_messages[-PROFILE_RECENT_MESSAGES:]
             
-            # Форматируем для анализа
-            formatted_messages = self.format_for_prompt(recent_messages, profile)
+            # Более ранняя история — ограниченным набором сводок вместо прежнего анализа
+            summaries = await self.update_memory(chat_key, all_messages)
+            
+            # Сводка статистики по всей истории (без LLM, по желанию)
+            analytics_summary = None
+            if ANALYTICS_IN_PROMPT and all_messages:
+                # NumPy загружается только при включённой сводке
+                from services import analytics
+                analytics_summary = await file_io.run(
+                    lambda: analytics.summary_text(analytics.analyze(analytics.arrays_from_messages(all_messages)))
+                )
+            
+            # Старые сообщения, близкие по смыслу к новому
+            relevant_messages = await self.find_relevant_messages(chat_key, new_msg, all_messages, recent_messages)
+            
+            # Форматируем для анализа (прежний анализ — только пока нет сводок)
+            formatted_messages = self.format_for_prompt(recent_messages, None if summaries else profile,
+                                                        analytics_summary, relevant_messages)
             
             # Анализируем
-            new_analysis = await self.analyze_with_context(formatted_messages, profile)
+            new_analysis = await self.analyze_with_context(formatted_messages, profile, chat_key, summaries)
+            if new_analysis is None:
+                # Прежний профиль остаётся как был
+                return None
             
             # Обновляем профиль
             profile['last_updated'] = datetime.now().isoformat()
             profile['analysis'] = new_analysis
             
             # Сохраняем обновлённый профиль
-            with open(profile_file, 'w', encoding='utf-8') as f:
-                json.dump(profile, f, ensure_ascii=False, indent=2)
+            await file_io.write(profile_file, profile, pretty=True)
             
             # Сохраняем последний анализ
             analysis_file = os.path.join(self.profiles_dir, f"{chat_key}_last_analysis.txt")
-            with open(analysis_file, 'w', encoding='utf-8') as f:
-                f.write(new_analysis)
+            await file_io.write_text(analysis_file, new_analysis)
             
             logger.info(f"✅ Профиль {chat_key} обновлён")
+            return new_analysis
             
         except Exception as e:
             logger.error(f"❌ Ошибка анализа нового сообщения: {e}")
+            return None
 
 # Пример использования
 async def main():
@@ -463,6 +575,7 @@ async def main():
         
         # Слушаем новые сообщения
         await analyzer.listen_to_new_messages("@azalia")
+        await analyzer.client.run_until_disconnected()
     
     await analyzer.disconnect()
 
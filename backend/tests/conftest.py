@@ -0,0 +1,13 @@
+"""
+Общие настройки тестов: сервисы импортируются как в приложении (from services import ...)
+
+Запуск из папки backend:
+    python -m pytest -q
+"""
+
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
@@ -0,0 +1,108 @@
+"""Пакетный планировщик: общий лимит слотов, лимит пакета, приоритет, отмена"""
+
+import asyncio
+
+from services.batch import BatchRunner, CANCELLED, COMPLETED
+
+
+class Tracker:
+    """work(item) для пакетов: считает одновременные элементы и порядок запуска"""
+
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+        self.started = []
+
+    def work(self, tag: str):
+        async def run(item: str):
+            self.started.append(f"{tag}:{item}")
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            try:
+                await asyncio.sleep(self.delay)
+                if item == "fail":
+                    raise RuntimeError("нет экспорта")
+                return f"готово {item}"
+            finally:
+                self.active -= 1
+        return run
+
+
+def items(count: int):
+    return [str(i) for i in range(count)]
+
+
+def test_batch_parallelism_is_capped():
+    async def run():
+        runner, tracker = BatchRunner(max_parallel=4), Tracker()
+        batch = runner.submit(items(8), tracker.work("a"), parallelism=2)
+        await batch.done_event.wait()
+        return batch, tracker
+
+    batch, tracker = asyncio.run(run())
+    assert tracker.peak == 2
+    assert batch.status == COMPLETED
+    assert batch.counts() == {"success": 8}
+
+
+def test_slots_are_shared_between_batches():
+    async def run():
+        runner, tracker = BatchRunner(max_parallel=3), Tracker()
+        batches = [runner.submit(items(6), tracker.work(tag), parallelism=3) for tag in "ab"]
+        await asyncio.gather(*(batch.done_event.wait() for batch in batches))
+        return runner, tracker
+
+    runner, tracker = asyncio.run(run())
+    assert tracker.peak == 3
+    assert runner.running == 0
+
+
+def test_higher_priority_batch_takes_next_free_slot():
+    async def run():
+        runner, tracker = BatchRunner(max_parallel=1), Tracker()
+        low = runner.submit(items(3), tracker.work("low"), priority=0)
+        high = runner.submit(items(2), tracker.work("high"), priority=5)
+        await asyncio.gather(low.done_event.wait(), high.done_event.wait())
+        return tracker.started
+
+    # Первый элемент low уже запущен; дальше сначала весь пакет high
+    assert asyncio.run(run()) == ["low:0", "high:0", "high:1", "low:1", "low:2"]
+
+
+def test_item_errors_and_skipped_items_are_reported():
+    async def run():
+        runner = BatchRunner(max_parallel=2)
+        batch = runner.submit(["ok", "fail"], Tracker().work("a"), skipped={"42": "no export"})
+        await batch.done_event.wait()
+        return batch.stats()
+
+    stats = asyncio.run(run())
+    assert stats["counts"] == {"success": 1, "error": 1, "skipped": 1}
+    assert stats["progress"] == 1.0
+    assert stats["items"]["ok"]["result"] == "готово ok"
+    assert stats["items"]["fail"]["error"] == "нет экспорта"
+
+
+def test_cancel_drops_pending_items_only():
+    async def run():
+        runner = BatchRunner(max_parallel=1)
+        batch = runner.submit(items(4), Tracker(delay=0.05).work("a"))
+        await asyncio.sleep(0.01)
+        assert runner.cancel(batch.batch_id)
+        await batch.done_event.wait()
+        return runner, batch
+
+    runner, batch = asyncio.run(run())
+    assert batch.status == CANCELLED
+    assert batch.counts() == {"success": 1, CANCELLED: 3}
+    assert not runner.cancel(batch.batch_id)
+
+
+def test_empty_batch_finishes_immediately():
+    async def run():
+        runner = BatchRunner()
+        return runner.submit([], Tracker().work("a"), skipped={"1": "no export"})
+
+    batch = asyncio.run(run())
+    assert batch.status == COMPLETED and batch.done_event.is_set()
@@ -0,0 +1,92 @@
+"""Пул LLM-бэкендов: выбор бэкенда, честная очередь владельцев, исключение"""
+
+import asyncio
+
+from services import llm_pool
+from services.llm_pool import Backend, LLMPool
+
+
+def test_requests_spread_over_least_loaded_backends():
+    async def run():
+        pool = LLMPool([Backend("http://a", 2), Backend("http://b", 2)])
+        return [(await pool.acquire()).url for _ in range(4)]
+
+    assert sorted(asyncio.run(run())) == ["http://a", "http://a", "http://b", "http://b"]
+
+
+def test_free_slots_go_to_tenants_in_turn():
+    """Чат с очередью запросов не задерживает запрос другого владельца"""
+    async def run():
+        pool = LLMPool([Backend("http://a", 1)])
+        backend = await pool.acquire("busy")
+        order = []
+
+        async def request(tenant):
+            granted = await pool.acquire(tenant)
+            order.append(tenant)
+            pool.release(granted, ok=True)
+
+        tasks = [asyncio.create_task(request("busy")) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request("other")))
+        await asyncio.sleep(0)
+        assert pool.stats()["queued_by_tenant"] == {"busy": 3, "other": 1}
+
+        pool.release(backend, ok=True)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["busy", "other", "busy", "busy"]
+
+
+def test_cancelled_waiter_does_not_hold_a_slot():
+    async def run():
+        pool = LLMPool([Backend("http://a", 1)])
+        backend = await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire("gone"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        pool.release(backend, ok=True)
+        await asyncio.gather(waiter, return_exceptions=True)
+        return pool, backend
+
+    pool, backend = asyncio.run(run())
+    assert backend.active == 0
+    assert pool.queued() == 0
+
+
+def test_failing_backend_is_ejected_and_skipped():
+    async def run():
+        broken, healthy = Backend("http://broken", 4), Backend("http://healthy", 4)
+        pool = LLMPool([broken, healthy])
+        for _ in range(llm_pool.LLM_EJECT_FAILURES):
+            pool.release(await pool.acquire(prefer="http://broken"), ok=False)
+        assert not broken.healthy
+        # Предпочтение исключённого бэкенда не действует
+        return [(await pool.acquire(prefer="http://broken")).url for _ in range(3)]
+
+    assert asyncio.run(run()) == ["http://healthy"] * 3
+
+
+def test_client_errors_do_not_count_towards_ejection():
+    async def run():
+        backend = Backend("http://a", 1)
+        pool = LLMPool([backend, Backend("http://b", 1)])
+        for _ in range(llm_pool.LLM_EJECT_FAILURES + 1):
+            pool.release(await pool.acquire(prefer="http://a"), ok=None)
+        return backend
+
+    backend = asyncio.run(run())
+    assert backend.healthy and backend.errors == 0
+
+
+def test_single_backend_is_never_ejected():
+    async def run():
+        backend = Backend("http://only", 1)
+        pool = LLMPool([backend])
+        for _ in range(llm_pool.LLM_EJECT_FAILURES * 2):
+            pool.release(await pool.acquire(), ok=False)
+        return backend
+
+    backend = asyncio.run(run())
+    assert backend.healthy and backend.errors == llm_pool.LLM_EJECT_FAILURES * 2
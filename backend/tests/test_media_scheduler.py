@@ -0,0 +1,77 @@
+"""Планировщик медиа: приоритеты, лимиты объёма, отложенные файлы и отмена"""
+
+import asyncio
+
+import pytest
+
+from benchmarks.fake_telegram import FakeDocument, FakeTelegramClient
+from services.media_scheduler import (MediaScheduler, DEFERRED, DOWNLOADED, SKIPPED, load_deferred)
+
+KB = 1024
+MIME = {"voice": "audio/ogg", "video": "video/mp4", "document": "application/pdf"}
+
+
+def document(doc_id: int, kind: str, size: int) -> FakeDocument:
+    return FakeDocument(doc_id, size, MIME[kind])
+
+
+def test_job_budget_goes_to_priority_types_first(tmp_path):
+    """Видео, поставленное первым, не съедает бюджет голосовых"""
+    async def run():
+        client = FakeTelegramClient([])
+        async with MediaScheduler(client, workers=1, max_job_mb=1, defer=[]) as scheduler:
+            video = scheduler.submit("video", 1, document(1, "video", 400 * KB), str(tmp_path / "video.mp4"))
+            voices = [scheduler.submit("voice", i, document(i, "voice", 300 * KB), str(tmp_path / f"voice{i}.ogg"))
+                      for i in range(2, 5)]
+        return scheduler, video.result(), [future.result() for future in voices]
+
+    scheduler, video, voices = asyncio.run(run())
+    assert [result["status"] for result in voices] == [DOWNLOADED] * 3
+    assert video["status"] == SKIPPED and video["reason"] == "max_job_mb"
+    assert scheduler.bytes_downloaded == 900 * KB
+    assert not (tmp_path / "video.mp4").exists()
+
+
+def test_file_over_limit_is_skipped_without_download(tmp_path):
+    async def run():
+        client = FakeTelegramClient([])
+        async with MediaScheduler(client, max_file_mb=0.5, defer=[]) as scheduler:
+            big = scheduler.submit("document", 1, document(1, "document", 600 * KB), str(tmp_path / "big.pdf"))
+            small = scheduler.submit("document", 2, document(2, "document", 100 * KB), str(tmp_path / "small.pdf"))
+        return client, big.result(), small.result()
+
+    client, big, small = asyncio.run(run())
+    assert big["status"] == SKIPPED and big["reason"] == "max_file_mb"
+    assert small["status"] == DOWNLOADED
+    assert client.calls["download_media"] == 1
+
+
+def test_deferred_video_is_written_to_manifest(tmp_path):
+    async def run():
+        client = FakeTelegramClient([])
+        async with MediaScheduler(client, defer=["video"]) as scheduler:
+            future = scheduler.submit("video", 7, document(7, "video", 200 * KB), str(tmp_path / "video.mp4"))
+        scheduler.write_deferred(str(tmp_path))
+        return future.result()
+
+    assert asyncio.run(run())["status"] == DEFERRED
+    entries = load_deferred(str(tmp_path))
+    assert [(entry["message_id"], entry["type"], entry["size"]) for entry in entries] == [(7, "video", 200 * KB)]
+
+
+def test_error_resolves_in_flight_and_queued_futures(tmp_path):
+    """Ошибка в блоке отменяет и скачивающийся файл, и очередь — никто не ждёт вечно"""
+    async def run():
+        client = FakeTelegramClient([], download_latency=10)
+        futures = []
+        with pytest.raises(RuntimeError):
+            async with MediaScheduler(client, workers=1, defer=[]) as scheduler:
+                for i in range(3):
+                    futures.append(scheduler.submit("voice", i, document(i, "voice", KB), str(tmp_path / f"{i}.ogg")))
+                # Первый файл уже скачивается
+                await asyncio.sleep(0.05)
+                raise RuntimeError("экспорт прерван")
+        return futures
+
+    futures = asyncio.run(run())
+    assert all(future.cancelled() for future in futures)
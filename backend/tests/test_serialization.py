@@ -0,0 +1,111 @@
+"""Сериализация: определение формата по содержимому, потоки сообщений, запись файлов"""
+
+import io
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from services import serialization
+from services.serialization import JSON, MSGPACK
+
+needs_msgpack = pytest.mark.skipif(serialization.msgpack is None, reason="нужен пакет msgpack")
+
+MESSAGES = [{"message_id": i, "from": "User", "text": f"привет {i}"} for i in range(3)]
+
+
+@pytest.mark.parametrize("head, expected", [
+    (b"", False),
+    (b"[", False),
+    (b"{", False),
+    (b"\xef\xbb\xbf", False),
+    (b"\x81", True),     # словарь (fixmap)
+    (b"\x93", True),     # массив (fixarray)
+    (b"\xdc", True),     # array16
+    (b"\xdf", True),     # map32
+    (b"\xa5", False),    # строка — не начало хранилища
+])
+def test_msgpack_head_detection(head, expected):
+    assert serialization.is_msgpack(head) is expected
+
+
+@needs_msgpack
+@pytest.mark.parametrize("fmt", [JSON, MSGPACK])
+def test_loads_detects_format(fmt):
+    data = {"chat": 1, "messages": MESSAGES}
+    assert serialization.loads(serialization.dumps(data, fmt)) == data
+
+
+def test_loads_skips_bom():
+    assert serialization.loads(b"\xef\xbb\xbf" + serialization.dumps_json(MESSAGES)) == MESSAGES
+
+
+def test_unsupported_values_are_converted():
+    data = {"time": datetime(2024, 1, 2, 3, 4, 5), "vector": np.arange(3, dtype=np.float32)}
+    assert serialization.loads(serialization.dumps(data)) == {"time": "2024-01-02T03:04:05",
+                                                              "vector": [0.0, 1.0, 2.0]}
+
+
+@pytest.mark.parametrize("fmt", [JSON, pytest.param(MSGPACK, marks=needs_msgpack)])
+def test_message_stream_round_trip(fmt):
+    f = io.BytesIO()
+    serialization.write_messages(f, MESSAGES, fmt)
+    f.seek(0)
+    assert list(serialization.iter_messages(f)) == MESSAGES
+
+
+@needs_msgpack
+def test_appended_msgpack_messages_follow_the_stream():
+    f = io.BytesIO()
+    serialization.write_messages(f, MESSAGES[:2], MSGPACK)
+    f.write(serialization.dumps_message(MESSAGES[2], MSGPACK))
+    f.seek(0)
+    assert list(serialization.iter_messages(f)) == MESSAGES
+
+
+@needs_msgpack
+def test_msgpack_list_written_as_one_array_is_flattened():
+    f = io.BytesIO(serialization.dumps(MESSAGES, MSGPACK))
+    assert list(serialization.iter_messages(f)) == MESSAGES
+
+
+@pytest.mark.parametrize("content", [b"", b"[]\n", b"\xef\xbb\xbf[]"])
+def test_empty_message_files(content):
+    assert list(serialization.iter_messages(io.BytesIO(content))) == []
+
+
+@needs_msgpack
+def test_file_format_sniffs_content(tmp_path):
+    path = str(tmp_path / "store.json")
+    assert serialization.file_format(path) is None
+    open(path, 'wb').close()
+    assert serialization.file_format(path) is None
+    serialization.dump(path, MESSAGES, JSON)
+    assert serialization.file_format(path) == JSON
+    # Расширение не важно: формат определяется по первым байтам
+    serialization.dump(path, MESSAGES, MSGPACK)
+    assert serialization.file_format(path) == MSGPACK
+    assert serialization.load(path) == MESSAGES
+
+
+def test_load_missing_file_returns_default(tmp_path):
+    assert serialization.load(str(tmp_path / "missing.json"), default={}) == {}
+
+
+def test_dump_leaves_no_temporary_files(tmp_path):
+    path = tmp_path / "index.json"
+    serialization.dump(str(path), {"a": 1}, pretty=True)
+    assert [p.name for p in tmp_path.iterdir()] == ["index.json"]
+    assert serialization.load(str(path)) == {"a": 1}
+
+
+def test_msgpack_falls_back_to_json_without_package(monkeypatch):
+    monkeypatch.setattr(serialization, "msgpack", None)
+    monkeypatch.setattr(serialization, "_warned", True)
+    assert serialization.store_format(MSGPACK) == JSON
+    assert serialization.dumps(MESSAGES, MSGPACK).startswith(b"[")
+
+
+def test_unknown_store_format_is_rejected():
+    with pytest.raises(ValueError):
+        serialization.store_format("yaml")
@@ -0,0 +1,135 @@
+"""Single-flight: одинаковые одновременные вызовы и потоки выполняются один раз"""
+
+import asyncio
+
+import pytest
+
+from services.single_flight import SingleFlight
+
+
+class Work:
+    """Счётчик вызовов с управляемым завершением"""
+
+    def __init__(self, result="ответ", error=None):
+        self.calls = 0
+        self.result = result
+        self.error = error
+        self.release = None
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_concurrent_calls_share_one_run():
+    async def run():
+        flight, work = SingleFlight("test"), Work()
+        work.release = asyncio.Event()
+        callers = [asyncio.create_task(flight.run("key", work)) for _ in range(5)]
+        await asyncio.sleep(0)
+        work.release.set()
+        return flight, work, await asyncio.gather(*callers)
+
+    flight, work, results = asyncio.run(run())
+    assert results == ["ответ"] * 5
+    assert work.calls == 1
+    assert (flight.leaders, flight.joined) == (1, 4)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_different_keys_run_separately():
+    async def run():
+        flight, work = SingleFlight("test"), Work()
+        work.release = asyncio.Event()
+        work.release.set()
+        await asyncio.gather(flight.run("a", work), flight.run("b", work))
+        return work
+
+    assert asyncio.run(run()).calls == 2
+
+
+def test_error_reaches_every_caller_and_frees_the_key():
+    async def run():
+        flight, work = SingleFlight("test"), Work(error=RuntimeError("LLM недоступна"))
+        work.release = asyncio.Event()
+        callers = [asyncio.create_task(flight.run("key", work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        work.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        # После ошибки тот же ключ выполняется заново
+        work.error = None
+        return work, results, await flight.run("key", work)
+
+    work, results, retry = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retry == "ответ" and work.calls == 2
+
+
+def test_cancelled_caller_does_not_stop_work_for_others():
+    async def run():
+        flight, work = SingleFlight("test"), Work()
+        work.release = asyncio.Event()
+        first = asyncio.create_task(flight.run("key", work))
+        second = asyncio.create_task(flight.run("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        work.release.set()
+        return first, await second
+
+    first, result = asyncio.run(run())
+    assert first.cancelled()
+    assert result == "ответ"
+
+
+def test_late_stream_subscriber_gets_all_chunks():
+    async def run():
+        flight = SingleFlight("test")
+        calls = 0
+        halfway = asyncio.Event()
+        release = asyncio.Event()
+
+        async def source():
+            nonlocal calls
+            calls += 1
+            for chunk in ("раз", "два"):
+                yield chunk
+            halfway.set()
+            await release.wait()
+            yield "три"
+
+        async def collect():
+            return [chunk async for chunk in flight.stream("key", source)]
+
+        early = asyncio.create_task(collect())
+        await halfway.wait()
+        late = asyncio.create_task(collect())
+        await asyncio.sleep(0)
+        release.set()
+        return calls, await early, await late
+
+    calls, early, late = asyncio.run(run())
+    assert calls == 1
+    assert early == late == ["раз", "два", "три"]
+
+
+def test_stream_error_reaches_subscribers():
+    async def run():
+        flight = SingleFlight("test")
+
+        async def source():
+            yield "начало"
+            raise RuntimeError("обрыв")
+
+        received = []
+        with pytest.raises(RuntimeError):
+            async for chunk in flight.stream("key", source):
+                received.append(chunk)
+        return flight, received
+
+    flight, received = asyncio.run(run())
+    assert received == ["начало"]
+    assert flight.stats()["streams_in_flight"] == 0
@@ -0,0 +1,82 @@
+"""Хранилище экспортов: запись, дозапись и конвертация между форматами"""
+
+import os
+import threading
+
+import pytest
+
+from services import serialization, storage
+
+METHODS = ["none", "gzip", pytest.param("zstd", marks=pytest.mark.skipif(
+    storage.zstandard is None, reason="нужен пакет zstandard"))]
+
+
+def messages(count: int, start: int = 0):
+    return [{"message_id": i, "from": f"User{i % 2}", "text": f"сообщение {i}"} for i in range(start, start + count)]
+
+
+@pytest.fixture
+def live_path(tmp_path):
+    os.makedirs(tmp_path / "live")
+    return str(tmp_path / "live" / "chat.json")
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_write_then_append_round_trip(tmp_path, method):
+    path = str(tmp_path / "chat_export.json")
+    actual = storage.write_messages(path, messages(5), method)
+    assert actual == storage.target_path(path, method)
+    for message in messages(3, start=5):
+        storage.append_message(path, message)
+    assert storage.read_messages(path) == messages(8)
+
+
+def test_live_json_is_migrated_to_msgpack_on_append(live_path):
+    if serialization.store_format(serialization.MSGPACK) != serialization.MSGPACK:
+        pytest.skip("нужен пакет msgpack")
+    storage.write_messages(live_path, messages(3), "none", serialization.JSON)
+    storage.append_message(live_path, messages(1, start=3)[0], fmt=serialization.MSGPACK)
+    assert serialization.file_format(live_path) == serialization.MSGPACK
+    assert storage.read_messages(live_path) == messages(4)
+
+
+def test_convert_replaces_variant_and_keeps_messages(tmp_path):
+    path = str(tmp_path / "chat_export.json")
+    storage.write_messages(path, messages(50), "none")
+    result = storage.convert(path, "gzip")
+    assert result["file"] == path[:-len(".json")] + ".jsonl.gz"
+    assert result["bytes_after"] < result["bytes_before"]
+    assert not os.path.exists(path)
+    assert storage.read_messages(path) == messages(50)
+    # Повторная конвертация в тот же формат ничего не делает
+    assert storage.convert(path, "gzip") is None
+
+
+def test_convert_tree_handles_texts_and_live_files(tmp_path, live_path):
+    export_dir = tmp_path / "123_chat"
+    os.makedirs(export_dir)
+    storage.write_text(str(export_dir / "chat_for_llm.txt"), "строка\n" * 100, "none")
+    storage.write_messages(live_path, messages(10), "none")
+
+    status = storage.convert_tree([str(tmp_path)], "gzip")
+    assert (status["status"], status["total"], status["converted"], status["errors"]) == ("completed", 2, 2, [])
+    assert storage.read_text(str(export_dir / "chat_for_llm.txt")) == "строка\n" * 100
+    assert storage.read_messages(live_path) == messages(10)
+
+
+def test_append_during_conversion_is_not_lost(tmp_path, live_path):
+    """Сообщение, пришедшее во время конвертации, попадает в новый файл"""
+    storage.write_messages(live_path, messages(3000), "none")
+    appended = messages(200, start=3000)
+
+    def append_all():
+        for message in appended:
+            storage.append_message(live_path, message)
+
+    writer = threading.Thread(target=append_all)
+    writer.start()
+    storage.convert_tree([str(tmp_path)], "gzip")
+    writer.join()
+
+    ids = [message["message_id"] for message in storage.read_messages(live_path)]
+    assert sorted(ids) == list(range(3200))
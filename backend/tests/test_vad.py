@@ -0,0 +1,46 @@
+"""Перевод времени обрезанного аудио во время исходной записи"""
+
+import numpy as np
+
+from services import vad
+
+RATE = 1000
+SEGMENTS = [(1000, 2000), (5000, 6000)]
+
+
+def test_time_inside_first_segment():
+    assert vad.to_original_time(0.5, SEGMENTS, RATE) == 1.5
+
+
+def test_time_skips_removed_silence():
+    # 1.5 с обрезанного аудио — 0.5 с во втором участке речи
+    assert vad.to_original_time(1.5, SEGMENTS, RATE) == 5.5
+
+
+def test_segment_boundary_stays_in_previous_segment():
+    assert vad.to_original_time(1.0, SEGMENTS, RATE) == 2.0
+
+
+def test_time_past_end_clamps_to_last_segment():
+    assert vad.to_original_time(10.0, SEGMENTS, RATE) == 6.0
+
+
+def test_no_segments_keeps_time():
+    assert vad.to_original_time(3.25, [], RATE) == 3.25
+
+
+def test_round_trip_with_trim_silence():
+    """Время слова в обрезанной записи попадает в тот же участок речи исходной"""
+    rate = vad.SAMPLE_RATE
+    rng = np.random.default_rng(0)
+    audio = np.zeros(6 * rate, dtype=np.float32)
+    audio[1 * rate:2 * rate] = rng.uniform(-0.5, 0.5, rate)
+    audio[4 * rate:5 * rate] = rng.uniform(-0.5, 0.5, rate)
+
+    segments = vad.speech_segments(audio, rate)
+    trimmed = vad.trim_silence(audio, rate)
+    assert len(trimmed) == sum(end - start for start, end in segments)
+
+    first = segments[0][1] - segments[0][0]
+    original = vad.to_original_time((first + rate // 2) / rate, segments, rate)
+    assert 4.0 <= original <= 5.0